@@ -0,0 +1,300 @@
+import re
+
+# This file implements the world-wide address index, which resolves garbled or partial addresses ("jon smiht, 12 mian st, piketwn, 27049")
+# to the senders, houses and towns they most likely refer to.
+#
+# Names in the world are drawn from short word lists, so there are few distinct town, street and sender names even in huge worlds. Each
+# kind of name has a trigram index over its distinct values, and zip codes have an index by edit distance. A query is split into its parts, each part is
+# matched against the index of its kind, and the matches are combined top-down: towns by zip code and name, then streets and house numbers
+# within those towns, then senders within those houses or towns. Objects are only ever looked up within a few candidate towns, so queries
+# take about the same time however large the world is.
+
+# Gets the trigrams of a string, padded so that the start and end of words count.
+def trigrams(s):
+	s = "  " + s + " "
+	return {s[i:i + 3] for i in range(len(s) - 2)}
+
+# Gets the number of single character insertions, deletions and substitutions needed to turn one string into the other.
+def levenshtein(a, b):
+	prev = list(range(len(b) + 1))
+	for i in range(len(a)):
+		cur = [i + 1]
+		for j in range(len(b)):
+			cur.append(min(prev[j + 1] + 1, cur[j] + 1, prev[j] + (a[i] != b[j])))
+		prev = cur
+
+	return prev[-1]
+
+# Trigram index over a set of distinct strings.
+class ngram_index:
+	def __init__(self):
+		self.keys = []
+		self.key_grams = []
+		self.key_index = {}
+		self.postings = {}
+
+	def add(self, key):
+		if key in self.key_index:
+			return
+
+		k_i = len(self.keys)
+		self.key_index[key] = k_i
+		self.keys.append(key)
+
+		grams = trigrams(key)
+		self.key_grams.append(grams)
+		for g in grams:
+			if g in self.postings:
+				self.postings[g].append(k_i)
+			else:
+				self.postings[g] = [k_i]
+
+	# Gets up to limit (similarity, key) pairs for the keys most similar to s, best first. Keys less similar than min_sim are left out.
+	def query(self, s, limit=8, min_sim=0.3):
+		grams = trigrams(s)
+
+		shared = {}
+		for g in grams:
+			for k_i in self.postings.get(g, ()):
+				shared[k_i] = shared.get(k_i, 0) + 1
+
+		results = []
+		for k_i, n in shared.items():
+			sim = 2 * n / (len(grams) + len(self.key_grams[k_i]))
+			if sim >= min_sim:
+				results.append((sim, self.keys[k_i]))
+
+		results.sort(key=lambda r: (-r[0], r[1]))
+		return results[:limit]
+
+# Index of short strings, such as zip codes, by edit distance. Every key is stored under each string left by deleting up to max_dist of its
+# characters. Two strings within max_dist edits of each other always share one of those, so a query only looks up the deletions of the
+# query instead of comparing against every key, which a BK-tree would end up doing over keys as short and uniform as zip codes.
+class deletion_index:
+	def __init__(self, max_dist):
+		self.max_dist = max_dist
+		self.variants = {}
+
+	# Gets s and every string left by deleting up to max_dist of its characters.
+	def deletions(self, s, max_dist):
+		found = {s}
+		edge = [s]
+		for d in range(max_dist):
+			next_edge = []
+			for v in edge:
+				for i in range(len(v)):
+					w = v[:i] + v[i + 1:]
+					if w not in found:
+						found.add(w)
+						next_edge.append(w)
+			edge = next_edge
+
+		return found
+
+	def add(self, key):
+		for v in self.deletions(key, self.max_dist):
+			keys = self.variants.get(v)
+			if keys is None:
+				self.variants[v] = [key]
+			elif key not in keys:
+				keys.append(key)
+
+	# Gets every (distance, key) pair for the keys at most max_dist edits from s, nearest first. max_dist can't be more than the index's.
+	# Short deletions are shared by many keys, so queries with a smaller max_dist have far fewer candidates to check.
+	def query(self, s, max_dist):
+		candidates = set()
+		for v in self.deletions(s, max_dist):
+			candidates.update(self.variants.get(v, ()))
+
+		results = []
+		for key in candidates:
+			d = levenshtein(s, key)
+			if d <= max_dist:
+				results.append((d, key))
+
+		results.sort()
+		return results
+
+# Index of every address in the world. Built by postman.gen_map as pm.addresses.
+class address_index:
+	def __init__(self, pm):
+		self.pm = pm
+
+		self.town_names = ngram_index()
+		self.towns_by_name = {}
+
+		self.zips = deletion_index(2)
+		self.towns_by_zip = {}
+
+		self.street_names = ngram_index()
+
+		# Senders by name, then by the town they live in. Kept up to date by move.
+		self.sender_names = ngram_index()
+		self.senders_by_name = {}
+
+		for t in pm.towns:
+			self.add_town(t)
+
+	def add_town(self, t):
+		name = t.name.lower()
+		self.town_names.add(name)
+		self.towns_by_name.setdefault(name, []).append(t)
+
+		zip_code = str(t.zip_code)
+		self.zips.add(zip_code)
+		self.towns_by_zip.setdefault(zip_code, []).append(t)
+
+		for s in t.streets:
+			self.street_names.add(s.name.lower())
+
+		for c in t.citizens:
+			self.add_sender(c)
+
+	def add_sender(self, s):
+		name = (s.first_name + " " + s.last_name).lower()
+		by_town = self.senders_by_name.get(name)
+		if by_town is None:
+			self.sender_names.add(name)
+			by_town = {}
+			self.senders_by_name[name] = by_town
+
+		ss = by_town.get(s.town)
+		if ss is None:
+			by_town[s.town] = [s]
+		else:
+			ss.append(s)
+
+	# Update the index after a sender moved out of the given town.
+	def move(self, s, old_town):
+		if old_town is s.town:
+			return
+
+		by_town = self.senders_by_name[(s.first_name + " " + s.last_name).lower()]
+		by_town[old_town].remove(s)
+		if len(by_town[old_town]) == 0:
+			del by_town[old_town]
+
+		by_town.setdefault(s.town, []).append(s)
+
+	# Gets up to limit (score, town) pairs for the towns matching a zip code and a town name, either of which may be None. Best first.
+	def match_towns(self, zip_code, name, limit):
+		scores = {}
+		if zip_code is not None:
+			# Look further only if nothing is a typo away.
+			matches = self.zips.query(zip_code, 1)
+			if len(matches) == 0:
+				matches = self.zips.query(zip_code, 2)
+
+			for d, key in matches:
+				for t in self.towns_by_zip[key]:
+					scores[t] = scores.get(t, 0) + 1 - d / max(len(key), 1)
+
+		if name is not None:
+			# If the zip code matched, the name only ranks the towns it matched.
+			by_zip = len(scores) > 0
+			for sim, key in self.town_names.query(name):
+				for t in self.towns_by_name[key]:
+					if not by_zip or t in scores:
+						scores[t] = scores.get(t, 0) + sim
+
+		return sorted(((score, t) for t, score in scores.items()), key=lambda r: -r[0])[:limit]
+
+	# Resolve an address, in the order and form of get_address_line, but possibly misspelled or missing parts. Returns up to limit
+	# (score, object) pairs, best first. Objects are senders if a sender's name was given, else houses if a street was given, else towns.
+	# Scores add up the similarity of every part of the address that matched.
+	def resolve(self, dest, limit=5, num_towns=5):
+		parts = [p.strip() for p in re.split(r"[,\n]", dest.lower()) if p.strip() != ""]
+
+		# Tell the parts apart: the zip code is one word with digits in it, a house is a number followed by a street name, the sender's name
+		# comes before the house and the town's name after it.
+		zip_code = None
+		house_number = None
+		street_name = None
+		names = []
+		for p in parts:
+			match = re.match(r"(\d+)\s+(.+)$", p)
+			if " " not in p and re.search(r"\d", p) is not None:
+				zip_code = p
+			elif match is not None and street_name is None:
+				house_number = int(match.group(1))
+				street_name = match.group(2)
+			else:
+				names.append((p, street_name is not None))
+
+		sender_name = None
+		town_name = None
+		for p, after_house in names:
+			if after_house or (street_name is None and sender_name is not None):
+				town_name = p
+			elif street_name is None and zip_code is None and len(names) == 1 and self.is_town_name(p):
+				town_name = p
+			else:
+				sender_name = p
+
+		towns = None
+		if zip_code is not None or town_name is not None:
+			towns = self.match_towns(zip_code, town_name, num_towns)
+
+		# Houses, within the candidate towns.
+		houses = None
+		if street_name is not None and towns is not None:
+			street_sims = dict((key, sim) for sim, key in self.street_names.query(street_name))
+			houses = []
+			for t_score, t in towns:
+				for s in t.streets:
+					sim = street_sims.get(s.name.lower())
+					if sim is None:
+						continue
+
+					for h in s.houses:
+						if h.number == house_number:
+							houses.append((t_score + sim + 1, h))
+						elif levenshtein(str(h.number), str(house_number)) == 1:
+							houses.append((t_score + sim + 0.5, h))
+
+		if sender_name is None:
+			results = houses if houses is not None else towns if towns is not None else []
+			results.sort(key=lambda r: -r[0])
+			return results[:limit]
+
+		# Senders, within the candidate houses, or else the candidate towns, or else anywhere.
+		# Houses hold a few senders each, so their names are compared directly.
+		results = []
+		if houses is not None:
+			grams = trigrams(sender_name)
+			for h_score, h in houses:
+				for s in h.senders:
+					s_grams = trigrams((s.first_name + " " + s.last_name).lower())
+					sim = 2 * len(grams & s_grams) / (len(grams) + len(s_grams))
+					if sim >= 0.3:
+						results.append((h_score + sim, s))
+
+		if len(results) == 0:
+			name_sims = self.sender_names.query(sender_name, 16)
+			for sim, key in name_sims:
+				by_town = self.senders_by_name[key]
+				if towns is None:
+					for ss in by_town.values():
+						results.extend((sim, s) for s in ss)
+				else:
+					for t_score, t in towns:
+						results.extend((t_score + sim, s) for s in by_town.get(t, ()))
+
+		results.sort(key=lambda r: -r[0])
+		return results[:limit]
+
+	# Whether a string is more like a town name than a sender's name.
+	def is_town_name(self, s):
+		town = self.town_names.query(s, 1)
+		name = self.sender_names.query(s, 1)
+		return len(town) > 0 and (len(name) == 0 or town[0][0] >= name[0][0])
+
+	# Gets the place an address most likely refers to: the house of the best matching sender or house, or the best matching town. Returns
+	# None if nothing matches.
+	def resolve_place(self, dest):
+		results = self.resolve(dest, 1)
+		if len(results) == 0:
+			return None
+
+		obj = results[0][1]
+		return obj.house if hasattr(obj, "house") else obj
@@ -0,0 +1,661 @@
+import argparse
+import gc
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import deque
+
+from postman_classes import *
+from mail_store import *
+from snapshot import *
+from shards import *
+from protocol import *
+
+# This file benchmarks the hot paths of the mail simulation. It must be run from the repository root so that the server files can be found.
+# Usage: python benchmark.py [num_towns] [num_mail] [num_store_mail] [--seed SEED] [--json FILE]
+# Every world and every letter is drawn from generators seeded with SEED, so two runs with the same arguments do the same work and their
+# timings can be compared between commits. With --json, the results are also written to FILE as JSON.
+
+# Seed used when none is given.
+BENCH_SEED = 1
+
+# Routing as it was before the routing backends existed, as the baseline of bench_routing: a dict of dicts of hop counts between towns by
+# zip code, and a scan of the current town's neighbors for one nearer to the destination at every hop.
+class scan_router:
+	def __init__(self, towns):
+		self.towns = {}
+		self.dist = {}
+		for a in towns:
+			self.towns[a.zip_code] = a
+			dist = {a.zip_code: 0}
+			edge = deque([a])
+			while len(edge) > 0:
+				cur = edge.popleft()
+				for n in cur.neighbors:
+					if n.zip_code not in dist:
+						dist[n.zip_code] = dist[cur.zip_code] + 1
+						edge.append(n)
+
+			self.dist[a.zip_code] = dist
+
+	def next_hop(self, cur_zip, dest_zip):
+		my_dis = self.dist[cur_zip][dest_zip]
+		for n in self.towns[cur_zip].neighbors:
+			if self.dist[n.zip_code][dest_zip] < my_dis:
+				return n
+
+		return None
+
+# Build a routing backend, returning it with its build time and the memory it allocated.
+def build_backend(cls, towns):
+	tracemalloc.start()
+	start = time.perf_counter()
+	rt = cls(towns)
+	elapsed = time.perf_counter() - start
+	size = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	return rt, elapsed, size
+
+# Generate a world with roughly the requested number of towns. min_town_sep can be lowered to fit more towns on the map.
+def gen_world(num_towns, min_town_sep=None, routing=None, seed=BENCH_SEED):
+	pm = postman("postman_campaign", seed)
+	pm.settings.world_gen.num_additional_towns = max(0, num_towns - pm.settings.world_gen.num_connecting_towns - 1)
+	if min_town_sep is not None:
+		pm.settings.world_gen.min_town_sep = min_town_sep
+	if routing is not None:
+		pm.settings.routing = routing
+	pm.gen_map()
+	return pm
+
+# Time world generation for several town counts, with a separation small enough for all of them to fit.
+def bench_gen_map(town_counts, min_town_sep=4, seed=BENCH_SEED):
+	results = []
+	for num_towns in town_counts:
+		start = time.perf_counter()
+		pm = gen_world(num_towns, min_town_sep, "tree", seed)
+		results.append((len(pm.towns), len(pm.senders), time.perf_counter() - start))
+
+	return results
+
+# Generate mail and run it through a few days so that it is spread over the network. If batch, the mail is generated with gen_mail_batch.
+def gen_post(pm, num_mail, batch=False):
+	if batch:
+		pm.gen_mail_batch(num_mail)
+	else:
+		for i in range(num_mail):
+			pm.gen_mail()
+
+	for day in range(3):
+		tick_objects(pm)
+
+# Time the automated routers handling the same mail for several days with each router, each on a fresh world from the same seed. The
+# routers take turns, reps times, and the fastest run of each is kept. Returns the number of letters handled per day, the seconds per day
+# spent in mail.handle and delivering with each router, and whether every router left the mail in the same places.
+def bench_routing(num_towns, num_mail, routers, days=3, reps=3, seed=BENCH_SEED):
+	results = {}
+	places = {}
+	for r in range(reps):
+		for name in routers:
+			pm = gen_world(num_towns, seed=seed)
+			pm.routing = routers[name](pm.towns)
+			pm.gen_mail_batch(num_mail)
+
+			# The worlds of the previous runs are collected first, so that they don't slow down this one.
+			gc.collect()
+
+			num_handled = 0
+			elapsed = 0
+			for day in range(days):
+				num_handled += len(pm.post)
+				elapsed += tick_objects(pm)[0]
+
+			results[name] = min(results.get(name, elapsed / days), elapsed / days)
+			places[name] = [(m.ID, m.current.get_address()) for m in pm.post]
+
+	return num_handled // days, results, all(p == places["scan"] for p in places.values())
+
+# Run one day of the automated routers over the mail objects in the post. Returns the time spent handling and delivering mail, and the time
+# spent advancing it, which is when notifications are sent.
+def tick_objects(pm):
+	start = time.perf_counter()
+
+	delivered = [m for m in pm.post if m.handle()]
+	for m in delivered:
+		m.deliver()
+
+	handled = time.perf_counter()
+	for m in pm.post:
+		m.advance()
+
+	return handled - start, time.perf_counter() - handled
+
+# Time one day of the automated routers over the mail objects in the post.
+def bench_tick_objects(pm):
+	return sum(tick_objects(pm))
+
+# Fill a columnar store with mail between random senders and run it through the given number of days so that it is spread over the network.
+# The store replaces pm.store, and the store it replaced is returned so that the caller can put it back.
+def gen_store_post(pm, num_mail, seed=BENCH_SEED, days=3):
+	st = mail_columns(pm)
+	rng = np.random.default_rng(seed)
+	st.add(rng.integers(0, len(pm.senders), num_mail), rng.integers(0, len(pm.senders), num_mail))
+	for day in range(days):
+		st.handle()
+		st.advance()
+
+	old_store = pm.store
+	pm.store = st
+	return old_store
+
+# Fill a columnar store with mail between random senders and time a few days of the automated routers over it.
+# If num_shards is given, the routers run in that many worker processes.
+def bench_tick_store(pm, num_mail, days=5, seed=BENCH_SEED, num_shards=None):
+	if np is None:
+		return None
+
+	old_store = gen_store_post(pm, num_mail, seed, 0)
+	st = pm.store
+	if num_shards is not None:
+		st.shards = shard_pool(st, num_shards)
+
+	results = []
+	for day in range(days):
+		num_letters = len(st)
+		start = time.perf_counter()
+		st.handle()
+		st.advance()
+		results.append((num_letters, time.perf_counter() - start))
+
+	if st.shards is not None:
+		st.shards.close()
+
+	pm.store = old_store
+	return results
+
+# Time whole simulated days, as run by the server, for several volumes of mail in transit. Returns the volume, mean seconds per day and
+# mean letters handled per second for each.
+def bench_tick_days(num_towns, volumes, days=3, seed=BENCH_SEED):
+	results = []
+	for num_mail in volumes:
+		pm = gen_world(num_towns, seed=seed)
+		pm.gen_mail_batch(num_mail)
+		stats = pm.simulate_days(days, False)
+		seconds = sum(d["seconds"] for d in stats)
+		results.append((num_mail, seconds / days, sum(d["letters"] for d in stats) / seconds))
+
+	return results
+
+# Time drawing the world map.
+def bench_draw_map(pm, fn="benchmark.png"):
+	start = time.perf_counter()
+	pm.draw_map(fn)
+	elapsed = time.perf_counter() - start
+	os.remove(fn)
+	return elapsed
+
+# Fill a columnar store with mail, spread it over the network, and time counting the mail on the map and drawing it over the cached base
+# layer. Returns the number of letters, the time to draw the base layer, and the median time to count and to draw a day's mail.
+def bench_draw_mail(pm, num_mail, reps=5, seed=BENCH_SEED):
+	if np is None:
+		return None
+
+	old_store = gen_store_post(pm, num_mail, seed)
+	st = pm.store
+
+	renderer = map_renderer(pm)
+	start = time.perf_counter()
+	renderer.get_base()
+	base_time = time.perf_counter() - start
+
+	count_times = []
+	draw_times = []
+	for i in range(reps):
+		start = time.perf_counter()
+		renderer.count_mail()
+		count_times.append(time.perf_counter() - start)
+
+		start = time.perf_counter()
+		renderer.draw_mail(pm.phase.day)
+		draw_times.append(time.perf_counter() - start)
+
+	pm.store = old_store
+	return len(st), base_time, sorted(count_times)[reps // 2], sorted(draw_times)[reps // 2]
+
+# Gets the share of the given letters sent within the sender's town, and the share addressed to someone the sender recently received mail from.
+def mail_shares(pm, letters):
+	num_local = 0
+	num_replies = 0
+	for m in letters:
+		recv_from = m.sender.recv_from
+		recv_from.recent(pm.phase.day, pm.srv.reply_window)
+		num_local += m.sender.town is m.recipient.town
+		num_replies += m.recipient.ID in [recv_from.get(i) for i in range(len(recv_from))]
+
+	return num_local / len(letters), num_replies / len(letters)
+
+# Time generating mail one letter at a time and in a batch, and report the shares of local mail and replies of each. Both generators start
+# from the same world, generated from seed with its mail spread for a few days so that senders have correspondents to reply to.
+def bench_gen_mail(num_towns, num_mail, seed=BENCH_SEED):
+	results = []
+	for batch in (False, True):
+		pm = gen_world(num_towns, seed=seed)
+		gen_post(pm, num_mail, True)
+
+		start = time.perf_counter()
+		if batch:
+			letters = pm.gen_mail_batch(num_mail)
+		else:
+			letters = [pm.gen_mail() for i in range(num_mail)]
+		results.append((time.perf_counter() - start,) + mail_shares(pm, letters))
+
+	return results
+
+# The action flags of a letter as they were kept before mail.act: a separate object per letter.
+class dict_mail_action:
+	def __init__(self):
+		self.routing_error = False
+		self.delivery_error = False
+		self.routed_damaged = False
+		self.delivered_damaged = False
+		self.following = None
+
+# A letter laid out as mail objects were before they had __slots__: attributes in a dict, a dict_mail_action, and copies of both addresses
+# and zip codes made when the letter is created. Only used by bench_memory, as the baseline of the current layout.
+class dict_mail:
+	def __init__(self, pm, sender, recipient):
+		self.sender = sender
+		self.recipient = recipient
+
+		self.srce_zip = sender.town.zip_code
+		self.dest_zip = recipient.town.zip_code
+
+		self.ID = pm.get_mail_ID()
+
+		self.srce = sender.build_address()
+		self.dest = recipient.build_address()
+
+		self.is_story = False
+		self.act = dict_mail_action()
+		self.stamp = 2
+		self.damage_lvl = 0
+		self.repair_lvl = 0
+		self.is_auto = True
+		self.previous = sender.house
+		self.current = sender.town
+		self.age = 0
+
+# Measure the memory used by each live letter as dict_mail objects, as mail objects and in the columnar store. Letters of both kinds of
+# objects are counted with their entries in the post, in their location's post and in their sender's mail in transit.
+def bench_memory(pm, num_mail):
+	post = {}
+	located = {}
+	in_transit = {}
+	tracemalloc.start()
+	before = tracemalloc.get_traced_memory()[0]
+	for i in range(num_mail):
+		m = dict_mail(pm, pm.rng.choice(pm.senders), pm.rng.choice(pm.senders))
+		post[m] = None
+		located[m] = None
+		in_transit[m] = None
+	per_dict = (tracemalloc.get_traced_memory()[0] - before) / num_mail
+	tracemalloc.stop()
+
+	post = located = in_transit = None
+
+	tracemalloc.start()
+	before = tracemalloc.get_traced_memory()[0]
+	letters = [pm.gen_mail() for i in range(num_mail)]
+	per_object = (tracemalloc.get_traced_memory()[0] - before) / num_mail
+	tracemalloc.stop()
+
+	for m in letters:
+		m.deliver()
+
+	per_row = None
+	if np is not None:
+		st = mail_columns(pm)
+		st.add(np.zeros(num_mail, dtype="i4"), np.ones(num_mail, dtype="i4"))
+		per_row = sum(c.nbytes for c in st.cols.values()) / num_mail
+
+	return per_dict, per_object, per_row
+
+# Time saving a world with mail in transit to a snapshot and loading it back, against generating the world from scratch.
+def bench_snapshot(num_towns, num_mail, fn="benchmark.snap", seed=BENCH_SEED):
+	start = time.perf_counter()
+	pm = gen_world(num_towns, 4, "tree", seed)
+	gen_time = time.perf_counter() - start
+
+	for i in range(num_mail):
+		pm.gen_mail()
+
+	start = time.perf_counter()
+	save_snapshot(pm, fn)
+	save_time = time.perf_counter() - start
+
+	start = time.perf_counter()
+	load_snapshot(fn)
+	load_time = time.perf_counter() - start
+
+	size = os.path.getsize(fn)
+	os.remove(fn)
+	return len(pm.towns), gen_time, save_time, load_time, size
+
+# File num_filed letters sitting in post offices into recovery bins, have every sender ask for theirs, and time the requests making their way
+# through the network until all are resolved, against searching every bin in the world for each letter. Returns the number of requests,
+# the number found, the number of days they took, and the seconds taken by each method.
+def bench_recovery(pm, num_filed):
+	gen_post(pm, num_filed * 4, True)
+
+	filed = [m for m in pm.post if type(m.current) is town][:num_filed]
+	for m in filed:
+		m.current.file_recovery(m)
+
+	# Requests are only submitted here.
+	pm.recovery.due = []
+	for m in filed:
+		pm.recovery.submit(m, pm.phase.day)
+
+	start = time.perf_counter()
+	num_found = 0
+	num_days = 0
+	while len(pm.recovery.requests) > 0:
+		found, num_failed = pm.recovery.handle(pm, pm.phase.day)
+		num_found += len(found)
+		num_days += 1
+	routed_time = time.perf_counter() - start
+
+	start = time.perf_counter()
+	for m in filed:
+		for t in pm.towns:
+			if t.recovery.find(m.ID, m.sender, m.recipient) is not None:
+				break
+	scan_time = time.perf_counter() - start
+
+	return len(filed), num_found, num_days, routed_time, scan_time
+
+# Spread the same mail over the network with aggregated and separate notifications, run one more day, and drain every post office's
+# notifications of that day as the "notes" command does. Returns the number of notifications, then for each mode the number of entries kept
+# and the time spent notifying and draining.
+def bench_notes(num_towns, num_mail, seed=BENCH_SEED):
+	results = []
+	for aggregate in (True, False):
+		pm = gen_world(num_towns, seed=seed)
+		gen_post(pm, num_mail, True)
+
+		for t in pm.towns:
+			t.notes = notice_board(aggregate)
+
+		notify_time = tick_objects(pm)[1]
+
+		num_entries = sum(len(t.notes) for t in pm.towns)
+		num_notes = sum(count for t in pm.towns for notifier, code, arg, count in t.notes)
+
+		start = time.perf_counter()
+		for t in pm.towns:
+			while len(t.notes) > 0:
+				t.pop_note()
+		drain_time = time.perf_counter() - start
+
+		results.append((num_entries, notify_time, drain_time))
+
+	return num_notes, results
+
+# Fill a columnar store with mail, spread it over the network, then move num_moves senders into empty houses and time the moves and the
+# next day's handle pass, which forwards the mail of the senders who moved. Returns the number of letters, the number of moves, the time
+# spent moving, the number of letters forwarded, and the time of the handle pass before and after the moves.
+def bench_moves(pm, num_mail, num_moves, seed=BENCH_SEED):
+	if np is None:
+		return None
+
+	old_store = gen_store_post(pm, num_mail, seed)
+	st = pm.store
+
+	start = time.perf_counter()
+	st.handle()
+	before_time = time.perf_counter() - start
+	st.advance()
+
+	num_moves = min(num_moves, len(pm.vacancies))
+	start = time.perf_counter()
+	for i in range(num_moves):
+		pm.move_sender(pm.senders[pm.rng.randrange(len(pm.senders))], pm.vacancies.get(pm.rng.randrange(len(pm.vacancies))))
+	move_time = time.perf_counter() - start
+
+	# Letters the handle pass will forward.
+	c = st.cols
+	num_forwarded = int(np.count_nonzero((c["current"] == st.place_town[c["addressed"]]) & (st.sender_house[c["recipient"]] != c["addressed"])))
+
+	start = time.perf_counter()
+	st.handle()
+	after_time = time.perf_counter() - start
+
+	pm.store = old_store
+	return num_mail, num_moves, move_time, num_forwarded, before_time, after_time
+
+# Misspell a string by deleting, inserting or replacing num_typos letters picked with rng.
+def misspell(s, num_typos, rng):
+	s = list(s)
+	for i in range(num_typos):
+		c_i = rng.randrange(len(s))
+		if not s[c_i].isalnum():
+			continue
+
+		op = rng.randrange(3)
+		if op == 0:
+			s[c_i] = rng.choice("abcdefghijklmnopqrstuvwxyz")
+		elif op == 1:
+			del s[c_i]
+		else:
+			s.insert(c_i, rng.choice("abcdefghijklmnopqrstuvwxyz"))
+
+	return "".join(s)
+
+# Time resolving the misspelled addresses of random senders with the address index. Returns the time to build the index, the median and
+# 99th percentile time per query, and the share of queries whose best match was the right sender.
+def bench_addresses(pm, num_queries=1000, num_typos=2, seed=BENCH_SEED):
+	start = time.perf_counter()
+	address_index(pm)
+	build_time = time.perf_counter() - start
+
+	rng = random.Random(seed)
+	times = []
+	num_correct = 0
+	for i in range(num_queries):
+		s = rng.choice(pm.senders)
+		dest = misspell(s.get_address_line(), num_typos, rng)
+
+		start = time.perf_counter()
+		results = pm.addresses.resolve(dest)
+		times.append(time.perf_counter() - start)
+
+		if len(results) > 0 and results[0][1] is s:
+			num_correct += 1
+
+	times.sort()
+	return build_time, times[len(times) // 2], times[int(len(times) * 0.99)], num_correct / num_queries
+
+# Check that a delta_decoder holds the same queue and notifications as the town it was sent. Returns a description of the first difference,
+# or None.
+def check_decoded(dec, t, notes):
+	if dec.order != [m.ID for m in t.player_queue]:
+		return "queue order"
+
+	for m in t.player_queue:
+		q = dec.queue[m.ID]
+		expected = (m.sender.get_address_line(), m.get_dest_line(), m.is_story or None, m.damage_lvl, m.repair_lvl, m.stamp, m.age, following_address(m))
+		if (q.sender, q.recipient, q.story, q.damage_lvl, q.repair_lvl, q.stamp, q.age, q.following) != expected:
+			return "letter " + m.get_details()
+
+	if dec.notes != [(notifier.get_address_line(), code, arg, count) for notifier, code, arg, count in notes]:
+		return "notifications"
+
+	return None
+
+# Stream the queues and notifications of num_players players over several days, with the delta protocol and as JSON. Every day, each player
+# gets an update, routes half of their queue, and gets another update. Every update is decoded and checked against the town.
+# Returns the number of updates, the bytes and encoding seconds of each format, and the decoding seconds of the delta protocol, or None
+# and a description if a decoded state differs.
+def bench_protocol(num_towns, num_players, num_mail, days=5, seed=BENCH_SEED):
+	pm = gen_world(num_towns, seed=seed)
+	players = pm.set_player_towns(num_players)
+	pm.gen_mail_batch(num_mail)
+
+	encoders = [delta_encoder() for t in players]
+	decoders = [delta_decoder() for t in players]
+
+	num_updates = 0
+	delta_bytes = 0
+	json_bytes = 0
+	delta_time = 0
+	decode_time = 0
+	json_time = 0
+	for day in range(days):
+		pm.simulate_day()
+		pm.phase.day += 1
+
+		for update in range(2):
+			for p_i in range(num_players):
+				t = players[p_i]
+				notes = list(t.notes)
+
+				start = time.perf_counter()
+				data = encode_json(t, pm.phase.day, pm.strings)
+				json_time += time.perf_counter() - start
+				json_bytes += len(data)
+
+				start = time.perf_counter()
+				data = encoders[p_i].encode(t, pm.phase.day)
+				delta_time += time.perf_counter() - start
+				delta_bytes += len(data)
+
+				start = time.perf_counter()
+				decoders[p_i].decode(data)
+				decode_time += time.perf_counter() - start
+
+				num_updates += 1
+				error = check_decoded(decoders[p_i], t, notes)
+				if error is not None:
+					return None, "day %d, player %d: %s" % (pm.phase.day, p_i, error)
+
+				# Route half of the queue, as a player would between updates.
+				if update == 0:
+					for m in t.player_queue[::2]:
+						m.following = pm.rng.choice(t.neighbors + [h for s in t.streets for h in s.houses])
+
+	return (num_updates, delta_bytes, delta_time, decode_time, json_bytes, json_time), None
+
+# Gets the commit the benchmark is run on, or None if it can't be found.
+def get_commit():
+	try:
+		return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Benchmark the mail simulation.")
+	parser.add_argument("num_towns", nargs="?", type=int, default=200)
+	parser.add_argument("num_mail", nargs="?", type=int, default=50000)
+	parser.add_argument("num_store_mail", nargs="?", type=int, default=1000000)
+	parser.add_argument("--seed", type=int, default=BENCH_SEED)
+	parser.add_argument("--json", help="also write the results to this file as JSON")
+	args = parser.parse_args()
+
+	num_towns = args.num_towns
+	num_mail = args.num_mail
+	seed = args.seed
+
+	# Every result is printed and kept as a named record for the JSON output.
+	results = []
+	def report(name, text, **values):
+		print(text)
+		results.append(dict(name=name, **values))
+
+	for gen_towns, gen_senders, elapsed in bench_gen_map((100, 1000, 10000), seed=seed):
+		report("gen_map", "World generation: %d towns, %d senders in %.3fs" % (gen_towns, gen_senders, elapsed), towns=gen_towns, senders=gen_senders, seconds=elapsed)
+
+	start = time.perf_counter()
+	pm = gen_world(num_towns, seed=seed)
+	elapsed = time.perf_counter() - start
+	report("gen_map", "World generation: %d towns, %d senders in %.3fs" % (len(pm.towns), len(pm.senders), elapsed), towns=len(pm.towns), senders=len(pm.senders), seconds=elapsed)
+
+	elapsed = bench_draw_map(pm)
+	report("draw_map", "Map drawing: %d towns in %.3fs" % (len(pm.towns), elapsed), towns=len(pm.towns), seconds=elapsed)
+
+	backends = {}
+	for name, cls in (("table", routing_table), ("tree", routing_tree)):
+		backends[name], elapsed, size = build_backend(cls, pm.towns)
+		report("routing_build", "Routing %s build: %.3fs, %.1fMB" % (name, elapsed, size / 1e6), backend=name, towns=len(pm.towns), seconds=elapsed, bytes=size)
+
+	num_handled, times, agree = bench_routing(num_towns, num_mail, {"scan": scan_router, "table": routing_table, "tree": routing_tree}, seed=seed)
+	if not agree:
+		print("Routing mismatch between routers")
+	report("routing", "Handling %d letters per tick: neighbor scan %.1fms, table %.1fms, tree %.1fms" % (num_handled, times["scan"] * 1000, times["table"] * 1000, times["tree"] * 1000), letters=num_handled, seconds=times)
+
+	gen_post(pm, num_mail)
+
+	num_letters = len(pm.post)
+	elapsed = bench_tick_objects(pm)
+	report("tick_objects", "Object tick: %d letters in %.3fs (%.0f letters/s)" % (num_letters, elapsed, num_letters / elapsed), letters=num_letters, seconds=elapsed)
+
+	for volume, seconds, rate in bench_tick_days(num_towns, (num_mail // 10, num_mail, num_mail * 4), seed=seed):
+		report("tick_day", "Simulated day: %d letters generated, %.3fs per day (%.0f letters/s)" % (volume, seconds, rate), volume=volume, seconds=seconds, letters_per_second=rate)
+
+	store_results = bench_tick_store(pm, args.num_store_mail, seed=seed)
+	if store_results is None:
+		print("Columnar tick: skipped, numpy is not installed")
+	else:
+		for num_letters, elapsed in store_results:
+			report("tick_store", "Columnar tick: %d letters in %.3fs (%.0f letters/s)" % (num_letters, elapsed, num_letters / elapsed), letters=num_letters, seconds=elapsed)
+
+		num_shards = max(2, os.cpu_count() or 1)
+		for num_letters, elapsed in bench_tick_store(pm, args.num_store_mail, seed=seed, num_shards=num_shards):
+			report("tick_shards", "Sharded columnar tick, %d shards: %d letters in %.3fs (%.0f letters/s)" % (num_shards, num_letters, elapsed, num_letters / elapsed), shards=num_shards, letters=num_letters, seconds=elapsed)
+
+	per_dict, per_object, per_row = bench_memory(pm, 20000)
+	report("memory", "Memory per live letter: %.0f bytes as dict-based mail objects, %.0f bytes as mail objects" % (per_dict, per_object) + ("" if per_row is None else ", %.0f bytes in the columnar store" % per_row), dict_object_bytes=per_dict, object_bytes=per_object, row_bytes=per_row)
+
+	draw_results = bench_draw_mail(pm, args.num_store_mail, seed=seed)
+	if draw_results is None:
+		print("Map mail overlay: skipped, numpy is not installed")
+	else:
+		num_letters, base_time, count_time, draw_time = draw_results
+		report("draw_mail", "Map mail overlay: %d letters, base layer %.3fs, counting %.1fms, drawing with counts %.1fms" % (num_letters, base_time, count_time * 1000, draw_time * 1000), letters=num_letters, base_seconds=base_time, count_seconds=count_time, draw_seconds=draw_time)
+
+	(single, single_local, single_replies), (batch, batch_local, batch_replies) = bench_gen_mail(num_towns, num_mail, seed)
+	report("gen_mail", "Mail generation of %d letters: gen_mail %.3fs (%.1f%% local, %.1f%% replies), gen_mail_batch %.3fs (%.1f%% local, %.1f%% replies)" % (num_mail, single, single_local * 100, single_replies * 100, batch, batch_local * 100, batch_replies * 100), letters=num_mail, single_seconds=single, single_local=single_local, single_replies=single_replies, batch_seconds=batch, batch_local=batch_local, batch_replies=batch_replies)
+
+	snap_towns, gen_time, save_time, load_time, size = bench_snapshot(10000, num_mail, seed=seed)
+	report("snapshot", "Snapshot of %d towns and %d letters: generation %.3fs, save %.3fs, load %.3fs, %.1fMB" % (snap_towns, num_mail, gen_time, save_time, load_time, size / 1e6), towns=snap_towns, letters=num_mail, gen_seconds=gen_time, save_seconds=save_time, load_seconds=load_time, bytes=size)
+
+	big = gen_world(1500, 4, "tree", seed)
+	build_time, median, p99, accuracy = bench_addresses(big, seed=seed)
+	report("addresses", "Address resolution over %d senders: index built in %.3fs, median %.3fms, p99 %.3fms, %.1f%% resolved to the right sender" % (len(big.senders), build_time, median * 1000, p99 * 1000, accuracy * 100), senders=len(big.senders), build_seconds=build_time, median_seconds=median, p99_seconds=p99, accuracy=accuracy)
+
+	num_requests, num_found, num_days, routed_time, scan_time = bench_recovery(big, 10000)
+	report("recovery", "Recovery requests over %d towns: %d requests, %d found in %d days, forwarded %.3fs, searching every bin %.3fs" % (len(big.towns), num_requests, num_found, num_days, routed_time, scan_time), towns=len(big.towns), requests=num_requests, found=num_found, days=num_days, routed_seconds=routed_time, scan_seconds=scan_time)
+
+	num_notes, ((agg_entries, agg_notify, agg_drain), (sep_entries, sep_notify, sep_drain)) = bench_notes(num_towns, num_mail, seed=seed)
+	report("notes", "Notifications of %d letters: %d notifications, aggregated into %d entries (advance %.3fs, drain %.3fs), separately %d entries (advance %.3fs, drain %.3fs)" % (num_mail, num_notes, agg_entries, agg_notify, agg_drain, sep_entries, sep_notify, sep_drain), letters=num_mail, notifications=num_notes, aggregated_entries=agg_entries, aggregated_seconds=agg_notify, aggregated_drain_seconds=agg_drain, separate_entries=sep_entries, separate_seconds=sep_notify, separate_drain_seconds=sep_drain)
+
+	move_results = bench_moves(big, args.num_store_mail, 2000, seed=seed)
+	if move_results is None:
+		print("Sender moves: skipped, numpy is not installed")
+	else:
+		num_letters, num_moves, move_time, num_forwarded, before_time, after_time = move_results
+		report("moves", "Sender moves over %d letters: %d moves in %.3fs, %d letters forwarded, handle pass %.3fs before the moves and %.3fs after" % (num_letters, num_moves, move_time, num_forwarded, before_time, after_time), letters=num_letters, moves=num_moves, move_seconds=move_time, forwarded=num_forwarded, before_seconds=before_time, after_seconds=after_time)
+
+	protocol_results, error = bench_protocol(num_towns, 8, num_mail, seed=seed)
+	if protocol_results is None:
+		print("Delta protocol mismatch: " + error)
+	else:
+		num_updates, delta_bytes, delta_time, decode_time, json_bytes, json_time = protocol_results
+		report("protocol", "Queue updates for 8 players: %d updates, delta %.0f bytes per update in %.1fus (decode %.1fus), JSON %.0f bytes in %.1fus" % (num_updates, delta_bytes / num_updates, delta_time / num_updates * 1e6, decode_time / num_updates * 1e6, json_bytes / num_updates, json_time / num_updates * 1e6), updates=num_updates, delta_bytes=delta_bytes, delta_seconds=delta_time, decode_seconds=decode_time, json_bytes=json_bytes, json_seconds=json_time)
+
+	if args.json is not None:
+		fout = open(args.json, "w")
+		json.dump({"commit": get_commit(), "seed": seed, "args": vars(args), "results": results}, fout, indent=1)
+		fout.close()
@@ -0,0 +1,159 @@
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+
+from server import read_frame, write_frame
+from protocol import delta_decoder
+from postman_classes import load_json
+from notices import render_note
+
+# This file implements clients for the multiplayer server (see server.py for the protocol).
+# Usage:
+#   python client.py [--host HOST] [--port PORT]
+#       Play interactively: commands are read from stdin and the server's responses printed.
+#   python client.py --load N [--days D] [--think SECONDS] [--delta]
+#       Load generator: N bots connect at once and play D days each. Every day, each bot reads its queue, routes every letter to a random
+#       neighboring town or house, and ends the day, waiting a random time of up to SECONDS between commands. Prints the latency of the
+#       commands and the length of each day. With --delta, bots read their queue through the delta protocol instead of "gam", and the
+#       bytes received for it are printed too.
+
+# Send a command and return the server's response.
+async def request(reader, writer, command):
+	write_frame(writer, command.encode("utf-8"))
+	await writer.drain()
+	return await read_response(reader)
+
+async def read_response(reader):
+	frame = await read_frame(reader)
+	if frame is None:
+		raise ConnectionError("The server closed the connection.")
+
+	return json.loads(frame.decode("utf-8"))
+
+# Request an update of the delta protocol and apply it to decoder. Returns the size of the update.
+async def request_update(reader, writer, decoder):
+	write_frame(writer, b"upd")
+	await writer.drain()
+
+	frame = await read_frame(reader)
+	if frame is None:
+		raise ConnectionError("The server closed the connection.")
+	if frame[:1] != b"\x00":
+		raise ConnectionError(json.loads(frame.decode("utf-8"))["output"])
+
+	decoder.decode(memoryview(frame)[1:])
+	return len(frame)
+
+async def interactive(host, port):
+	reader, writer = await asyncio.open_connection(host, port)
+	loop = asyncio.get_running_loop()
+	decoder = delta_decoder()
+	strings = load_json("localization/" + load_json("settings.json").language + ".json")
+
+	res = await read_response(reader)
+	print(res["output"])
+	if not res["ok"]:
+		return
+
+	while True:
+		line = await loop.run_in_executor(None, sys.stdin.readline)
+		if line == "":
+			break
+
+		# Updates are shown as the queue and notifications they leave the client with.
+		if line.strip().lower() == "upd":
+			await request_update(reader, writer, decoder)
+			for i, ID in enumerate(decoder.order):
+				print("%d: %s" % (i, decoder.queue[ID].get_details()))
+			for notifier, code, arg, count in decoder.notes:
+				print("%s: %s" % (notifier, render_note(strings, code, arg, count)))
+			continue
+
+		res = await request(reader, writer, line.strip())
+		print(res["output"])
+
+	writer.close()
+
+# Play num_days days as a bot, recording the latency of every command in latencies. Returns the day the bot ended on.
+# If sizes is given, the queue is read through the delta protocol, and the size of every queue response is appended to sizes.
+async def bot(host, port, num_days, think, latencies, rng, sizes=None):
+	reader, writer = await asyncio.open_connection(host, port)
+
+	res = await read_response(reader)
+	if not res["ok"]:
+		writer.close()
+		raise ConnectionError(res["output"])
+
+	decoder = delta_decoder()
+
+	async def timed(command):
+		await asyncio.sleep(rng.uniform(0, think))
+		start = time.perf_counter()
+		if command == "upd":
+			res = await request_update(reader, writer, decoder)
+		else:
+			res = await request(reader, writer, command)
+		latencies.append(time.perf_counter() - start)
+		return res
+
+	# Everywhere mail can be routed to, recovery included.
+	routables = (await timed("grs"))["output"].split("\n")
+
+	day = 0
+	for d in range(num_days):
+		if sizes is None:
+			res = await timed("gam")
+			num_mail = sum(1 for l in res["output"].split("\n") if l[:1].isdigit())
+		else:
+			sizes.append(await timed("upd"))
+			num_mail = len(decoder.order)
+
+		for m_i in range(num_mail):
+			await timed("rte %d %s" % (m_i, rng.choice(routables)))
+
+		res = await timed("end")
+		day = res["day"]
+
+	writer.close()
+	return day
+
+async def load(host, port, num_bots, num_days, think, seed, delta=False):
+	rng = random.Random(seed)
+	latencies = []
+	sizes = [] if delta else None
+
+	start = time.perf_counter()
+	results = await asyncio.gather(*[bot(host, port, num_days, think, latencies, random.Random(rng.getrandbits(64)), sizes) for i in range(num_bots)], return_exceptions=True)
+	elapsed = time.perf_counter() - start
+
+	errors = [r for r in results if isinstance(r, Exception)]
+	for e in errors[:5]:
+		print("Bot failed: " + str(e))
+
+	latencies.sort()
+	if len(latencies) == 0:
+		return
+
+	print("%d bots (%d failed), %d days in %.3fs (%.3fs per day)" % (num_bots, len(errors), num_days, elapsed, elapsed / num_days))
+	print("%d commands: mean latency %.2fms, p50 %.2fms, p99 %.2fms, max %.2fms" % (len(latencies), sum(latencies) / len(latencies) * 1000, latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000, latencies[-1] * 1000))
+	if delta and len(sizes) > 0:
+		print("%d queue updates: %d bytes, %.1f bytes per update" % (len(sizes), sum(sizes), sum(sizes) / len(sizes)))
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Postman multiplayer client.")
+	parser.add_argument("--host", default="127.0.0.1")
+	parser.add_argument("--port", type=int, default=7070)
+	parser.add_argument("--load", type=int, metavar="N", help="run N bots instead of playing interactively")
+	parser.add_argument("--days", type=int, default=3, help="number of days each bot plays")
+	parser.add_argument("--think", type=float, default=0.0, help="longest time a bot waits between commands, in seconds")
+	parser.add_argument("--seed", type=int, help="seed for the bots' choices")
+	parser.add_argument("--delta", action="store_true", help="have the bots read their queue through the delta protocol")
+	args = parser.parse_args()
+
+	if args.load is not None:
+		asyncio.run(load(args.host, args.port, args.load, args.days, args.think, args.seed, args.delta))
+	else:
+		asyncio.run(interactive(args.host, args.port))
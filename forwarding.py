@@ -0,0 +1,72 @@
+from collections import deque
+
+# This file implements sender moves: the houses senders can move into, and the mail forwarding orders they leave behind.
+#
+# Mail is addressed to the house its recipient lived in when it was sent, and keeps that address however often the recipient moves. When
+# a letter reaches the town it is addressed to and its recipient no longer lives there, the post office looks up the recipient's forwarding
+# order for that house, once, and readdresses the letter to the new house. Moving a sender only touches the sender and the table, never the
+# letters addressed to them.
+
+# Every mail forwarding order in a world, keyed by (sender, old house). Every postman has one in postman.forwarding.
+class forwarding_table:
+	def __init__(self):
+		# [new house, day the order expires] by (sender, old house).
+		self.orders = {}
+
+		# (key, order) in the order orders were placed, for expiry. Every order lasts the same number of days, so this is also the order
+		# they expire in. Orders replaced by a later move from the same house are left here until they expire.
+		self.placed = deque()
+
+	def __len__(self):
+		return len(self.orders)
+
+	# Have mail to the sender at old_house forwarded to new_house until the given day.
+	def add(self, s, old_house, new_house, expires):
+		key = (s, old_house)
+		order = [new_house, expires]
+		self.orders[key] = order
+		self.placed.append((key, order))
+
+	# Gets the house mail to the sender at old_house should be forwarded to, or None if the sender left no order there.
+	def get(self, s, old_house):
+		order = self.orders.get((s, old_house))
+		if order is None:
+			return None
+
+		return order[0]
+
+	# Drop every order that expires on or before the given day.
+	def evict(self, day):
+		while len(self.placed) > 0 and self.placed[0][1][1] <= day:
+			key, order = self.placed.popleft()
+			if self.orders.get(key) is order:
+				del self.orders[key]
+
+	# Gets every (sender, old house, new house, expires) still in the table, in the order they were placed.
+	def items(self):
+		return [(key[0], key[1], order[0], order[1]) for key, order in self.placed if self.orders.get(key) is order]
+
+# Houses nobody lives in, which senders can move into. Kept in a list, so that one can be picked at random in constant time.
+class vacancy_list:
+	def __init__(self):
+		self.houses = []
+		self.index = {}
+
+	def __len__(self):
+		return len(self.houses)
+
+	def add(self, h):
+		if h not in self.index:
+			self.index[h] = len(self.houses)
+			self.houses.append(h)
+
+	# Remove a house by moving the last house into its place.
+	def remove(self, h):
+		i = self.index.pop(h)
+		last = self.houses.pop()
+		if last is not h:
+			self.houses[i] = last
+			self.index[last] = i
+
+	def get(self, i):
+		return self.houses[i]
@@ -0,0 +1,81 @@
+import cProfile
+import json
+import time
+from contextlib import contextmanager, nullcontext
+
+# This file implements the instrumentation of the simulation loop: how long each phase of a day takes, counters of what happened during the
+# day, and optional profiling of one day. Every postman has one in postman.stats. It is disabled by default, in which case timing a phase
+# costs one attribute check and counting costs one function call.
+
+# Shared by every phase timed while instrumentation is disabled.
+NO_PHASE = nullcontext()
+
+class day_stats:
+	# If out is given, the statistics of each day are appended to it as one line of JSON.
+	# If profile_day is given, that day is run under cProfile and the profile is written to profile_fn.
+	def __init__(self, enabled=False, out=None, profile_day=None, profile_fn=None):
+		self.enabled = enabled
+		self.out = out
+		self.profile_day = profile_day
+		self.profile_fn = profile_fn if profile_fn is not None else "day_%d.prof" % (profile_day if profile_day is not None else 0)
+
+		self.day = 0
+		self.start = None
+		self.times = {}
+		self.counts = {}
+		self.profiler = None
+
+	# Start collecting statistics for the given day.
+	def begin_day(self, day):
+		if not self.enabled:
+			return
+
+		self.day = day
+		self.times = {}
+		self.counts = {}
+
+		if day == self.profile_day:
+			self.profiler = cProfile.Profile()
+			self.profiler.enable()
+
+		self.start = time.perf_counter()
+
+	# Time a phase of the day. Time spent in phases with the same name adds up.
+	def phase(self, name):
+		if not self.enabled:
+			return NO_PHASE
+
+		return self.timer(name)
+
+	@contextmanager
+	def timer(self, name):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.times[name] = self.times.get(name, 0) + time.perf_counter() - start
+
+	# Add n to the named counter.
+	def count(self, name, n=1):
+		if self.enabled:
+			self.counts[name] = self.counts.get(name, 0) + n
+
+	# Finish the day's statistics, write them out, and return them as a dict. Returns None if disabled.
+	def end_day(self):
+		if not self.enabled:
+			return None
+
+		record = {"day": self.day, "seconds": time.perf_counter() - self.start, "phases": self.times, "counts": self.counts}
+
+		if self.profiler is not None:
+			self.profiler.disable()
+			self.profiler.dump_stats(self.profile_fn)
+			self.profiler = None
+			record["profile"] = self.profile_fn
+
+		if self.out is not None:
+			fout = open(self.out, "a")
+			fout.write(json.dumps(record) + "\n")
+			fout.close()
+
+		return record
@@ -1,138 +1,211 @@
-
+from snapshot import *
 
 # This file implements the interface between the server (simulation) and client (player interface)
+# Each client controls one post office. addr is the address of a remote client, or None for the local player. Output is passed to out, one
+# message at a time.
 class pm_cli:
-	def __init__(self, pm, addr):
+	def __init__(self, pm, addr, player_town=None, out=print):
 		self.pm = pm
-		self.player_town = pm.towns[0]
-	
-	# Handle player input on a loop. This should be called in a seperate thread. Thread locks are used to prevent race conditions.
-	# If use_gui, load and handle input via the gui interface. Otherwise, use the command line interface
-	def mainloop(self, use_gui):
+		self.addr = addr
+		self.player_town = pm.towns[0] if player_town is None else player_town
+		self.out = out
+		
 		# Create data structure to contain the boxes the player can put mail in.
-		boxes = {}
+		self.boxes = {}
 		
 		# Allow player to place mail in recovery.
-		boxes["recovery"] = []
+		self.boxes["recovery"] = []
 		
 		# Allow player to route mail to adjacent towns.
 		for n in self.player_town.neighbors:
-			boxes[str(n.zip_code)] = []
+			self.boxes[str(n.zip_code)] = []
 		
 		# Allow player to route mail to each house in their town.
 		for s in self.player_town.streets:
 			for h in s.houses:
-				boxes[(str(h.number) + " " + s.name).lower()] = []
+				self.boxes[(str(h.number) + " " + s.name).lower()] = []
 		
 		# Create map for converting names to objects in memory.
-		get_place_by_name = {}
-		get_place_by_name["recovery"] = "recovery"
+		self.get_place_by_name = {}
+		self.get_place_by_name["recovery"] = "recovery"
 		
 		for n in self.player_town.neighbors:
-			get_place_by_name[str(n.zip_code)] = n
+			self.get_place_by_name[str(n.zip_code)] = n
 			
 		for s in self.player_town.streets:
 			for h in s.houses:
-				get_place_by_name[(str(h.number) + " " + s.name).lower()] = h
+				self.get_place_by_name[(str(h.number) + " " + s.name).lower()] = h
+	
+	# Gets the name of the routable location a misspelled one most likely refers to, or None. Houses are looked for in the player's town.
+	def suggest_routable(self, name):
+		if name.isdigit():
+			place = self.pm.addresses.resolve_place(name)
+		else:
+			place = self.pm.addresses.resolve_place(name + ", " + self.player_town.get_address_line())
+		
+		for key in self.get_place_by_name:
+			if self.get_place_by_name[key] is place:
+				return key
 		
+		return None
+	
+	# Handle player input on a loop. This should be called in a seperate thread. The day phase lock is held while commands run to prevent race conditions.
+	# If use_gui, load and handle input via the gui interface. Otherwise, use the command line interface
+	def mainloop(self, use_gui):
 		# Begin checking for player input
 		if use_gui:
 			print("GUI not yet implemented.")
 			exit()
 		else:
+			day = 0
 			while True:
-				# Wait for the server to stop simulating
-				while self.pm.is_simulating:
-					pass
+				# Wait for the server to finish simulating the next day
+				day = self.pm.phase.wait_for_day(day)
 				
 				# Display notifications.
-				print("Notifications from yesterday:")
-				while len(self.player_town.notes) != 0:
-					print(self.player_town.notes[0][0].get_address().replace("\n", " ") + ": " + self.player_town.notes[0][1])
-					del self.player_town.notes[0]
+				with self.pm.phase.lock:
+					self.run_command(["notes"])
 				
-				# Take input on a loop.
+				# Take input on a loop until the player ends the day.
 				while True:
 					inp = input("> ").lower().split(" ")
 					
-					# Help page
-					if inp[0] == "help" or inp[0] == "?":
-						if len(inp) < 2:
-							print("Display this help page or the help page for a specific command:\n(help | h | ?) [<command>]\n")
-							print("Get all mail in brief:\n(get_all_mail | gam)\n")
-							print("Get details of a mail item by its position in your queue:\n(get_mail_item | gmi) <position>\n")
-							print("Get locations mail can be routed to:\n(get_routables | grs)\n")
-							print("Repair Mail:\n(repair | rpr) <position>\n")
-							print("Route mail:\n(route | rte) <mail_position> <destination>\n")
-							print("End the day:\n(end_day | end)\n")
-					
-					# Get all mail in the player's queue
-					elif inp[0] == "get_all_mail" or inp[0] == "gam":
-						for m_i in range(len(self.player_town.player_queue)):
-							m = self.player_town.player_queue[m_i]
-							print(str(m_i) + ", " + ("Unrouted" if m.act.following is None else "  Routed") + ": " + m.get_details())
-					
-					# Get the details of a mail item
-					elif inp[0] == "get_mail_item" or inp[0] == "gmi":
-						if len(inp) < 2:
-							print("invalid command")
-							continue
-						try:
-							m_i = int(inp[1])
-						except ValueError:
-							print("invalid command")
-							continue
-						
-						m = self.player_town.player_queue[m_i]
-						print(str(m_i) + ": " + m.srce.replace("\n", ", ") + " -> " + m.dest.replace("\n", ", "))
-						print("damage: " + str(m.damage_lvl) + ", repair: " + str(m.repair_lvl) + ", postage: " + str(m.stamp))
-						print("Mail's previous location: " + m.previous.get_address().replace("\n", ", "))
-						print("Mail's next location: " + ("Not yet specified" if m.act.following is None else m.act.following.get_address().replace("\n", ", ")))
-					
-					# List all available locations that can be routed to
-					elif inp[0] == "get_routables" or inp[0] == "grs":
-						print("recovery")
-						for n in self.player_town.neighbors:
-							print(n.zip_code)
-						for s in self.player_town.streets:
-							for h in s.houses:
-								print(str(h.number) + " " + s.name)
-					
-					# Repair mail
-					elif inp[0] == "repair" or inp[0] == "rpr":
-						if len(inp) < 2:
-							print("Invalid command, not enough arguments.")
-							continue
-							
-						try:
-							inp[1] = int(inp[1])
-						except ValueError:
-							print("Invlid command, first parameter should be a number.")
-						
-						self.player_town.player_queue[inp[1]].repair()
-					
-					# Route mail
-					elif inp[0] == "route" or inp[0] == "rte":
-						try:
-							inp[1] = int(inp[1])
-						except ValueError:
-							print("Invalid mail posiition. Must be a number.")
-							continue
-						
-						for i in range(3, len(inp)):
-							inp[2] = inp[2] + " " + inp[i]
-						
-						try:
-							# Put mail in the specified box
-							boxes[inp[2]].append(self.player_town.player_queue[inp[1]])
-							
-							# Set the mail item's next location
-							self.player_town.player_queue[inp[1]].act.following = get_place_by_name[inp[2]]
-						except KeyError:
-							print("Location " + inp[2] + " specified does not exist.")
-							continue
-					
-					# End the day.
-					elif inp[0] == "end_day" or inp[0] == "end":
-						self.pm.is_simulating = True
-						break
\ No newline at end of file
+					with self.pm.phase.lock:
+						if not self.run_command(inp):
+							break
+				
+				self.pm.phase.end_day(self)
+	
+	# Run a command given as a list of lowercase words. Returns False if the command ends the day.
+	def run_command(self, inp):
+		# Help page
+		if inp[0] == "help" or inp[0] == "?":
+			if len(inp) < 2:
+				self.out("Display this help page or the help page for a specific command:\n(help | h | ?) [<command>]\n")
+				self.out("Get notifications from yesterday:\n(get_notifications | notes)\n")
+				self.out("Get all mail in brief:\n(get_all_mail | gam)\n")
+				self.out("Get details of a mail item by its position in your queue:\n(get_mail_item | gmi) <position>\n")
+				self.out("Get locations mail can be routed to:\n(get_routables | grs)\n")
+				self.out("Repair Mail:\n(repair | rpr) <position>\n")
+				self.out("Route mail:\n(route | rte) <mail_position> <destination>\n")
+				self.out("List the mail in your recovery bin:\n(get_recovery | grc)\n")
+				self.out("Find the places and people matching a (possibly misspelled) address:\n(find | fnd) <address>\n")
+				self.out("Save the game to a snapshot file:\nsave <filename>\n")
+				self.out("End the day:\n(end_day | end)\n")
+		
+		# Get and clear the notifications from yesterday
+		elif inp[0] == "get_notifications" or inp[0] == "notes":
+			self.out("Notifications from yesterday:")
+			while len(self.player_town.notes) != 0:
+				notifier, text = self.player_town.pop_note()
+				self.out(notifier.get_address_line() + ": " + text)
+		
+		# Get all mail in the player's queue
+		elif inp[0] == "get_all_mail" or inp[0] == "gam":
+			for m_i in range(len(self.player_town.player_queue)):
+				m = self.player_town.player_queue[m_i]
+				self.out(str(m_i) + ", " + ("Unrouted" if m.following is None else "  Routed") + ": " + m.get_details())
+		
+		# Get the details of a mail item
+		elif inp[0] == "get_mail_item" or inp[0] == "gmi":
+			if len(inp) < 2:
+				self.out("invalid command")
+				return True
+			try:
+				m_i = int(inp[1])
+			except ValueError:
+				self.out("invalid command")
+				return True
+			
+			m = self.player_town.player_queue[m_i]
+			self.out(str(m_i) + ": " + m.sender.get_address_line() + " -> " + m.get_dest_line())
+			
+			# Mail to a recipient who moved is forwarded as they requested.
+			if m.addressed is not m.recipient.house:
+				new_house = self.pm.forwarding.get(m.recipient, m.addressed)
+				self.out("Forward to: " + ("No forwarding order" if new_house is None else new_house.get_address_line()))
+			self.out("damage: " + str(m.damage_lvl) + ", repair: " + str(m.repair_lvl) + ", postage: " + str(m.stamp))
+			self.out("Mail's previous location: " + m.previous.get_address_line())
+			self.out("Mail's next location: " + ("Not yet specified" if m.following is None else "recovery" if m.following == "recovery" else m.following.get_address_line()))
+		
+		# List all available locations that can be routed to
+		elif inp[0] == "get_routables" or inp[0] == "grs":
+			self.out("recovery")
+			for n in self.player_town.neighbors:
+				self.out(str(n.zip_code))
+			for s in self.player_town.streets:
+				for h in s.houses:
+					self.out(str(h.number) + " " + s.name)
+		
+		# Repair mail
+		elif inp[0] == "repair" or inp[0] == "rpr":
+			if len(inp) < 2:
+				self.out("Invalid command, not enough arguments.")
+				return True
+				
+			try:
+				inp[1] = int(inp[1])
+			except ValueError:
+				self.out("Invlid command, first parameter should be a number.")
+				return True
+			
+			self.player_town.player_queue[inp[1]].repair()
+		
+		# Route mail
+		elif inp[0] == "route" or inp[0] == "rte":
+			try:
+				inp[1] = int(inp[1])
+			except ValueError:
+				self.out("Invalid mail posiition. Must be a number.")
+				return True
+			
+			for i in range(3, len(inp)):
+				inp[2] = inp[2] + " " + inp[i]
+			
+			try:
+				# Put mail in the specified box
+				self.boxes[inp[2]].append(self.player_town.player_queue[inp[1]])
+				
+				# Set the mail item's next location
+				self.player_town.player_queue[inp[1]].following = self.get_place_by_name[inp[2]]
+			except KeyError:
+				self.out("Location " + inp[2] + " specified does not exist.")
+				
+				suggestion = self.suggest_routable(inp[2])
+				if suggestion is not None:
+					self.out("Did you mean " + suggestion + "?")
+				return True
+		
+		# List the recovery bin, oldest first
+		elif inp[0] == "get_recovery" or inp[0] == "grc":
+			self.out("Mail in recovery:")
+			for day, m in self.player_town.recovery.items():
+				self.out("Day " + str(day) + ": " + m.get_details())
+		
+		# Find addresses
+		elif inp[0] == "find" or inp[0] == "fnd":
+			if len(inp) < 2:
+				self.out("Invalid command, no address given.")
+				return True
+			
+			results = self.pm.addresses.resolve(" ".join(inp[1:]))
+			if len(results) == 0:
+				self.out("No matches.")
+			
+			for score, obj in results:
+				self.out("%.2f: %s" % (score, obj.get_address_line()))
+		
+		# Save the game
+		elif inp[0] == "save":
+			if len(inp) < 2:
+				self.out("Invalid command, no filename given.")
+				return True
+			
+			save_snapshot(self.pm, inp[1])
+			self.out("Saved to " + inp[1])
+		
+		# End the day.
+		elif inp[0] == "end_day" or inp[0] == "end":
+			return False
+		
+		return True
@@ -0,0 +1,567 @@
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+from postman_classes import *
+from routing import *
+
+# This file implements an optional structure-of-arrays store for automated mail. Instead of a mail object per letter, the store keeps one
+# NumPy column per field and runs the automated routers' daily handle and advance passes as vectorized operations over all letters at once.
+# Only mail that ends up in a player's queue is materialized as mail objects (see materialize and absorb).
+#
+# Towns and houses are referred to by place index: towns come first, in the order of pm.towns, followed by every house.
+# Senders are referred to by their index in pm.senders. Letters held by the store are not listed in their sender's in_transit.
+
+class mail_columns:
+	# The name and dtype of every column.
+	columns = (
+		("ID", "i4"),
+		("sender", "i4"),
+		("recipient", "i4"),
+		# Place index of the house the letter is addressed to, as mail.addressed.
+		("addressed", "i4"),
+		("previous", "i4"),
+		("current", "i4"),
+		("following", "i4"),
+		("damage_lvl", "i1"),
+		("repair_lvl", "i1"),
+		("stamp", "i1"),
+		("age", "i4"),
+		# Holds the same ACT_* flags as mail.act.
+		("act", "u1"),
+	)
+
+	def __init__(self, pm):
+		if np is None:
+			raise ImportError("The columnar mail store requires numpy.")
+
+		self.pm = pm
+		self.rng = np.random.default_rng(pm.rng.getrandbits(64))
+
+		# Number all places, towns first.
+		self.num_towns = len(pm.towns)
+		self.places = list(pm.towns)
+		for t in pm.towns:
+			for s in t.streets:
+				self.places.extend(s.houses)
+
+		self.place_index = {}
+		for i in range(len(self.places)):
+			self.place_index[self.places[i]] = i
+
+		# The town each place is in. Towns are in themselves.
+		self.place_town = np.arange(len(self.places), dtype="i4")
+		for i in range(self.num_towns, len(self.places)):
+			self.place_town[i] = self.place_index[self.places[i].street.town]
+
+		# Number all senders, and record where each of them lives.
+		self.sender_index = {}
+		self.sender_house = np.zeros(len(pm.senders), dtype="i4")
+		for i in range(len(pm.senders)):
+			self.sender_index[pm.senders[i]] = i
+			self.sender_house[i] = self.place_index[pm.senders[i].house]
+
+		self.sender_town = self.place_town[self.sender_house]
+
+		# The citizens of every town, as sender indices grouped by town. Town t's citizens are citizens[town_start[t]:town_start[t] + town_pop[t]].
+		# Set to None when a sender moves to another town, and rebuilt by index_citizens when next needed.
+		self.index_citizens()
+
+		# Every column is kept in an array with room for more rows, so that mail can be added without copying the columns. self.cols holds
+		# views of the first n rows. Set by resize.
+		self.n = 0
+		self.data = {}
+		for name, dtype in mail_columns.columns:
+			self.data[name] = np.zeros(0, dtype=dtype)
+
+		self.cols = {}
+		self.resize(0)
+
+		# Rows absorbed since the columns were last rebuilt, as tuples in column order.
+		self.pending = []
+
+		# Rows materialized since the columns were last rebuilt. They are dropped on the next flush.
+		self.removed = []
+
+		# Routes letters for handle. Rebuilt by get_router when the routing backend changes.
+		self.router = None
+
+		# Optional pool of worker processes that run handle for shards of the towns (see shards.py). If None, handle runs in this process.
+		self.shards = None
+
+	def index_citizens(self):
+		self.citizens = np.array([self.sender_index[c] for t in self.pm.towns for c in t.citizens], dtype="i4")
+		self.town_pop = np.array([len(t.citizens) for t in self.pm.towns], dtype="i4")
+		self.town_start = (np.cumsum(self.town_pop) - self.town_pop).astype("i4")
+
+	# Record that a sender moved into their current house. Called by sender.set_house. Letters are left as they are.
+	def move_sender(self, s):
+		i = self.sender_index[s]
+		self.sender_house[i] = self.place_index[s.house]
+		if self.sender_town[i] != self.place_town[self.sender_house[i]]:
+			self.sender_town[i] = self.place_town[self.sender_house[i]]
+			self.citizens = None
+
+	# Gets the number of letters in the store.
+	def __len__(self):
+		self.flush()
+		return self.n
+
+	# Make room for n rows, keeping the current ones. Room is doubled as needed, so adding mail costs amortized constant time per letter.
+	def reserve(self, n):
+		capacity = len(self.data["ID"])
+		if n <= capacity:
+			return
+
+		capacity = max(n, 2 * capacity, 1024)
+		if self.shards is not None:
+			self.data = self.shards.grow(self.data, self.n, capacity)
+		else:
+			data = {}
+			for name, dtype in mail_columns.columns:
+				data[name] = np.zeros(capacity, dtype=dtype)
+				data[name][:self.n] = self.data[name][:self.n]
+			self.data = data
+
+		self.resize(self.n)
+
+	# Set the number of rows. Rows past the current ones are left as they are in the arrays.
+	def resize(self, n):
+		self.reserve(n)
+		self.n = n
+		self.cols = {}
+		for name, dtype in mail_columns.columns:
+			self.cols[name] = self.data[name][:n]
+
+	# Add rows, given as a dict of arrays by column name, after the current ones.
+	def append(self, rows):
+		start = self.n
+		self.resize(start + len(rows["ID"]))
+		for name in self.cols:
+			self.cols[name][start:] = rows[name]
+
+	# Apply pending additions and removals to the columns.
+	def flush(self):
+		if len(self.removed) > 0:
+			keep = np.ones(self.n, dtype=bool)
+			keep[self.removed] = False
+			self.keep(keep)
+			self.removed = []
+
+		if len(self.pending) > 0:
+			rows = list(zip(*self.pending))
+			new = {}
+			for c in range(len(mail_columns.columns)):
+				name, dtype = mail_columns.columns[c]
+				new[name] = np.array(rows[c], dtype=dtype)
+
+			self.pending = []
+			self.append(new)
+
+	# Keep only the rows selected by the boolean mask. Their order is kept.
+	def keep(self, mask):
+		k = int(np.count_nonzero(mask))
+		for name in self.cols:
+			self.data[name][:k] = self.cols[name][mask]
+
+		if self.shards is not None:
+			self.shards.keep(mask)
+
+		self.resize(k)
+
+	# Add new mail from the senders to the recipients, given as arrays of sender indices. Postage and initial damage are rolled as in mail.__init__.
+	def add(self, senders, recipients):
+		self.flush()
+
+		senders = np.asarray(senders, dtype="i4")
+		recipients = np.asarray(recipients, dtype="i4")
+		n = len(senders)
+
+		# Mail IDs wrap around like postman.get_mail_ID
+		IDs = (self.pm.next_mail_ID + 1 + np.arange(n)) % 100000
+		if n > 0:
+			self.pm.next_mail_ID = int(IDs[-1])
+
+		# Mail has a random chance of not having due postage
+		is_local = self.sender_town[senders] == self.sender_town[recipients]
+		shortpays = self.rng.random(n) < self.pm.srv.prob_sender_shortpays
+		stamp = np.where(is_local, 1, 2)
+		stamp[shortpays] = np.where(~is_local[shortpays] & (self.rng.random(int(shortpays.sum())) < 0.5), 1, 0)
+
+		# Some mail randomly generates with 1 level of damage
+		damage_lvl = (self.rng.random(n) < self.pm.srv.prob_sender_damages_mail).astype("i1")
+
+		new = {
+			"ID": IDs,
+			"sender": senders,
+			"recipient": recipients,
+			"addressed": self.sender_house[recipients],
+			"previous": self.sender_house[senders],
+			"current": self.sender_town[senders],
+			"following": np.full(n, -1),
+			"damage_lvl": damage_lvl,
+			"repair_lvl": np.zeros(n),
+			"stamp": stamp,
+			"age": np.zeros(n),
+			"act": np.zeros(n),
+		}
+
+		self.append(new)
+
+	# Generate a piece of mail from each of the given senders, with recipients picked as in postman.build_mail_batch, and add it to the store.
+	def gen_mail(self, senders):
+		senders = np.asarray(senders, dtype="i4")
+		num_senders = len(self.pm.senders)
+		u_reply, u_local, u_pick = self.rng.random((3, len(senders)))
+
+		# Pick anyone but the sender...
+		recipients = (u_pick * (num_senders - 1)).astype("i4")
+		recipients[recipients == senders] = num_senders - 1
+
+		# ...unless writing to someone within the sender's town...
+		if self.citizens is None:
+			self.index_citizens()
+
+		towns = self.sender_town[senders]
+		local = (u_local < 0.6) & (self.town_pop[towns] > 1)
+		start = self.town_start[towns[local]]
+		pop = self.town_pop[towns[local]]
+		local_recipients = self.citizens[start + (u_pick[local] * (pop - 1)).astype("i4")]
+		is_sender = local_recipients == senders[local]
+		local_recipients[is_sender] = self.citizens[(start + pop - 1)[is_sender]]
+		recipients[local] = local_recipients
+
+		# ...or replying to someone mail was recently received from.
+		day = self.pm.phase.day
+		reply_window = self.pm.srv.reply_window
+		for i in np.flatnonzero(u_reply < 0.5):
+			recv_from = self.pm.senders[senders[i]].recv_from
+			if recv_from.recent(day, reply_window) > 0:
+				recipients[i] = recv_from.get(int(u_pick[i] * len(recv_from)))
+
+		self.add(senders, recipients)
+	
+	# Generate num pieces of mail from senders picked uniformly among everyone outside of the given town, and add them to the store.
+	def gen_mail_outside(self, num, excluded_town):
+		excluded = self.place_index[excluded_town]
+
+		senders = np.zeros(0, dtype="i4")
+		while len(senders) < num:
+			draw = self.rng.integers(0, len(self.pm.senders), num - len(senders))
+			senders = np.concatenate((senders, draw[self.sender_town[draw] != excluded]))
+
+		self.gen_mail(senders)
+	
+	# Move a piece of automated mail into the store, removing the mail object from the post.
+	def absorb(self, m):
+		self.pending.append((
+			m.ID,
+			self.sender_index[m.sender],
+			self.sender_index[m.recipient],
+			self.place_index[m.addressed],
+			self.place_index[m.previous],
+			self.place_index[m.current],
+			-1,
+			m.damage_lvl,
+			m.repair_lvl,
+			m.stamp,
+			m.age,
+			0,
+		))
+
+		del self.pm.post[m]
+		del m.sender.in_transit[m]
+		del m.current.post[m]
+
+	# Create a mail object for the given row and add it to the post. The row is removed from the store on the next flush.
+	def materialize(self, r):
+		c = self.cols
+		self.removed.append(r)
+
+		return mail.rebuild(
+			self.pm,
+			self.pm.senders[c["sender"][r]],
+			self.pm.senders[c["recipient"][r]],
+			self.places[c["addressed"][r]],
+			int(c["ID"][r]),
+			int(c["stamp"][r]),
+			int(c["damage_lvl"][r]),
+			int(c["repair_lvl"][r]),
+			self.places[c["previous"][r]],
+			self.places[c["current"][r]],
+			int(c["age"][r]),
+		)
+
+	# Gets the rows of all mail at the given town or house, in canonical order. If the rows are split among shards, only the place's shard is
+	# searched.
+	def rows_at(self, place):
+		self.flush()
+		i = self.place_index[place]
+		if self.shards is not None:
+			return self.canonical(self.shards.rows_at(i))
+
+		return self.canonical(np.flatnonzero(self.cols["current"] == i))
+
+	# Sort rows into an order that only depends on their letters, not on where the letters are in the columns, so that anything done to
+	# letters one at a time happens in the same order however the rows are grouped among shards. Identical rows are interchangeable.
+	def canonical(self, rows):
+		return rows[np.lexsort([self.cols[name][rows] for name, dtype in reversed(mail_columns.columns)])]
+
+	def get_age(self, r):
+		return int(self.cols["age"][r])
+
+	# Gets the router used by handle, building it if the routing backend changed since it was last built.
+	def get_router(self):
+		if self.router is None or self.router.routing is not self.pm.routing:
+			self.router = row_router(self)
+
+		return self.router
+
+	# Gets the neighboring town mail at towns cur should be forwarded to, to reach towns dest. Both are arrays of place indices.
+	def next_hops(self, cur, dest):
+		return self.get_router().next_hops(cur, dest)
+
+	# Set the following and act columns of every letter, as mail.handle does for each mail object. Delivered mail is removed from the store.
+	# Returns the number of letters delivered.
+	def handle(self):
+		self.forward()
+
+		# The routers' damage rolls are drawn from a seed for the day and each letter (see letter_rolls), so that they don't depend on the
+		# order of the rows.
+		seed = int(self.rng.integers(0, 2 ** 63))
+
+		router = self.get_router()
+		if self.shards is not None:
+			delivered, num_unrouted, num_errors, num_damaged = self.shards.handle(router, seed)
+		else:
+			delivered, num_unrouted, num_errors, num_damaged = router.handle(self.cols, self.sender_house, seed)
+
+		if num_unrouted > 0:
+			print("Could not route %d mail items." % num_unrouted)
+
+		self.pm.stats.count("routing_errors", num_errors)
+		self.pm.stats.count("damage_events", num_damaged)
+
+		# Recipients remember who wrote to them, as in mail.deliver. They are told in order of recipient and sender, which doesn't depend on
+		# the order of the rows.
+		c = self.cols
+		rows = np.flatnonzero(delivered)
+		sender_i = c["sender"][rows]
+		recipient_i = c["recipient"][rows]
+		order = np.lexsort((sender_i, recipient_i))
+
+		senders = self.pm.senders
+		day = self.pm.phase.day
+		for s_i, r_i in zip(sender_i[order].tolist(), recipient_i[order].tolist()):
+			senders[r_i].recv_from.add(s_i, day)
+
+		self.keep(~delivered)
+		return len(rows)
+
+	# Readdress the letters at the town they are addressed to whose recipient moved out, as mail.handle does, and file the letters whose
+	# recipient left no forwarding order in the town's recovery bin. Only the letters of recipients who moved are looked up.
+	def forward(self):
+		self.flush()
+		c = self.cols
+		addressed = c["addressed"]
+
+		rows = self.canonical(np.flatnonzero((c["current"] == self.place_town[addressed]) & (self.sender_house[c["recipient"]] != addressed)))
+		if len(rows) == 0:
+			return
+
+		num_forwarded = 0
+		for r in rows.tolist():
+			new_house = self.pm.forwarding.get(self.pm.senders[c["recipient"][r]], self.places[addressed[r]])
+			if new_house is None:
+				m = self.materialize(r)
+				m.current.file_recovery(m)
+			else:
+				addressed[r] = self.place_index[new_house]
+				num_forwarded += 1
+
+		self.pm.stats.count("forwarded", num_forwarded)
+		self.pm.stats.count("undeliverable", len(rows) - num_forwarded)
+		self.flush()
+
+	# Send notifications as counted by row_router.advance. Each (town, notifier) pair is sent once with its count, in increasing order.
+	def notify(self, notes):
+		num_places = len(self.places)
+		for code, keys, counts in notes:
+			for key, count in zip(keys.tolist(), counts.tolist()):
+				t, notifier = divmod(key, num_places)
+				self.places[t].notify(self.places[notifier], code, None, count)
+
+	# Move all mail towards its destination and send notifications, as mail.advance does for each mail object.
+	def advance(self):
+		self.flush()
+		if self.shards is not None:
+			self.notify(self.shards.advance())
+		else:
+			self.notify(self.get_router().advance(self.cols))
+
+# Draw a random number in [0, 1) for each letter from a seed and the letter's ID, sender and recipient, which are hashed together with the
+# finalizer of splitmix64. The numbers only depend on the letters, not on the order of the rows.
+def letter_rolls(seed, IDs, senders, recipients):
+	with np.errstate(over="ignore"):
+		z = np.uint64(seed) + IDs.astype("u8") * np.uint64(0x9e3779b97f4a7c15) + senders.astype("u8") * np.uint64(0xc2b2ae3d27d4eb4f) + recipients.astype("u8") * np.uint64(0x165667b19e3779f9)
+		z = (z ^ (z >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+		z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+		z ^= z >> np.uint64(31)
+
+	return (z >> np.uint64(11)) * (1.0 / (1 << 53))
+
+# The per-letter part of the automated routers' handle pass, over arrays of letters. It copies the lookup tables it needs from the store and
+# holds no reference to the postman, so that it can be sent to worker processes.
+class row_router:
+	def __init__(self, st):
+		rt = st.pm.routing
+		self.routing = rt
+
+		self.num_towns = st.num_towns
+		self.num_places = len(st.places)
+		self.place_town = st.place_town
+		self.prob_router_damages_mail = st.pm.srv.prob_router_damages_mail
+
+		if type(rt) is routing_tree:
+			# Translate between place indices and the tree's town indices.
+			self.to_rt = np.array([rt.index[t.zip_code] for t in st.pm.towns], dtype="i4")
+			self.from_rt = np.zeros(self.num_towns, dtype="i4")
+			self.from_rt[self.to_rt] = np.arange(self.num_towns, dtype="i4")
+
+			self.up = np.array([list(a) for a in rt.up], dtype="i4").reshape(len(rt.up), self.num_towns)
+			self.depth = np.array(rt.depth, dtype="i4")
+			self.hop_matrix = None
+		else:
+			# Dense next-hop matrix indexed by place index. -1 if there is no route.
+			self.hop_matrix = np.full((self.num_towns, self.num_towns), -1, dtype="i4")
+			for t in st.pm.towns:
+				for d in st.pm.towns:
+					n = rt.next_hop(t.zip_code, d.zip_code)
+					if n is not None:
+						self.hop_matrix[st.place_index[t], st.place_index[d]] = st.place_index[n]
+			self.up = None
+
+	# The routing backend isn't needed once the arrays are built, and can't be sent to other processes cheaply.
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state["routing"] = None
+		return state
+
+	# Gets the neighboring town mail at towns cur should be forwarded to, to reach towns dest. Both are arrays of place indices.
+	def next_hops(self, cur, dest):
+		if self.up is None:
+			return self.hop_matrix[cur, dest]
+
+		u = self.to_rt[cur]
+		v = self.to_rt[dest]
+
+		# Go down towards the destination if the current town is its ancestor, otherwise go up towards the root. See routing_tree.next_hop.
+		k = self.depth[v] - self.depth[u] - 1
+		w = v.copy()
+		for i in range(len(self.up)):
+			jump = (k >= 0) & (((k >> i) & 1) == 1)
+			w[jump] = self.up[i][w[jump]]
+
+		down = (k >= 0) & (self.up[0][w] == u)
+		hop = self.from_rt[np.where(down, w, self.up[0][u])]
+		hop[u == v] = -1
+
+		return hop
+
+	# Decide what the routers do with each letter, as mail.handle does. addressed is the house each letter is addressed to, and
+	# recipient_house the house its recipient lives in, which differ for letters to be forwarded. rolls holds one random number in [0, 1) per
+	# letter for the router's chance to damage it. Returns the new following, act and damage_lvl columns, and which letters were delivered.
+	# Letters that can't be routed get a following of -1.
+	def route(self, cur, previous, addressed, recipient_house, damage_lvl, repair_lvl, rolls):
+		n = len(cur)
+		act = np.zeros(n, dtype="u1")
+		following = np.full(n, -1, dtype="i4")
+
+		damaged = damage_lvl > repair_lvl
+		at_house = cur >= self.num_towns
+		at_town = ~at_house
+
+		dest_town = self.place_town[addressed]
+
+		# Houses notify of damaged mail, send mail at the wrong house to the post office, and accept the rest. Only mail at a house it isn't
+		# addressed to was delivered in error; mail whose recipient moved out is forwarded by the post office.
+		act[at_house & damaged] |= ACT_DELIVERED_DAMAGED
+
+		wrong_house = at_house & (cur != recipient_house)
+		following[wrong_house] = self.place_town[cur[wrong_house]]
+		act[wrong_house & (cur != addressed)] |= ACT_DELIVERY_ERROR
+
+		delivered = at_house & ~wrong_house
+
+		# Routers notify senders of damaged mail, and have a small chance of damaging mail themselves.
+		act[at_town & damaged] |= ACT_ROUTED_DAMAGED
+
+		router_damages = at_town & (rolls < self.prob_router_damages_mail)
+		damage_lvl = damage_lvl.copy()
+		damage_lvl[router_damages] = np.minimum(damage_lvl[router_damages] + 1, 3)
+
+		# Mail in the town of the destination goes to the correct home. Otherwise, it is routed towards its destination.
+		is_local = at_town & (cur == dest_town)
+		following[is_local] = addressed[is_local]
+
+		remote = at_town & ~is_local
+		following[remote] = self.next_hops(cur[remote], dest_town[remote])
+		act[remote & (following == previous)] |= ACT_ROUTING_ERROR
+
+		return following, act, damage_lvl, delivered
+
+	# Route the letters in the columns c, a dict of arrays by column name, as mail.handle does, and write their following, act and
+	# damage_lvl columns in place. Letters that can't be routed stay where they are. seed is the seed of the day's damage rolls.
+	# Returns which letters were delivered, and the number of letters that couldn't be routed, that were routed in error and that were damaged.
+	def handle(self, c, sender_house, seed):
+		rolls = letter_rolls(seed, c["ID"], c["sender"], c["recipient"])
+
+		# Routers get where each recipient lives now with the letters, so that they don't have to be rebuilt when senders move.
+		following, act, damage_lvl, delivered = self.route(c["current"], c["previous"], c["addressed"], sender_house[c["recipient"]], c["damage_lvl"], c["repair_lvl"], rolls)
+
+		unrouted = ~delivered & (following < 0)
+		following[unrouted] = c["current"][unrouted]
+		num_damaged = int(np.count_nonzero(damage_lvl != c["damage_lvl"]))
+
+		c["following"][:] = following
+		c["act"][:] = act
+		c["damage_lvl"][:] = damage_lvl
+
+		return delivered, int(np.count_nonzero(unrouted)), int(np.count_nonzero(act & ACT_ROUTING_ERROR)), num_damaged
+
+	# Count the notifications sent from each of the notifiers to the town of the same row. Returns the (town, notifier) pairs, as
+	# town * number of places + notifier in increasing order, and the number of notifications for each.
+	def count_notes(self, towns, notifiers):
+		return np.unique(towns.astype("i8") * self.num_places + notifiers, return_counts=True)
+
+	# Move the letters in the columns c towards their destination, in place, as mail.advance does. Returns the notifications to send, as a
+	# list of (code, pairs, counts) as returned by count_notes.
+	def advance(self, c):
+		cur = c["current"]
+		act = c["act"]
+		notes = []
+
+		# Houses ignore notifications, so only notify towns.
+		rows = np.flatnonzero(act & ACT_DELIVERY_ERROR)
+		notes.append((NOTE_INCORRECT_RESIDENCE,) + self.count_notes(self.place_town[cur[rows]], cur[rows]))
+
+		rows = np.flatnonzero((act & ACT_ROUTING_ERROR) & (c["following"] < self.num_towns))
+		notes.append((NOTE_ROUTED_IN_ERROR,) + self.count_notes(c["following"][rows], cur[rows]))
+
+		rows = np.flatnonzero((act & ACT_DELIVERED_DAMAGED) & (c["previous"] < self.num_towns))
+		notes.append((NOTE_DELIVERED_DAMAGED,) + self.count_notes(c["previous"][rows], cur[rows]))
+
+		routed_damaged = (act & ACT_ROUTED_DAMAGED) != 0
+		rows = np.flatnonzero(routed_damaged & (c["previous"] < self.num_towns))
+		notes.append((NOTE_ROUTED_DAMAGED,) + self.count_notes(c["previous"][rows], cur[rows]))
+
+		c["repair_lvl"][routed_damaged] = np.minimum(c["repair_lvl"][routed_damaged] + 1, c["damage_lvl"][routed_damaged])
+
+		c["previous"][:] = cur
+		cur[:] = c["following"]
+		c["following"].fill(-1)
+		act.fill(0)
+		c["age"] += 1
+
+		return notes
@@ -0,0 +1,245 @@
+import io
+import math
+
+from PIL import Image, ImageDraw, ImageFont
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+# This file implements the world map, and the picture of the mail in transit drawn over it at the end of each day.
+#
+# The map is drawn in two layers. The base layer (connections, towns and their names) never changes, so it is drawn once and cached. The
+# mail layer is drawn over a copy of it: the number of letters in each town and on each connection are counted in one pass over the mail
+# (vectorized over the columnar store), and only towns and connections that hold mail are drawn, so a frame costs the same however much
+# mail is in transit. Maps are drawn in palette mode, which keeps copies small and lets frames be written to GIFs as they are.
+
+# Size of the map in pixels. Town coordinates are relative to its center.
+MAP_SIZE = (1920, 1080)
+
+# Palette indices. Mail is drawn in NUM_LOAD_COLORS colors from COLOR_LOAD on, lightest first, by the amount of mail on a log scale.
+COLOR_BACKGROUND = 0
+COLOR_CONNECTION = 1
+COLOR_TOWN = 2
+COLOR_LOAD = 3
+NUM_LOAD_COLORS = 16
+
+# Gets the palette of the map, as a list of 768 RGB values.
+def map_palette():
+	pal = [0, 0, 0, 220, 220, 220, 240, 240, 240]
+	for i in range(NUM_LOAD_COLORS):
+		f = i / (NUM_LOAD_COLORS - 1)
+		pal += [255, int(210 - 170 * f), int(80 - 40 * f)]
+
+	return pal + [0] * (768 - len(pal))
+
+# Draws the map of a world. Every postman has one, created by postman.get_map.
+class map_renderer:
+	def __init__(self, pm):
+		self.pm = pm
+		self.font = ImageFont.load_default()
+
+		self.town_index = {}
+		for i in range(len(pm.towns)):
+			self.town_index[pm.towns[i]] = i
+
+		# Every connection once, as a pair of town indices, lowest first.
+		self.edges = sorted({(min(a, b), max(a, b)) for a in range(len(pm.towns)) for b in (self.town_index[n] for n in pm.towns[a].neighbors)})
+		self.edge_index = {}
+		for i in range(len(self.edges)):
+			self.edge_index[self.edges[i]] = i
+
+		# To find the connections of many letters at once without searching, every town gets a slot such that the neighbors of any town
+		# are in different slots. The connection between towns a and b is then slot_edge[a * num_slots + town_slot[b]]. Towns only have a
+		# few neighbors, so few slots are needed.
+		town_slot = [-1] * len(pm.towns)
+		for t in pm.towns:
+			taken = {town_slot[self.town_index[n2]] for n in t.neighbors for n2 in n.neighbors}
+			slot = 0
+			while slot in taken:
+				slot += 1
+			town_slot[self.town_index[t]] = slot
+
+		self.num_slots = max(town_slot + [0]) + 1
+		self.town_slot = None
+		self.slot_edge = None
+		if np is not None:
+			self.town_slot = np.array(town_slot, dtype="i4")
+			self.slot_edge = np.full(len(pm.towns) * self.num_slots, -1, dtype="i4")
+			for i in range(len(self.edges)):
+				a, b = self.edges[i]
+				self.slot_edge[a * self.num_slots + town_slot[b]] = i
+				self.slot_edge[b * self.num_slots + town_slot[a]] = i
+
+		# Cached base layer. Drawn by get_base.
+		self.base = None
+
+		# Masks of the digits 0-9, which mail counts are pasted from instead of rendering text for every town in every frame.
+		self.digits = {}
+		height = self.font.getbbox("0123456789")[3]
+		for d in "0123456789":
+			mask = Image.new("1", (int(self.font.getlength(d)), height))
+			ImageDraw.Draw(mask).text((0, 0), d, font=self.font, fill=1)
+			self.digits[d] = mask
+
+	# Gets the position of a town on the map.
+	def position(self, t):
+		return t.x + MAP_SIZE[0] // 2, t.y + MAP_SIZE[1] // 2
+
+	# Draw a number at the given position.
+	def draw_number(self, img, xy, n, color):
+		x, y = int(xy[0]), int(xy[1])
+		for d in str(n):
+			mask = self.digits[d]
+			img.paste(color, (x, y), mask)
+			x += mask.width
+
+	# Gets the base layer: connections, towns and their names. Drawn on the first call only.
+	def get_base(self):
+		if self.base is not None:
+			return self.base
+
+		img = Image.new("P", MAP_SIZE, COLOR_BACKGROUND)
+		img.putpalette(map_palette())
+		drw = ImageDraw.Draw(img)
+
+		for a, b in self.edges:
+			drw.line(self.position(self.pm.towns[a]) + self.position(self.pm.towns[b]), fill=COLOR_CONNECTION)
+
+		for t in self.pm.towns:
+			x, y = self.position(t)
+			drw.ellipse((x - 5, y - 5, x + 5, y + 5), fill=COLOR_TOWN)
+			drw.text((x - 5, y - 15), t.get_address(), font=self.font, fill=COLOR_TOWN)
+
+		self.base = img
+		return img
+
+	# Count the mail in each town, at its post office or one of its houses, and on each connection, meaning mail at a post office whose
+	# last move was along that connection. Returns two lists, indexed like pm.towns and self.edges.
+	def count_mail(self):
+		num_towns = len(self.pm.towns)
+		town_counts = [0] * num_towns
+		edge_counts = [0] * len(self.edges)
+
+		town_index = self.town_index
+		edge_index = self.edge_index
+		for m in self.pm.post:
+			cur = town_index.get(m.current)
+			if cur is None:
+				town_counts[town_index[m.current.street.town]] += 1
+				continue
+
+			town_counts[cur] += 1
+
+			prev = town_index.get(m.previous)
+			if prev is not None and prev != cur:
+				e = edge_index.get((min(prev, cur), max(prev, cur)))
+				if e is not None:
+					edge_counts[e] += 1
+
+		st = self.pm.store
+		if st is not None and len(st) > 0:
+			cur = st.cols["current"]
+			prev = st.cols["previous"]
+			town_counts = (np.bincount(st.place_town[cur], minlength=num_towns) + town_counts).tolist()
+
+			moved = np.flatnonzero((cur < num_towns) & (prev < num_towns) & (cur != prev))
+			e = self.slot_edge[cur[moved] * self.num_slots + self.town_slot[prev[moved]]]
+			edge_counts = (np.bincount(e[e >= 0], minlength=len(self.edges)) + edge_counts).tolist()
+
+		return town_counts, edge_counts
+
+	# Draw the mail in transit over a copy of the base layer, and return it. Connections and towns holding mail are colored, and drawn
+	# thicker, by how much mail they hold. If counts are given, as returned by count_mail, they are drawn instead of counting the mail, so
+	# that the mail can be counted while the world is locked and drawn after.
+	def draw_mail(self, day, counts=None):
+		town_counts, edge_counts = self.count_mail() if counts is None else counts
+
+		img = self.get_base().copy()
+		drw = ImageDraw.Draw(img)
+
+		# Colors go up to the largest count, on a log scale.
+		scale = (NUM_LOAD_COLORS - 1) / math.log(1 + max(town_counts + edge_counts + [1]))
+
+		towns = self.pm.towns
+		for i in range(len(edge_counts)):
+			if edge_counts[i] > 0:
+				level = int(math.log(1 + edge_counts[i]) * scale)
+				a, b = self.edges[i]
+				drw.line(self.position(towns[a]) + self.position(towns[b]), fill=COLOR_LOAD + level, width=1 + level // 4)
+
+		for i in range(len(town_counts)):
+			if town_counts[i] > 0:
+				level = int(math.log(1 + town_counts[i]) * scale)
+				r = 5 + level // 3
+				x, y = self.position(towns[i])
+				drw.ellipse((x - r, y - r, x + r, y + r), fill=COLOR_LOAD + level)
+				self.draw_number(img, (x - 5, y + r + 2), town_counts[i], COLOR_LOAD + level)
+
+		drw.text((10, 10), "Day %d: %d letters in transit" % (day, sum(town_counts)), font=self.font, fill=COLOR_TOWN)
+		return img
+
+# Encode a palette image as the blocks of one frame of an animated GIF: a graphic control extension showing it for duration milliseconds,
+# and the image itself with its own color table. Pillow encodes the image, and its blocks are taken out of the file it writes.
+def encode_gif_frame(img, duration):
+	buf = io.BytesIO()
+	img.save(buf, "GIF")
+	data = buf.getvalue()
+
+	# The global color table follows the 6-byte header and 7-byte logical screen descriptor.
+	flags = data[10]
+	table_size = 3 << ((flags & 7) + 1) if flags & 0x80 else 0
+	table = data[13:13 + table_size]
+
+	# Skip any extensions up to the image descriptor.
+	i = 13 + table_size
+	while data[i] == 0x21:
+		i += 2
+		while data[i] != 0:
+			i += data[i] + 1
+		i += 1
+
+	# Make the global color table the image's own, unless it has one. The image data runs up to the trailer.
+	descriptor = bytearray(data[i:i + 10])
+	if descriptor[9] & 0x80:
+		table = b""
+	else:
+		descriptor[9] |= 0x80 | (flags & 7)
+
+	control = b"\x21\xf9\x04\x00" + (duration // 10).to_bytes(2, "little") + b"\x00\x00"
+	return control + bytes(descriptor) + table + data[i + 10:-1]
+
+# Records the mail in transit at the end of every day as an animation.
+class map_animation:
+	# If fn ends with ".gif", frames are appended to it as a GIF as they are added, each shown for duration milliseconds. The file is a
+	# complete GIF after every frame, so nothing is kept in memory and the game can be quit at any time. Otherwise, every frame is written
+	# as a PNG, to fn formatted with its day (as in "frames/day_%03d.png").
+	def __init__(self, fn, duration=500):
+		self.fn = fn
+		self.duration = duration
+
+		self.is_gif = fn.lower().endswith(".gif")
+		self.file = None
+
+	# Add a frame, as drawn by map_renderer.draw_mail.
+	def add_frame(self, img, day):
+		if not self.is_gif:
+			img.save(self.fn % day)
+			return
+
+		# The header loops the animation forever.
+		if self.file is None:
+			self.file = open(self.fn, "wb")
+			self.file.write(b"GIF89a" + img.width.to_bytes(2, "little") + img.height.to_bytes(2, "little") + b"\x00\x00\x00")
+			self.file.write(b"\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00")
+
+		# Write the frame and the trailer, then step back over the trailer so the next frame replaces it.
+		self.file.write(encode_gif_frame(img, self.duration) + b"\x3b")
+		self.file.flush()
+		self.file.seek(-1, io.SEEK_CUR)
+
+	def close(self):
+		if self.file is not None:
+			self.file.close()
+			self.file = None
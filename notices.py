@@ -0,0 +1,77 @@
+from collections import deque
+
+# This file implements post office notifications. A notification is a code naming what happened, the place that reported it, an optional
+# integer argument, and a count. Its text is only rendered from the localization file when it is displayed.
+#
+# Notifications about the same thing are merged within a day: a post office that misroutes a hundred letters to the same neighbor gets
+# one notification with a count of a hundred, so the notifications kept grow with the number of distinct notices rather than with the
+# number of letters.
+
+# Notification codes, and their keys in the "notes" section of the localization file.
+NOTE_LEFTOVER = 0
+NOTE_INCORRECT_RESIDENCE = 1
+NOTE_ROUTED_IN_ERROR = 2
+NOTE_DELIVERED_DAMAGED = 3
+NOTE_ROUTED_DAMAGED = 4
+
+note_keys = ["leftover", "incorrect_residence", "routed_in_error", "delivered_damaged", "routed_damaged"]
+
+# Gets the text of a notification in the language of strings, the loaded localization file.
+def render_note(strings, code, arg, count):
+	text = getattr(strings.notes, note_keys[code])
+	if arg is not None:
+		text = text % arg
+	if count > 1:
+		text = strings.notes.repeated % (text, count)
+
+	return text
+
+# Queue of a post office's notifications, oldest first. Entries are (notifier, code, arg, count).
+class notice_board:
+	__slots__ = ("aggregate", "queue", "today")
+
+	# If aggregate is False, every notification is kept separately.
+	def __init__(self, aggregate=True):
+		self.aggregate = aggregate
+		self.queue = deque()
+
+		# Entries posted since the last call to new_day, by (notifier, code, arg). Only these are merged into.
+		self.today = {}
+
+	def __len__(self):
+		return len(self.queue)
+
+	def __iter__(self):
+		return (tuple(e) for e in self.queue)
+
+	# Stop merging new notifications into the ones posted so far.
+	def new_day(self):
+		self.today = {}
+
+	def post(self, notifier, code, arg=None, count=1):
+		if not self.aggregate:
+			for i in range(count):
+				self.queue.append([notifier, code, arg, 1])
+			return
+
+		key = (notifier, code, arg)
+		e = self.today.get(key)
+		if e is not None:
+			e[3] += count
+		else:
+			e = [notifier, code, arg, count]
+			self.queue.append(e)
+			self.today[key] = e
+
+	# Remove the oldest notification and return it.
+	def pop(self):
+		e = self.queue.popleft()
+		key = (e[0], e[1], e[2])
+		if self.today.get(key) is e:
+			del self.today[key]
+
+		return tuple(e)
+
+	def clear(self):
+		self.queue.clear()
+		self.today = {}
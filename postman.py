@@ -1,40 +1,61 @@
+import argparse
 import math
 import random
 import threading
-import time
 
 from postman_classes import *
 from interface import *
-	
-pm = postman("postman_campaign")
+from mail_store import *
+from snapshot import *
+from shards import *
+
+parser = argparse.ArgumentParser(description="Postman game server.")
+parser.add_argument("snapshot", nargs="?", help="snapshot file to resume from")
+parser.add_argument("--seed", type=int, help="seed for world and mail generation, to make the game reproducible")
+parser.add_argument("--days", type=int, help="simulate this many days without a player, print the throughput of each, then exit")
+parser.add_argument("--stats", metavar="FILE", help="time each phase of every day and append the statistics to FILE as JSON lines")
+parser.add_argument("--profile-day", type=int, metavar="DAY", help="run this day under cProfile and write the profile to day_DAY.prof")
+parser.add_argument("--animate", metavar="FILE", help="record the mail in transit at the end of every day, as a GIF if FILE ends with .gif, or else as PNG frames named FILE %% day (e.g. frames/day_%%03d.png)")
+parser.add_argument("--shards", type=int, metavar="N", help="route automated mail in N worker processes, each handling a subtree of the postal network (uses the columnar mail store)")
+args = parser.parse_args()
+
+# Resume from a snapshot if one is given. Otherwise, generate a new world.
+if args.snapshot is not None:
+	pm = load_snapshot(args.snapshot)
+else:
+	pm = postman("postman_campaign", args.seed)
+	pm.gen_map()
 
-pm.gen_map()
 pm.draw_map("map.png")
 
-# This function takes a mail item and adds it to the appropriate player's queue or ignores it as needed.
-def add_mail_to_pq(m):
-	# If this mail item is in a player-controlled town...
-	if type(m.current) == town and m.current.player_ctrl:
-		# If this is a story item, move it to the player's queue.
-		if m.is_story:	
-			m.current.player_queue.append(m)
-			m.is_auto = False
-			return
-		
-		# If the mail limit is not met...
-		if len(m.current.player_queue) < pm.srv.mail_limit:
-			# If this mail is new and the new mail quota is not met, add it to the player's queue
-			if m.age == 0 and m.current.new_mail_in_pq < pm.srv.new_mail_quota:
-				m.current.player_queue.append(m)
-				m.current.new_mail_in_pq += 1
-				m.is_auto = False
-				return
-			
-			# If the mail quota is not met, add it to the player's queue.
-			if len(m.current.player_queue) < pm.srv.mail_quota:
-				m.current.player_queue.append(m)
-				m.is_auto = False
-				return
+# Optionally instrument the simulation loop
+if args.stats is not None or args.profile_day is not None:
+	pm.stats = day_stats(True, args.stats, args.profile_day)
+
+# Optionally keep automated mail in the columnar store. Sharded simulation needs it.
+if (pm.settings.mail_store == "columnar" or args.shards is not None) and pm.store is None:
+	pm.store = mail_columns(pm)
+
+if args.shards is not None:
+	pm.store.shards = shard_pool(pm.store, args.shards)
+
+# Optionally record every day's mail. Frames are drawn over the map drawn above.
+anim = None
+if args.animate is not None:
+	anim = map_animation(args.animate)
+
+# In headless mode, fast-forward and exit without starting the client.
+if args.days is not None:
+	if anim is None:
+		pm.simulate_days(args.days)
+	else:
+		for i in range(args.days):
+			pm.simulate_days(1)
+			anim.add_frame(pm.get_map().draw_mail(pm.phase.day), pm.phase.day)
+
+		anim.close()
+
+	exit()
 
 # Create local client
 cli = pm_cli(pm, None)
@@ -43,77 +64,14 @@ cli = pm_cli(pm, None)
 cli_thr = threading.Thread(target=pm_cli.mainloop, args=(cli, False))
 cli_thr.start()
 
-# Start the mail simulation.
+# Start the mail simulation. Each day is simulated while the player waits, then the simulation waits for the player to end the day.
 while True:
-	# Handle mail
-	for t in pm.towns:
-		# Handle mail left in the player queues from the previous day.
-		if t.player_ctrl:
-			num_unhandled = 0
-			
-			for m in t.player_queue:
-				if m.act.following is None:
-					m.handle()
-					num_unhandled += 1
-			
-			t.notify(t, "There were " + str(num_unhandled) + " mail items left in your queue at the end of the day yesterday.")
-	
-	# Handle all automated mail
-	m_i = 0
-	while m_i < len(pm.post):
-		m = pm.post[m_i]
-		
-		is_destroyed = False
-		if type(m.current) is house or not m.current.player_ctrl:
-			is_destroyed = m.handle()
-		
-		if not is_destroyed:
-			m_i += 1
-	
-	# Handle remaining mail. This is mail in a player-controlled post office that didn't end up in the queue.
-	m_i = 0
-	while m_i < len(pm.post):
-		m = pm.post[m_i]
-		
-		is_destroyed = False
-		if m.current.player_ctrl and m not in m.current.player_queue:
-			is_destroyed = m.handle()
-		
-		if not is_destroyed:
-			m_i += 1
-	
-	# Reset player queues
-	for t in pm.towns:
-		if t.player_ctrl:
-			t.player_queue = []
-	
-	# Move all mail to its destination
-	for m in pm.post:
-		m.advance()
-	
-	# Get all mail for the player to handle
-	# Shuffle the mail to prevent bias in what ends up in the player's queue.
-	#random.shuffle(pm.post)
-	
-	# Reset the new_mail_in_pq for each town
-	for t in pm.towns:
-		t.new_mail_in_pq = 0
-		
-	# Move all mail to player queues as needed
-	for m in pm.post:
-		add_mail_to_pq(m)
-	
-	# Loop over towns. If the mail quotas aren't met, generate new mail randomly.
-	for t in pm.towns:
-		if t.player_ctrl:
-			while len(t.player_queue) < pm.srv.mail_limit and t.new_mail_in_pq < pm.srv.new_mail_quota or len(t.player_queue) < pm.srv.mail_quota:
-				pm.gen_mail()
-				add_mail_to_pq(pm.post[-1])
-	
-	# At this point, all players have queues meeting the mail quota and the mail limit (unless story mail pushed it over), and hopefully meeting the new mail quota. All remaining mail will be handled automatically.
-	
-	# Set is_simulating to false and wait for the player to update this by ending the day.
-	pm.is_simulating = False
-	while not pm.is_simulating:
-		time.sleep(0.1)
-		pass
\ No newline at end of file
+	# The mail in transit at the end of the day is counted before the player sees the day, and drawn once they may carry on.
+	with pm.phase.simulating():
+		pm.simulate_day()
+		counts = pm.get_map().count_mail()
+
+	img = pm.get_map().draw_mail(pm.phase.day, counts)
+	img.save("map.png")
+	if anim is not None:
+		anim.add_frame(img, pm.phase.day)
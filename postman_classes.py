@@ -1,9 +1,27 @@
 import math
 import random
 import json
+import sys
+import time
+import gc
+import threading
+from array import array
+from contextlib import contextmanager
 from types import SimpleNamespace
 
-from PIL import Image, ImageDraw, ImageFont
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+from routing import *
+from spatial import *
+from instrument import *
+from address_index import *
+from recovery import *
+from forwarding import *
+from notices import *
+from map_render import *
 
 # This file implements the mail simulation backend
 
@@ -17,10 +35,16 @@ def load_json(fn):
 # This class tracks the gamestate, including a list of all senders, the post network shape, and all mail in transit.
 class postman:
 	# The postman initializer creates the game map and all the senders.
-	def __init__(self, serv):
+	# All randomness in the game is drawn from self.rng, which is seeded with seed. If seed is None, the game is seeded randomly.
+	def __init__(self, serv, seed=None):
 		# Load settings
+		self.serv = serv
 		self.settings = load_json("settings.json")
 		
+		# Random generator for the whole game
+		self.seed = seed
+		self.rng = random.Random(seed)
+		
 		# Load list of days (rulesets)
 		self.days = load_json("servers/" + serv + "/days.json")
 		
@@ -34,7 +58,7 @@ class postman:
 		self.strings = load_json("localization/" + self.settings.language + ".json")
 		
 		# Each new piece of mail has a unique ID. This number tracks what the next available ID is.
-		self.next_mail_ID = random.randrange(0, 1000)
+		self.next_mail_ID = self.rng.randrange(0, 1000)
 		
 		# Load town name list
 		fin = open("servers/" + serv + "/names/town_names.txt", "r")
@@ -56,34 +80,69 @@ class postman:
 		self.last_names = fin.read().split("\n")
 		fin.close()
 		
-		# Start the game in simulation mode. Player input is ignored at this time.
-		self.is_simulating = True
+		# Synchronizes the simulation with the players. The game starts in simulation mode; player input is ignored at this time.
+		self.phase = day_phase(1)
 		
 		# Initialize list of all senders in the game
 		self.senders = []
 		
-		# Initialize list for all mail in transit
-		self.post = []
+		# Initialize collection of all mail in transit. Used as an ordered set (values are unused) so that delivered mail can be removed in constant time.
+		self.post = {}
 		
 		# Initialize list of towns
 		self.towns = []
 		
-		# Initialize routing table
-		self.routing = {}
+		# Zip codes already taken by towns
+		self.zip_codes = set()
+		
+		# Initialize routing backend. Set by build_routing.
+		self.routing = None
+		
+		# Optional columnar store holding automated mail (see mail_store.py). If None, all mail is kept in self.post.
+		self.store = None
+		
+		# Index used to resolve misspelled or partial addresses (see address_index.py). Set by gen_map.
+		self.addresses = None
+		
+		# Instrumentation of the simulation loop (see instrument.py). Disabled unless replaced.
+		self.stats = day_stats()
+		
+		# Recovery requests in progress (see recovery.py).
+		self.recovery = recovery_desk()
+		
+		# Draws the world map (see map_render.py). Created by get_map.
+		self.map = None
+		
+		# Mail forwarding orders of senders who moved, and the houses they can move into (see forwarding.py). Vacancies are listed by gen_map.
+		self.forwarding = forwarding_table()
+		self.vacancies = vacancy_list()
+		
+		# Mail that couldn't be delivered or forwarded today. It is filed in the recovery bins before it is moved.
+		self.undeliverable = []
+		
+		# Random generator used to draw random numbers in bulk, seeded from self.rng. Falls back on self.rng if numpy is not installed.
+		self.np_rng = None if np is None else np.random.default_rng(self.rng.getrandbits(64))
 	
-	# Generate a random piece of mail somewhere.
+	# Draw n random floats in [0, 1) at once, as a list.
+	def draw_uniform(self, n):
+		if self.np_rng is not None:
+			return self.np_rng.random(n).tolist()
+		
+		return [self.rng.random() for i in range(n)]
+	
+	# Generate a random piece of mail somewhere and return it.
 	def gen_mail(self):
-		sender = random.choice(self.senders)
+		sender = self.rng.choice(self.senders)
 		recipient = None
 		
 		# Mail has a chance to be in reply to an individual from whom mail was recently received
-		if random.uniform(0, 1) < 0.5 and len(sender.recv_from) > 0:
-			recipient = random.choice(sender.recv_from)
+		if self.rng.uniform(0, 1) < 0.5 and sender.recv_from.recent(self.phase.day, self.srv.reply_window) > 0:
+			recipient = self.senders[sender.recv_from.get(self.rng.randrange(len(sender.recv_from)))]
 		
 		# Mail has a good chance of being addressed to someone within the sender's town
-		elif random.uniform(0, 1) < 0.6:
+		elif self.rng.uniform(0, 1) < 0.6:
 			while True:
-				recipient = random.choice(sender.town.citizens)
+				recipient = self.rng.choice(sender.town.citizens)
 				
 				# Ensure the recipient is not the sender
 				if recipient != sender:
@@ -92,15 +151,103 @@ class postman:
 		# If both previous conditions failed, just pick a random person anywhere.
 		else:
 			while True:
-				recipient = random.choice(self.senders)
+				recipient = self.rng.choice(self.senders)
 				
 				# Ensure the recipient is not the sender
 				if recipient != sender:
 					break
 		
 		mail_item = mail(self, sender, recipient, False)
-		self.post.append(mail_item)
+		self.post[mail_item] = None
 		sender.add_mail(mail_item)
+		
+		return mail_item
+	
+	# Draw the number of failures before the k-th success of independent trials that succeed with probability p.
+	def draw_negative_binomial(self, k, p):
+		if p >= 1 or k <= 0:
+			return 0
+		
+		if self.np_rng is not None:
+			return int(self.np_rng.negative_binomial(k, p))
+		
+		# Sum of k geometric draws.
+		return sum(int(math.log(1 - u) / math.log(1 - p)) for u in self.draw_uniform(k))
+	
+	# Generate many random pieces of mail at once and return them. Senders, recipients and the choice between replying, writing locally
+	# and writing anywhere are drawn in bulk, with the same distribution as gen_mail.
+	#
+	# If quota_town is given, n is ignored and mail is generated as if gen_mail were called until exactly quota pieces of mail had been sent
+	# from that town. Rather than drawing senders until the quota is met, the quota is drawn directly from the town's own citizens, and the
+	# number of letters the other towns would have sent in the meantime is drawn from the matching negative binomial distribution. This meets
+	# the quota in O(quota) draws while keeping all mail statistics unbiased.
+	# If the postman has a columnar store, the mail from the other towns is added straight to the store and is not returned.
+	def gen_mail_batch(self, n, quota_town=None, quota=0):
+		num_senders = len(self.senders)
+		
+		if quota_town is None:
+			return self.build_mail_batch([self.senders[int(u * num_senders)] for u in self.draw_uniform(n)])
+		
+		pool = quota_town.citizens
+		batch = self.build_mail_batch([pool[int(u * len(pool))] for u in self.draw_uniform(quota)])
+		
+		num_other = self.draw_negative_binomial(quota, len(pool) / num_senders)
+		if self.store is not None:
+			self.store.gen_mail_outside(num_other, quota_town)
+		else:
+			others = []
+			while len(others) < num_other:
+				for u in self.draw_uniform(num_other - len(others)):
+					sender = self.senders[int(u * num_senders)]
+					if sender.town is not quota_town:
+						others.append(sender)
+			
+			batch.extend(self.build_mail_batch(others))
+		
+		return batch
+	
+	# Generate a piece of mail from each of the given senders, and return them.
+	def build_mail_batch(self, senders):
+		num_senders = len(self.senders)
+		day = self.phase.day
+		reply_window = self.srv.reply_window
+		
+		# Six random numbers per piece of mail: whether to reply, whether to write locally, which recipient to pick, and the three rolls of mail.__init__.
+		u = self.draw_uniform(6 * len(senders))
+		
+		# The cyclic garbage collector is paused while the letters are built, as none of them can be garbage yet.
+		gc_was_enabled = gc.isenabled()
+		gc.disable()
+		
+		batch = []
+		for sender, u_reply, u_local, u_pick, u_shortpay, u_stamp, u_damage in zip(senders, u[0::6], u[1::6], u[2::6], u[3::6], u[4::6], u[5::6]):
+			# Mail has a chance to be in reply to an individual from whom mail was recently received
+			if u_reply < 0.5 and sender.recv_from.recent(day, reply_window) > 0:
+				recipient = self.senders[sender.recv_from.get(int(u_pick * len(sender.recv_from)))]
+			
+			# Mail has a good chance of being addressed to someone within the sender's town. Picking among all citizens but the last, and
+			# replacing the sender with the last, picks uniformly among everyone but the sender without retrying.
+			elif u_local < 0.6 and len(sender.town.citizens) > 1:
+				citizens = sender.town.citizens
+				recipient = citizens[int(u_pick * (len(citizens) - 1))]
+				if recipient is sender:
+					recipient = citizens[-1]
+			
+			# Otherwise, just pick a random person anywhere.
+			else:
+				recipient = self.senders[int(u_pick * (num_senders - 1))]
+				if recipient is sender:
+					recipient = self.senders[-1]
+			
+			mail_item = mail(self, sender, recipient, False, (u_shortpay, u_stamp, u_damage))
+			self.post[mail_item] = None
+			sender.add_mail(mail_item)
+			batch.append(mail_item)
+		
+		if gc_was_enabled:
+			gc.enable()
+		
+		return batch
 			
 	# Generates a town. pop_mul is a multiplier for the average population. Actual population varies a lot.
 	# Towns of pop_mul 1 will have an average population of 80.
@@ -109,9 +256,14 @@ class postman:
 	
 	# Generates the game world according to the settings. Towns must be at least 50
 	def gen_map(self):
+		min_town_sep = self.settings.world_gen.min_town_sep
+		
 		# Generate the player's town
 		self.towns.append(self.add_town(0.5, 0, 0, True))
 		
+		# Spatial index of every town but the player's, which is exempt from the minimum separation and never connected to additional towns.
+		grid = spatial_grid(max(min_town_sep, 1))
+		
 		# Generate connecting towns
 		for i in range(0, self.settings.world_gen.num_connecting_towns):
 			# Town size is based on which town is being generated
@@ -125,24 +277,19 @@ class postman:
 			# If a town exhausts all attempts, stop generating connecting towns.
 			gen_successful = False
 			for j in range(400):
-				angle = random.uniform(0, 2*math.pi)
-				radius = random.uniform(self.settings.world_gen.min_town_sep, 300)
+				angle = self.rng.uniform(0, 2*math.pi)
+				radius = self.rng.uniform(self.settings.world_gen.min_town_sep, 300)
 				
 				x = radius * math.cos(radius)
 				y = radius * math.sin(radius)
 				
-				coords_valid = True
-				for t in self.towns[1:]:
-					if ((t.x - x)**2 + (t.y - y)**2)**0.5 < self.settings.world_gen.min_town_sep:
-						coords_valid = False
-						break
-				
-				if coords_valid:
+				if not grid.any_within(x, y, min_town_sep):
 					gen_successful = True
 					break
 			
 			if gen_successful:
 				self.towns.append(self.add_town(t_size, x, y, False))
+				grid.add(self.towns[-1])
 				postman.connect_towns(self.towns[0], self.towns[-1])
 			else:
 				print("Couldn't find room for all connecting towns; Number of connecting towns does not reflect settings.")
@@ -154,8 +301,8 @@ class postman:
 			# If a town exhausts all attempts, stop generating connecting towns.
 			gen_successful = False
 			for j in range(400):
-				angle = random.uniform(0, 2*math.pi)
-				radius = random.uniform(280, 1060)
+				angle = self.rng.uniform(0, 2*math.pi)
+				radius = self.rng.uniform(280, 1060)
 				
 				x = radius * math.cos(radius)
 				y = radius * math.sin(radius)
@@ -163,25 +310,15 @@ class postman:
 				if y < -510 or y > 510 or x < -930 or x > 930:
 					continue
 				
-				coords_valid = True
-				min_town = None
-				min_dist = 3000
-				for t in self.towns[1:]:
-					cur_dist = ((t.x - x)**2 + (t.y - y)**2)**0.5
-					if cur_dist < self.settings.world_gen.min_town_sep:
-						coords_valid = False
-						break
-					
-					if cur_dist < min_dist:
-						min_dist = cur_dist
-						min_town = t
-				
-				if coords_valid:
+				# Find the nearest town to connect to, which must not be closer than the minimum separation.
+				min_town, min_dist = grid.nearest(x, y)
+				if min_town is not None and min_dist >= min_town_sep:
 					gen_successful = True
 					break
 			
 			if gen_successful:
-				self.towns.append(self.add_town(random.uniform(0.3, 1.2), x, y, False))
+				self.towns.append(self.add_town(self.rng.uniform(0.3, 1.2), x, y, False))
+				grid.add(self.towns[-1])
 				postman.connect_towns(min_town, self.towns[-1])
 			else:
 				print("Couldn't find room for all additional towns; Number of additional towns does not reflect settings.")
@@ -189,18 +326,13 @@ class postman:
 		
 		# Optimize routes. Consider town A, connected to B, connected to C: A-B-C
 		# If the distance B-A-C is shorter, replace the old connection with it.
-		for a_i in range(1, len(self.towns)):
-			a = self.towns[a_i]
-			
-			b_i_off = 0
-			for b_i in range(len(a.neighbors)):
-				b = a.neighbors[b_i - b_i_off]
+		# Only the neighbors each town had when it is reached are considered, so the loops iterate over copies instead of adjusting indices around deletions.
+		for a in self.towns[1:]:
+			for b in a.neighbors[:]:
 				if b == self.towns[0]:
 					continue
 				
-				c_i_off = 0
-				for c_i in range(len(b.neighbors)):
-					c = b.neighbors[c_i - c_i_off]
+				for c in b.neighbors[:]:
 					if c == self.towns[0]:
 						continue
 					
@@ -208,59 +340,262 @@ class postman:
 						continue
 					
 					if (a.x - c.x)**2 + (a.y - c.y)**2 < (b.x - c.x)**2 + (b.y - c.y)**2:
-						del b.neighbors[c_i - c_i_off]
-						b_i_off+=1
-						for i in range(len(c.neighbors)):
-							if c.neighbors[i] == b:
-								del c.neighbors[i]
-								c_i_off+=1
-								break
-						
+						b.neighbors.remove(c)
+						c.neighbors.remove(b)
 						postman.connect_towns(a, c)
 					
 		# Build Routing tables so that all towns can know where they should forward mail.
 		self.build_routing()
+		
+		# Index every address.
+		self.addresses = address_index(self)
+		
+		# List the empty houses.
+		for t in self.towns:
+			for s in t.streets:
+				for h in s.houses:
+					if len(h.senders) == 0:
+						self.vacancies.add(h)
 			
 	# Build Routing tables so that all towns can know where they should forward mail.
+	# The backend is chosen by the "routing" setting: "table" for the dense all-pairs table, "tree" for the compact tree router, or "auto" to use the tree router whenever the network is a tree.
 	def build_routing(self):
 		print("Building routing table...")
 		
-		for a in self.towns:
-			self.routing[a.zip_code] = {}
-			
-			self.routing[a.zip_code][a.zip_code] = 0
-			
-			visited = []
-			edge = [a]
+		backend = self.settings.routing
+		if backend == "auto":
+			backend = "tree" if routing_tree.is_tree(self.towns) else "table"
+		
+		if backend == "tree":
+			self.routing = routing_tree(self.towns)
+		else:
+			self.routing = routing_table(self.towns)
+	
+	# Gets the map renderer of the world. The map is only drawn once, so this must not be called before the world is generated.
+	def get_map(self):
+		if self.map is None:
+			self.map = map_renderer(self)
+		
+		return self.map
+	
+	# Outputs the world map as an image to the specified file. If mail is True, the mail in transit is drawn over it.
+	def draw_map(self, fn, mail=False):
+		if mail:
+			self.get_map().draw_mail(self.phase.day).save(fn)
+		else:
+			self.get_map().get_base().save(fn)
+	
+	# Adds a mail item to the queue of the player-controlled town it is in, if the town wants it.
+	def add_mail_to_pq(self, m):
+		if type(m.current) == town and m.current.player_ctrl and m.current.queue_accepts(m.is_story, m.age):
+			m.current.player_queue.append(m)
+			m.is_auto = False
+	
+	# Moves mail held by the columnar store at a player-controlled town into the player's queue as needed.
+	def add_store_mail_to_pq(self, t):
+		for r in self.store.rows_at(t):
+			if len(t.player_queue) >= self.srv.mail_limit:
+				break
 			
-			while len(edge) > 0:
-				for n in edge[0].neighbors:
-					if n in visited:
-						continue
-					
-					self.routing[a.zip_code][n.zip_code] = self.routing[a.zip_code][edge[0].zip_code] + 1
-					
-					edge.append(n)
+			if t.queue_accepts(False, self.store.get_age(r)):
+				m = self.store.materialize(r)
+				t.player_queue.append(m)
+				m.is_auto = False
+	
+	# Simulate one day: handle and advance all mail, then refill the player queues. Returns the number of letters delivered.
+	# The caller must hold the day phase lock if players may be handling their queues.
+	# Each phase is timed by self.stats, which also counts the letters handled and delivered.
+	def simulate_day(self):
+		stats = self.stats
+		stats.begin_day(self.phase.day + 1)
+		
+		# Notifications are only merged with others from the same day.
+		for t in self.towns:
+			t.notes.new_day()
+		
+		# Handle mail left in the player queues from the previous day.
+		with stats.phase("leftovers"):
+			for t in self.towns:
+				if t.player_ctrl:
+					num_unhandled = 0
 					
-				visited.append(edge[0])
-				del edge[0]
+					for m in t.player_queue:
+						if m.following is None:
+							m.handle()
+							num_unhandled += 1
 					
-	
-	# Outputs the world map as an image to the specified file
-	def draw_map(self, fn):
-		fnt = ImageFont.load_default()
+					stats.count("handled", num_unhandled)
+					t.notify(t, NOTE_LEFTOVER, num_unhandled)
+		
+		# Evict old mail from the recovery bins, and move recovery requests along. Recovered mail is handled with the rest below.
+		with stats.phase("recovery"):
+			for t in self.towns:
+				for m in t.recovery.evict(self.phase.day, self.srv.recovery_keep_days):
+					del m.sender.in_transit[m]
+			
+			found, num_failed = self.recovery.handle(self, self.phase.day)
+			num_returned = 0
+			for m, t in found:
+				if not t.recover(m):
+					num_returned += 1
+			
+			stats.count("recovered", len(found) - num_returned)
+			stats.count("returned", num_returned)
+			stats.count("recovery_failed", num_failed)
+		
+		# Some senders move into empty houses, and leave an order to forward their mail. Expired orders are dropped first.
+		with stats.phase("moves"):
+			self.forwarding.evict(self.phase.day)
+			
+			num_moved = 0
+			for t in self.towns:
+				if len(t.citizens) > 0 and len(self.vacancies) > 0 and self.rng.uniform(0, 1) < self.srv.prob_sender_moves:
+					self.move_sender(t.citizens[self.rng.randrange(len(t.citizens))], self.vacancies.get(self.rng.randrange(len(self.vacancies))))
+					num_moved += 1
+			
+			stats.count("moved", num_moved)
+		
+		# Handle all automated mail. Mail that reached its recipient is delivered once the pass is done.
+		with stats.phase("handle"):
+			num_handled = 0
+			delivered = []
+			for m in self.post:
+				if type(m.current) is house or not m.current.player_ctrl:
+					num_handled += 1
+					if m.handle():
+						delivered.append(m)
+			
+			for m in delivered:
+				m.deliver()
+			
+			num_delivered = len(delivered)
+			if self.store is not None:
+				num_handled += len(self.store)
+				num_delivered += self.store.handle()
+			
+			stats.count("handled", num_handled)
+			stats.count("delivered", num_delivered)
+		
+		# Handle remaining mail. This is mail in a player-controlled post office that didn't end up in the queue.
+		with stats.phase("remaining"):
+			num_handled = 0
+			for t in self.towns:
+				if t.player_ctrl:
+					for m in t.post:
+						if m.is_auto:
+							m.handle()
+							num_handled += 1
+			
+			stats.count("handled", num_handled)
+		
+		# File mail that couldn't be delivered or forwarded in the recovery bins. Mail in the player queues is filed with the rest of the queue below.
+		for m in self.undeliverable:
+			if m.is_auto:
+				m.current.file_recovery(m)
 		
-		img = Image.new("RGB", (1920, 1080))
-		drw = ImageDraw.Draw(img)
+		stats.count("undeliverable", len(self.undeliverable))
+		self.undeliverable = []
+		
+		# Reset player queues. Mail the players put in recovery is filed in their bins.
 		for t in self.towns:
-			for n in t.neighbors:
-				drw.line((t.x + 960, t.y + 540, n.x + 960, n.y + 540), fill=(220, 220, 220))
+			if t.player_ctrl:
+				for m in t.player_queue:
+					m.is_auto = True
+					if m.following == "recovery":
+						t.file_recovery(m)
+				
+				t.player_queue = []
+		
+		# Move all mail to its destination
+		with stats.phase("advance"):
+			for m in self.post:
+				m.advance()
 			
+			if self.store is not None:
+				self.store.advance()
+		
+		# Reset the new_mail_in_pq for each town
 		for t in self.towns:
-			drw.ellipse((t.x-5 + 960, t.y-5 + 540, t.x+5 + 960, t.y+5 + 540), fill=(240, 240, 240))
-			drw.text((t.x-5 + 960, t.y-15 + 540), t.get_address(), font=fnt, fill=(240, 240, 240))
+			t.new_mail_in_pq = 0
+		
+		# Move all mail in player-controlled post offices to player queues as needed
+		with stats.phase("fill_queues"):
+			for t in self.towns:
+				if t.player_ctrl:
+					for m in t.post:
+						self.add_mail_to_pq(m)
+					
+					if self.store is not None:
+						self.add_store_mail_to_pq(t)
+		
+		# Loop over towns. If the mail quotas aren't met, generate new mail randomly until enough new mail has been sent from the town.
+		with stats.phase("gen_mail"):
+			for t in self.towns:
+				if t.player_ctrl:
+					for m in self.gen_mail_batch(0, t, t.new_mail_wanted()):
+						self.add_mail_to_pq(m)
+		
+		# Move all automated mail into the columnar store. Only mail in the player queues stays materialized.
+		if self.store is not None:
+			with stats.phase("absorb"):
+				for m in list(self.post):
+					if m.is_auto and not m.is_story:
+						self.store.absorb(m)
+		
+		# At this point, all players have queues meeting the mail quota and the mail limit (unless story mail pushed it over), and hopefully meeting the new mail quota. All remaining mail will be handled automatically.
+		stats.end_day()
+		return num_delivered
+	
+	# Gets the number of letters in transit, including those in the columnar store.
+	def num_live_mail(self):
+		return len(self.post) + (0 if self.store is None else len(self.store))
+	
+	# Simulate n days without a player. The player queues are left unhandled, so each day they are handled automatically at the start of the
+	# next day, and notifications are discarded since nobody reads them. If report, print the throughput of each day.
+	# Returns a list with the statistics of each day.
+	def simulate_days(self, n, report=True):
+		stats = []
+		for i in range(n):
+			num_letters = self.num_live_mail()
+			
+			start = time.perf_counter()
+			with self.phase.lock:
+				num_delivered = self.simulate_day()
+				self.phase.day += 1
+				
+				for t in self.towns:
+					t.notes.clear()
+			
+			elapsed = time.perf_counter() - start
+			
+			record = {"day": self.phase.day, "seconds": elapsed, "letters": num_letters, "letters_per_second": num_letters / elapsed, "delivered": num_delivered, "live_mail": self.num_live_mail()}
+			stats.append(record)
+			
+			if report:
+				print("Day %d: %d letters in %.3fs (%.0f letters/s), %d delivered, %d in transit" % (record["day"], num_letters, elapsed, record["letters_per_second"], num_delivered, record["live_mail"]))
+		
+		return stats
+	
+	# Move a sender into an empty house, and have their mail forwarded there for forwarding_days days.
+	def move_sender(self, s, h):
+		old_house = s.house
+		s.set_house(h)
+		
+		self.vacancies.remove(h)
+		if len(old_house.senders) == 0:
+			self.vacancies.add(old_house)
+		
+		self.forwarding.add(s, old_house, h, self.phase.day + self.srv.forwarding_days)
+	
+	# Give players control of the first num_players towns, starting with the player's town. Returns the player-controlled towns.
+	def set_player_towns(self, num_players):
+		if num_players > len(self.towns):
+			print("Not enough towns for all players; Number of players does not reflect settings.")
+		
+		for i in range(len(self.towns)):
+			self.towns[i].player_ctrl = i < num_players
 		
-		img.save(fn)
+		return self.towns[:num_players]
 	
 	# Connect two towns so that mail can be routed from one to the other directly.
 	def connect_towns(a, b):
@@ -272,10 +607,99 @@ class postman:
 		self.next_mail_ID = (self.next_mail_ID + 1) % 100000
 		return self.next_mail_ID
 
+# Synchronizes the simulation thread with the players. Each day, the simulation runs while players wait, then every player handles their
+# queue while the simulation waits, and the next day starts as soon as the last player ends theirs. Waiting threads block on a condition
+# variable, so they use no CPU and wake as soon as the other side is done.
+# lock must be held while touching game state shared with the simulation, such as player queues.
+class day_phase:
+	def __init__(self, num_players):
+		self.lock = threading.Condition(threading.RLock())
+		
+		# Number of players that must end the day before the simulation continues, and the players that have ended the current day. A
+		# player who leaves is only discounted from the day they ended, which the set forgets once that day is over.
+		self.num_players = num_players
+		self.ended = set()
+		
+		self.is_simulating = True
+		
+		# Number of days simulated so far.
+		self.day = 0
+	
+	# Simulate a day. Waits for all players to end the previous day, and holds the lock until the day is simulated.
+	@contextmanager
+	def simulating(self):
+		with self.lock:
+			self.lock.wait_for(lambda: self.is_simulating)
+			yield
+			
+			self.is_simulating = False
+			self.ended.clear()
+			self.day += 1
+			self.lock.notify_all()
+	
+	# Wait for the simulation of a day after last_day to finish, and return the day.
+	def wait_for_day(self, last_day):
+		with self.lock:
+			self.lock.wait_for(lambda: not self.is_simulating and self.day > last_day)
+			return self.day
+	
+	# Called by each player when they end the day, passing any object that identifies them. The simulation resumes once every player has.
+	def end_day(self, player):
+		with self.lock:
+			self.ended.add(player)
+			self.resume_if_ended()
+	
+	# Called when a player joins.
+	def add_player(self):
+		with self.lock:
+			self.num_players += 1
+	
+	# Called when a player leaves. If every remaining player has ended the day, the simulation resumes.
+	def remove_player(self, player):
+		with self.lock:
+			self.num_players -= 1
+			self.ended.discard(player)
+			self.resume_if_ended()
+	
+	# Resume the simulation if every player has ended the day. The world waits while there are no players.
+	def resume_if_ended(self):
+		if not self.is_simulating and self.num_players > 0 and len(self.ended) >= self.num_players:
+			self.is_simulating = True
+			self.lock.notify_all()
+
+# Base class for everything that has an address: towns, streets, houses and senders. The address is built once, interned and cached in both
+# its multi-line form and its single-line form, so that all mail to or from the same place shares the same strings.
+# Subclasses implement build_address(), and must call invalidate_address() whenever anything their address is built from changes.
+class addressable:
+	__slots__ = ("address", "address_line")
+	
+	# Gets the multi-line address as a string.
+	def get_address(self):
+		if self.address is None:
+			self.address = sys.intern(self.build_address())
+			self.address_line = sys.intern(self.address.replace("\n", ", "))
+		
+		return self.address
+	
+	# Gets the address on a single line, with lines separated by commas.
+	def get_address_line(self):
+		if self.address is None:
+			self.get_address()
+		
+		return self.address_line
+	
+	def invalidate_address(self):
+		self.address = None
+		self.address_line = None
+
 # Represents a town, which has one post office, a zip code, and contains streets which contain houses which contain senders.
-class town:
+class town(addressable):
+	__slots__ = ("pm", "x", "y", "player_ctrl", "citizens", "notes", "player_queue", "post", "recovery", "new_mail_in_pq", "zip_code", "name", "neighbors", "streets")
+	
 	# Initialize town. Constructor is passed the postman instance .
 	def __init__(self, pm, pop_mul, x, y, player_ctrl):
+		self.invalidate_address()
+		
 		self.pm = pm
 		
 		# The town location
@@ -289,48 +713,125 @@ class town:
 		self.citizens = []
 		
 		# Post-office notifications. Neighboring post offices will send notifications about errors made.
-		self.notes = []
+		self.notes = notice_board(pm.settings.aggregate_notes)
 		
 		# Queue of mail for players to handle. Filled out by the mainloop for player-controlled POs
 		self.player_queue = []
 		
+		# Mail currently at this post office. Used as an ordered set (values are unused) and kept up to date by mail.advance.
+		self.post = {}
+		
 		# I was on the fence about including this on the town class. It keeps track of the amount of new mail in the player's queue during the generation of the mail that the player must handle.
 		self.new_mail_in_pq = 0
 		
+		# Mail that couldn't be delivered or returned, kept until it is claimed or evicted.
+		self.recovery = recovery_bin()
+		
 		# Generate a random, unique zip code. For the purposes of building the routing table, it is vital that each town have a distinct zip code.
-		do_gen_zip = True
-		while do_gen_zip:
-			self.zip_code = random.randint(10000, 99999)
-			
-			do_gen_zip = False
-			for i in pm.towns:
-				if self.zip_code == i.zip_code:
-					do_gen_zip = True
-					break
+		if len(pm.zip_codes) >= 90000:
+			raise ValueError("All zip codes are taken; no more towns can be generated.")
+		
+		self.zip_code = pm.rng.randint(10000, 99999)
+		while self.zip_code in pm.zip_codes:
+			self.zip_code = pm.rng.randint(10000, 99999)
+		
+		pm.zip_codes.add(self.zip_code)
 		
 		# Get random town name from town name list
-		self.name = random.choice(pm.town_names)
+		self.name = pm.rng.choice(pm.town_names)
 		
 		# Initialize list for neighboring (connected) towns
 		self.neighbors = []
 		
 		self.streets = []
-		num_streets = max(2, round(random.gauss(5.5, 0.7) * (pm.settings.world_gen.town_size_mul*pop_mul)**(1/3)))
-		for i in range(num_streets):
-			self.streets.append(street(pm, pop_mul, self))
+		num_streets = max(2, round(pm.rng.gauss(5.5, 0.7) * (pm.settings.world_gen.town_size_mul*pop_mul)**(1/3)))
+		if num_streets > len(pm.street_names):
+			print("Not enough street names for %d streets in %s; Number of streets does not reflect settings." % (num_streets, self.name))
+			num_streets = len(pm.street_names)
+		
+		# Draw unique street names without replacement
+		for name in pm.rng.sample(pm.street_names, num_streets):
+			self.streets.append(street(pm, pop_mul, self, name))
 		
 		# Sort streets alphabetically
 		self.streets.sort(key = lambda a: a.name)
 	
-	# mail.handle() calls this function on towns which it detects have made a mistake. This adds the notification to a queue.
-	def notify(self, notifier, text):
-		self.notes.append((notifier, text))
+	# Take a piece of mail at this PO out of circulation and file it in the recovery bin. Its sender may ask for it after a few days.
+	def file_recovery(self, m):
+		pm = self.pm
+		del pm.post[m]
+		del self.post[m]
+		
+		m.following = "recovery"
+		m.act = 0
+		self.recovery.add(m, pm.phase.day)
+		
+		if pm.rng.uniform(0, 1) < pm.srv.prob_recovery_request:
+			pm.recovery.schedule(pm.phase.day + pm.rng.randint(1, pm.srv.max_recovery_request_delay), m)
+	
+	# Take a piece of mail out of the recovery bin and put it back in circulation from this PO. If its recipient moved away and left no
+	# forwarding order, it would only be filed again, so it is handed back to its sender instead and leaves circulation. Returns True if
+	# the mail was put back in circulation.
+	def recover(self, m):
+		self.recovery.remove(m)
+		m.following = None
+		
+		if m.addressed is not m.recipient.house and self.pm.forwarding.get(m.recipient, m.addressed) is None:
+			del m.sender.in_transit[m]
+			return False
+		
+		m.act = 0
+		m.is_auto = True
+		self.pm.post[m] = None
+		self.post[m] = None
+		return True
+	
+	# mail.handle() calls this function on towns which it detects have made a mistake. This adds the notification (a NOTE_* code, see
+	# notices.py) to the notice board, count times.
+	def notify(self, notifier, code, arg=None, count=1):
+		self.notes.post(notifier, code, arg, count)
+		self.pm.stats.count("notifications", count)
+		
+	# Decides whether a piece of mail that arrived at this player-controlled PO should be moved to the player's queue.
+	# Mail accepted as new mail is counted towards the new mail quota.
+	def queue_accepts(self, is_story, age):
+		# Story items always go to the player's queue.
+		if is_story:
+			return True
+		
+		# If the mail limit is not met...
+		if len(self.player_queue) < self.pm.srv.mail_limit:
+			# If this mail is new and the new mail quota is not met, accept it
+			if age == 0 and self.new_mail_in_pq < self.pm.srv.new_mail_quota:
+				self.new_mail_in_pq += 1
+				return True
+			
+			# If the mail quota is not met, accept it.
+			if len(self.player_queue) < self.pm.srv.mail_quota:
+				return True
+		
+		return False
+	
+	# Gets the number of brand-new pieces of mail this PO's player queue will accept before the new mail quota and the mail quota are met.
+	def new_mail_wanted(self):
+		queue_len = len(self.player_queue)
+		new_mail = self.new_mail_in_pq
+		wanted = 0
+		
+		# Follows the rules of queue_accepts for mail of age 0.
+		while queue_len < self.pm.srv.mail_limit and (new_mail < self.pm.srv.new_mail_quota or queue_len < self.pm.srv.mail_quota):
+			if new_mail < self.pm.srv.new_mail_quota:
+				new_mail += 1
+			
+			queue_len += 1
+			wanted += 1
 		
-	# Get the oldest note in the notes queue and remove it.
+		return wanted
+	
+	# Get the oldest note in the notes queue and remove it, as (notifier, text).
 	def pop_note(self):
-		n = self.notes[0]
-		del self.notes[0]
-		return n[0], n[1]
+		notifier, code, arg, count = self.notes.pop()
+		return notifier, render_note(self.pm.strings, code, arg, count)
 	
 	# Display the town name, zip, and population, all streets, all houses, and all senders.
 	def debug(self):
@@ -342,148 +843,218 @@ class town:
 				for r in h.senders:
 					print("      %s %s" % (r.first_name, r.last_name))
 	
-	def get_address(self):
+	def build_address(self):
 		return self.name + ", " + str(self.zip_code)
 
 # Represents a street, which contains houses which contain senders
-class street:
-	# Initialize street. Constructor is passed the postman instance.
-	def __init__(self, pm, pop_mul, town):
-		self.town = town
+class street(addressable):
+	__slots__ = ("town", "name", "houses")
+	
+	# Highest house number on a street. House numbers range from 1 to this.
+	max_house_number = 55
+	
+	# Initialize street. Constructor is passed the postman instance and the street's name, which must be unique within the town.
+	def __init__(self, pm, pop_mul, town, name):
+		self.invalidate_address()
 		
-		# Get unique random street name from street name list
-		do_gen_name = True
-		while do_gen_name:
-			self.name = random.choice(pm.street_names)
-			
-			do_gen_name = False
-			for s in town.streets:
-				if self.name == s.name:
-					do_gen_name = True
-					break
+		self.town = town
+		self.name = name
 		
 		self.houses = []
-		num_houses = max(2, round(random.gauss(8, 1.3) * (pm.settings.world_gen.town_size_mul*pop_mul)**(1/3)))
-		for i in range(num_houses):
-			self.houses.append(house(pm, pop_mul, town, self))
+		num_houses = max(2, round(pm.rng.gauss(8, 1.3) * (pm.settings.world_gen.town_size_mul*pop_mul)**(1/3)))
+		if num_houses > street.max_house_number:
+			print("Not enough house numbers for %d houses on %s; Number of houses does not reflect settings." % (num_houses, self.name))
+			num_houses = street.max_house_number
+		
+		# Draw unique house numbers without replacement
+		for number in pm.rng.sample(range(1, street.max_house_number + 1), num_houses):
+			self.houses.append(house(pm, pop_mul, town, self, number))
 		
 		# Sort houses by numbers
 		self.houses.sort(key = lambda a: a.number)
 	
-	def get_address(self):
+	def build_address(self):
 		return self.name + "\n" + self.town.get_address()
 
 # Represents a house, which contains senders. Each house has a small chance of being generated vacant.
-class house:
-	def __init__(self, pm, pop_mul, town, street):
+class house(addressable):
+	__slots__ = ("street", "number", "post", "senders")
+	
+	# Initialize house. number is the street address, which must be unique within the street.
+	def __init__(self, pm, pop_mul, town, street, number):
+		self.invalidate_address()
+		
 		self.street = street
+		self.number = number
 		
-		# Get a unique random number for the street address
-		do_gen_num = True
-		while do_gen_num:
-			self.number = random.randint(1, 55)
-			
-			do_gen_num = False
-			for h in street.houses:
-				if h.number == self.number:
-					do_gen_num = True
-					break
+		# Mail currently at this house. Used as an ordered set (values are unused) and kept up to date by mail.advance.
+		self.post = {}
 		
 		self.senders = []
-		if random.uniform(0, 1) > 0.05:
-			num_senders = max(1, round(random.gauss(2, 0.3) * (pm.settings.world_gen.town_size_mul*pop_mul)**(1/3)))
+		if pm.rng.uniform(0, 1) > 0.05:
+			num_senders = max(1, round(pm.rng.gauss(2, 0.3) * (pm.settings.world_gen.town_size_mul*pop_mul)**(1/3)))
 			for i in range(num_senders):
 				self.senders.append(sender(pm, pop_mul, town, self))
 	
-	def get_address(self):
+	def build_address(self):
 		return str(self.number) + " " + self.street.get_address()
 	
 	# Houses ignore notifications
-	def notify(self, notifier, text):
+	def notify(self, notifier, code, arg=None, count=1):
 		pass
 
+# Remembers who a sender has recently received mail from, so that they can reply. Holds the IDs of the last few correspondents (their index
+# in postman.senders) and the day each letter was delivered, in a ring buffer of fixed size, so memory per sender stays constant however
+# long the world runs. Entries older than the reply window are dropped when the memory is read.
+class reply_memory:
+	__slots__ = ("entries", "start", "size")
+	
+	def __init__(self, capacity):
+		# Pairs of (sender ID, day), oldest first starting at start.
+		self.entries = array("i", bytes(8 * capacity))
+		self.start = 0
+		self.size = 0
+	
+	def __len__(self):
+		return self.size
+	
+	# Remember a letter from the sender with the given ID, delivered on the given day. Forgets the oldest letter if full.
+	def add(self, ID, day):
+		capacity = len(self.entries) // 2
+		if capacity == 0:
+			return
+		
+		i = (self.start + self.size) % capacity
+		self.entries[2 * i] = ID
+		self.entries[2 * i + 1] = day
+		
+		if self.size < capacity:
+			self.size += 1
+		else:
+			self.start = (self.start + 1) % capacity
+	
+	# Forget every letter delivered window or more days before day, and return how many are left.
+	def recent(self, day, window):
+		capacity = len(self.entries) // 2
+		while self.size > 0 and day - self.entries[2 * self.start + 1] >= window:
+			self.start = (self.start + 1) % capacity
+			self.size -= 1
+		
+		return self.size
+	
+	# Gets the ID of the i-th remembered correspondent, oldest first.
+	def get(self, i):
+		return self.entries[2 * ((self.start + i) % (len(self.entries) // 2))]
+	
+	# Gets every remembered (sender ID, day), oldest first.
+	def items(self):
+		return [(self.get(i), self.entries[2 * ((self.start + i) % (len(self.entries) // 2)) + 1]) for i in range(self.size)]
+
 # Represents a sender
-class sender:
+class sender(addressable):
+	__slots__ = ("pm", "ID", "town", "house", "recv_from", "in_transit", "first_name", "last_name")
+	
 	def __init__(self, pm, pop_mul, town, house):
+		self.invalidate_address()
+		
 		self.pm = pm
 		self.town = town
 		self.house = house
 		
-		# Update Citizenship
+		# Update Citizenship. The sender's ID is their index in pm.senders.
+		self.ID = len(pm.senders)
 		town.citizens.append(self)
 		pm.senders.append(self)
 		
-		# Initialize list to hold recent senders that mail has been received from.
-		self.recv_from = []
+		# Recent senders that mail has been received from.
+		self.recv_from = reply_memory(pm.srv.reply_memory_size)
 		
-		# Initialize list of mail from this sender that the sender believes to be in transit.
-		self.in_transit = []
+		# Initialize collection of mail from this sender that the sender believes to be in transit. Used as an ordered set (values are unused).
+		self.in_transit = {}
 		
-		self.first_name = random.choice(pm.first_names)
-		self.last_name = random.choice(pm.last_names)
+		self.first_name = pm.rng.choice(pm.first_names)
+		self.last_name = pm.rng.choice(pm.last_names)
 	
-	# Gets this sender's address as a string.
-	def get_address(self):
+	def build_address(self):
 		return self.first_name + " " + self.last_name + "\n" + self.house.get_address()
 	
-	# Adds a piece of mail to this sender's list. The sender is notified 1-5 days after delivery that the mail is delivered, at which point it is removed.
-	# If a sender has not been notified for a while, they are liable to submit requests to locate mail.
-	def add_mail(self, mail):
-		self.in_transit.append(mail)
-
-# One instance of this class is held by each mail item. Its values are set by calling mail.handle and it describes what should be done to this piece of mail at the end of the day
-# and if it has any errors.
-class mail_action:
-	def __init__(self):
-		self.reset()
-	
-	def reset(self):
-		# If this mail was routed in error.
-		self.routing_error = False
+	# Moves this sender into another house, updating citizenship and the cached address.
+	def set_house(self, house):
+		self.house.senders.remove(self)
+		house.senders.append(self)
 		
-		# If this mail was delivered to the wrong address.
-		self.delivery_error = False
+		old_town = self.town
+		if house.street.town is not self.town:
+			self.town.citizens.remove(self)
+			house.street.town.citizens.append(self)
 		
-		# If this mail was delivered to a PO damaged.
-		self.routed_damaged = False
+		self.house = house
+		self.town = house.street.town
+		self.invalidate_address()
 		
-		# If this mail was delivered damaged.
-		self.delivered_damaged = False
+		if self.pm.addresses is not None:
+			self.pm.addresses.move(self, old_town)
 		
-		self.following = None
+		if self.pm.store is not None:
+			self.pm.store.move_sender(self)
+	
+	# Adds a piece of mail to this sender's list. The sender is notified 1-5 days after delivery that the mail is delivered, at which point it is removed.
+	# If a sender has not been notified for a while, they are liable to submit requests to locate mail.
+	def add_mail(self, mail):
+		self.in_transit[mail] = None
+
+# Flags describing what mail.handle decided should happen to a piece of mail at the end of the day, and if it has any errors. Stored in mail.act.
+# If this mail was routed in error.
+ACT_ROUTING_ERROR = 1
+
+# If this mail was delivered to the wrong address.
+ACT_DELIVERY_ERROR = 2
+
+# If this mail was delivered to a PO damaged.
+ACT_ROUTED_DAMAGED = 4
+
+# If this mail was delivered damaged.
+ACT_DELIVERED_DAMAGED = 8
 
 # Represents a piece of mail.
+# Mail is the most numerous object in the game, so it uses __slots__ and derives its addresses from the sender and recipient instead of storing copies.
 class mail:
+	__slots__ = ("sender", "recipient", "addressed", "ID", "is_story", "act", "following", "stamp", "damage_lvl", "repair_lvl", "is_auto", "previous", "current", "age")
+	
 	# Randomly creates a piece of mail from the sender to the recipient. is_story should be set to None if it is not story mail or to the name of the story mail item to send.
-	def __init__(self, pm, sender, recipient, is_story):
+	# rolls optionally gives the three random numbers in [0, 1) used for the postage and damage rolls, for callers that draw them in bulk.
+	def __init__(self, pm, sender, recipient, is_story, rolls=None):
 		self.sender = sender
 		self.recipient = recipient
 		
-		self.srce_zip = sender.town.zip_code
-		self.dest_zip = recipient.town.zip_code
+		# The house the mail is addressed to. It stays the same if the recipient moves, until a post office forwards the mail.
+		self.addressed = recipient.house
 		
 		self.ID = pm.get_mail_ID()
 		
-		self.srce = sender.get_address()
-		self.dest = recipient.get_address()
-		
 		self.is_story = is_story
 		
-		self.act = mail_action()
+		# Action flags (ACT_*) and next location, set by mail.handle.
+		self.act = 0
+		self.following = None
+		
+		if rolls is None:
+			rolls = (pm.rng.uniform(0, 1), pm.rng.uniform(0, 1), pm.rng.uniform(0, 1))
 		
 		# Mail has a random chance of not having due postage
-		if random.uniform(0, 1) < pm.srv.prob_sender_shortpays:
-			if self.srce_zip != self.dest_zip and random.uniform(0, 1) < 0.5:
+		is_local = sender.town is recipient.town
+		if rolls[0] < pm.srv.prob_sender_shortpays:
+			if not is_local and rolls[1] < 0.5:
 				self.stamp = 1
 			else:
 				self.stamp = 0
-		elif self.srce_zip != self.dest_zip:
+		elif not is_local:
 			self.stamp = 2
 		else:
 			self.stamp = 1
 		
 		# Some mail randomly generates with 1 level of damage
-		if random.uniform(0, 1) < pm.srv.prob_sender_damages_mail:
+		if rolls[2] < pm.srv.prob_sender_damages_mail:
 			self.damage_lvl = 1
 		else:
 			self.damage_lvl = 0
@@ -496,87 +1067,179 @@ class mail:
 		# Where the letter was last, where it is now, and where it will be on the next day.
 		self.previous = sender.house
 		self.current = sender.town
+		self.current.post[self] = None
 		
 		# Tracks a piece of mail's age. Incremented by mail.advance()
 		self.age = 0
 	
+	# The sender's and recipient's addresses and zip codes, as written on the mail.
+	@property
+	def srce(self):
+		return self.sender.get_address()
+	
+	@property
+	def dest(self):
+		if self.addressed is self.recipient.house:
+			return self.recipient.get_address()
+		
+		return self.recipient.first_name + " " + self.recipient.last_name + "\n" + self.addressed.get_address()
+	
+	@property
+	def srce_zip(self):
+		return self.sender.town.zip_code
+	
+	@property
+	def dest_zip(self):
+		return self.addressed.street.town.zip_code
+	
+	# Gets the recipient's address as written on the mail, on a single line.
+	def get_dest_line(self):
+		if self.addressed is self.recipient.house:
+			return self.recipient.get_address_line()
+		
+		return self.recipient.first_name + " " + self.recipient.last_name + ", " + self.addressed.get_address_line()
+	
+	# Recreates a piece of mail from its stored state without rolling any of its random properties, and adds it to the post.
+	# Used to materialize mail held outside of mail objects, such as in the columnar mail store.
+	def rebuild(pm, sender, recipient, addressed, ID, stamp, damage_lvl, repair_lvl, previous, current, age):
+		m = mail.__new__(mail)
+		
+		m.sender = sender
+		m.recipient = recipient
+		m.addressed = addressed
+		
+		m.ID = ID
+		
+		m.is_story = False
+		
+		m.act = 0
+		m.following = None
+		
+		m.stamp = stamp
+		m.damage_lvl = damage_lvl
+		m.repair_lvl = repair_lvl
+		
+		m.is_auto = True
+		
+		m.previous = previous
+		m.current = current
+		m.current.post[m] = None
+		
+		m.age = age
+		
+		pm.post[m] = None
+		sender.add_mail(m)
+		
+		return m
+	
 	# Set self.act based on what should be done when advancing this mail.
+	# Returns True if the mail has reached its recipient. The caller is responsible for calling deliver() on it, which is safe to do once it is done iterating over the post.
 	def handle(self):
-		# Reset the action object.
-		self.act.reset()
+		# Reset the action.
+		self.act = 0
+		self.following = None
 		
 		# If mail is at a house...
 		if type(self.current) is house:
 			# Houses notify of damaged mail.
 			if self.damage_lvl > self.repair_lvl:
-				self.act.delivered_damaged = True
+				self.act |= ACT_DELIVERED_DAMAGED
 				
 			# If mail is at the wrong house...
 			if self.current != self.recipient.house:
-				# Send to post office & notify
-				self.act.following = self.current.street.town
-				self.act.delivery_error = True
+				# Send to post office. Mail at the house it is addressed to was delivered correctly, but the recipient moved out, so the post
+				# office forwards it without being notified of an error.
+				self.following = self.current.street.town
+				if self.current is not self.addressed:
+					self.act |= ACT_DELIVERY_ERROR
 				return False
 				
-			# Otherwise, remove mail from the system. The sender will be notified immeediately by the magic of programming.
+			# Otherwise, the mail is delivered.
 			else:
-				self.sender.in_transit.remove(self)
-				self.sender.pm.post.remove(self)
 				return True
 		
 		# Otherwise, mail is at a town.
 		else:
 			# Routers repair mail and notify senders.
 			if self.damage_lvl > self.repair_lvl:
-				self.act.routed_damaged = True
+				self.act |= ACT_ROUTED_DAMAGED
 			
 			# Mail has a small chance of being damaged by the router.
-			if random.uniform(0, 1) < self.sender.pm.srv.prob_router_damages_mail:
+			if self.sender.pm.rng.uniform(0, 1) < self.sender.pm.srv.prob_router_damages_mail:
 				self.damage()
+				self.sender.pm.stats.count("damage_events")
+			
+			# If the recipient moved out of the house the mail is addressed to, the post office of that town readdresses it to their new house,
+			# or puts it in the recovery bin if they left no forwarding order.
+			dest = self.addressed.street.town
+			if dest is self.current and self.addressed is not self.recipient.house:
+				pm = self.sender.pm
+				new_house = pm.forwarding.get(self.recipient, self.addressed)
+				if new_house is None:
+					self.following = "recovery"
+					pm.undeliverable.append(self)
+					return False
+				
+				self.addressed = new_house
+				dest = new_house.street.town
+				pm.stats.count("forwarded")
 			
 			# If mail is in the town of the destination, forward it to the correct home
-			if self.recipient.town.zip_code == self.current.zip_code:
-				self.act.following = self.recipient.house
+			if dest is self.current:
+				self.following = self.addressed
 				return False
 			
 			# Otherwise, route mail towards its destination
 			else:
-				# Otherwise, route the mail in the correct direction. Loop over neighbors until one is found that is nearer to the destination.
-				my_dis = self.sender.pm.routing[self.current.zip_code][self.recipient.town.zip_code]
-				for n in self.current.neighbors:
-					ne_dis = self.sender.pm.routing[n.zip_code][self.recipient.town.zip_code]
-					if ne_dis < my_dis:
-						self.act.following = n
-						
-						# If mail should be routed to the place that routed it to this PO, notify that the mail was sent to this PO in error.
-						if self.previous == self.act.following:
-							self.act.routing_error = True
-						
-						return False
+				# Look up the neighbor that is nearer to the destination.
+				self.following = self.sender.pm.routing.next_hop(self.current.zip_code, dest.zip_code)
+				
+				if self.following is not None:
+					# If mail should be routed to the place that routed it to this PO, notify that the mail was sent to this PO in error.
+					if self.previous == self.following:
+						self.act |= ACT_ROUTING_ERROR
+						self.sender.pm.stats.count("routing_errors")
+					
+					return False
 				
 			print("Could not route " + self.get_details())
 			return False
 	
+	# Remove this mail from the system. The sender will be notified immeediately by the magic of programming, and the recipient will remember
+	# who wrote to them.
+	def deliver(self):
+		self.recipient.recv_from.add(self.sender.ID, self.sender.pm.phase.day)
+		del self.sender.pm.post[self]
+		del self.sender.in_transit[self]
+		del self.current.post[self]
+	
 	# Move this mail-item towards its destination.
 	def advance(self):
-		if self.act.following is None:
+		if self.following is None:
 			print("Fatal, MI not routed: " + self.get_details())
 		
-		if self.act.delivery_error:
-			self.current.street.town.notify(self.current, "Mail routed to incorrect residence.")
+		if self.act & ACT_DELIVERY_ERROR:
+			self.current.street.town.notify(self.current, NOTE_INCORRECT_RESIDENCE)
 		
-		if self.act.routing_error:
-			self.act.following.notify(self.current, "Mail Routed in Error.")
+		if self.act & ACT_ROUTING_ERROR:
+			self.following.notify(self.current, NOTE_ROUTED_IN_ERROR)
 		
-		if self.act.delivered_damaged:
-			self.previous.notify(self.current, "Mail arrived to residence damaged.")
+		if self.act & ACT_DELIVERED_DAMAGED:
+			self.previous.notify(self.current, NOTE_DELIVERED_DAMAGED)
 		
-		if self.act.routed_damaged:
-			self.previous.notify(self.current, "Mail arrived to PO damaged.")
+		if self.act & ACT_ROUTED_DAMAGED:
+			self.previous.notify(self.current, NOTE_ROUTED_DAMAGED)
 			self.repair()
 			
+		del self.current.post[self]
+		self.following.post[self] = None
+		
 		self.previous = self.current
-		self.current = self.act.following
+		self.current = self.following
+		
+		# The mail must be handled again at its new location.
+		self.following = None
+		self.act = 0
 		
 		self.age += 1
 	
@@ -592,4 +1255,4 @@ class mail:
 	
 	# Gets a string representing this piece of mail
 	def get_details(self):
-		return "#%05d | %s -> %s | %d/%d | %d" % (self.ID, self.srce.replace("\n", ", "), self.dest.replace("\n", ", "), self.damage_lvl, self.repair_lvl, self.stamp)
\ No newline at end of file
+		return "#%05d | %s -> %s | %d/%d | %d" % (self.ID, self.sender.get_address_line(), self.get_dest_line(), self.damage_lvl, self.repair_lvl, self.stamp)
\ No newline at end of file
@@ -0,0 +1,257 @@
+import json
+
+from notices import *
+
+# This file implements the compact binary format used to stream a player's queue and notifications to a networked client.
+#
+# Each client session has one delta_encoder on the server and one delta_decoder on the client. Every update carries only what changed
+# since the previous update of the session:
+#   - strings (addresses, names, story text) the client hasn't seen yet. Every string is sent once per session and referred to by its
+#     index afterwards. Index 0 means "none".
+#   - the IDs of letters that left the queue
+#   - letters that joined the queue, or changed in it, with small integer fields
+#   - route acknowledgements: letters whose only change is where they will be sent next
+#   - the queue order, only if it isn't the old order followed by the new letters
+#   - notifications, as codes (see notices.py) with their counts and arguments. The client renders their text in its own language.
+#
+# All integers are unsigned LEB128 varints. An update is laid out as:
+#   day
+#   count, then each new string as its UTF-8 length and bytes
+#   count, then the ID of each removed letter
+#   count, then each added or changed letter as
+#       ID, sender, recipient, story (string indices), packed byte (damage in bits 0-1, repair in bits 2-3, stamp in bits 4-7), age,
+#       following (string index of the place's address, or 0 if not yet routed)
+#   count, then each route acknowledgement as ID, following
+#   0, or 1 followed by the count and IDs of the whole queue in order
+#   count, then each notification as code, notifier (string index), count, and argument plus one (0 if it has none)
+
+def write_varint(buf, n):
+	while n >= 0x80:
+		buf.append((n & 0x7f) | 0x80)
+		n >>= 7
+	buf.append(n)
+
+def read_varint(data, pos):
+	n = 0
+	shift = 0
+	while True:
+		b = data[pos]
+		pos += 1
+		n |= (b & 0x7f) << shift
+		if b < 0x80:
+			return n, pos
+		shift += 7
+
+# Gets the address of the place a letter will be sent to next, or None if it hasn't been routed.
+def following_address(m):
+	if m.following is None:
+		return None
+	if m.following == "recovery":
+		return "recovery"
+
+	return m.following.get_address_line()
+
+# Streams the state of one player's post office. Create one per client session.
+class delta_encoder:
+	def __init__(self):
+		# Index of every string sent so far. Index 0 is reserved for "none".
+		self.string_index = {}
+
+		# Queue the client has, as a record per letter ID and the order of the IDs.
+		self.queue = {}
+		self.order = []
+
+	def intern(self, s, new_strings):
+		if s is None or s is False:
+			return 0
+
+		i = self.string_index.get(s)
+		if i is None:
+			i = len(self.string_index) + 1
+			self.string_index[s] = i
+			new_strings.append(s)
+
+		return i
+
+	# Encode everything that changed at the town since the last update, and return it as bytes. The town's notifications are sent and
+	# removed from it, as the command line interface does when it shows them.
+	def encode(self, town, day):
+		new_strings = []
+
+		# Records of the letters now in the queue.
+		queue = {}
+		order = []
+		for m in town.player_queue:
+			queue[m.ID] = (self.intern(m.sender.get_address_line(), new_strings), self.intern(m.get_dest_line(), new_strings), self.intern(m.is_story, new_strings), m.damage_lvl | m.repair_lvl << 2 | m.stamp << 4, m.age, self.intern(following_address(m), new_strings))
+			order.append(m.ID)
+
+		removed = [ID for ID in self.order if ID not in queue]
+		changed = []
+		acks = []
+		for ID in order:
+			old = self.queue.get(ID)
+			if old is None:
+				changed.append(ID)
+			elif old != queue[ID]:
+				if old[:5] == queue[ID][:5]:
+					acks.append(ID)
+				else:
+					changed.append(ID)
+
+		notes = []
+		for notifier, code, arg, count in town.notes:
+			notes.append((code, self.intern(notifier.get_address_line(), new_strings), count, 0 if arg is None else arg + 1))
+
+		town.notes.clear()
+
+		buf = bytearray()
+		write_varint(buf, day)
+
+		write_varint(buf, len(new_strings))
+		for s in new_strings:
+			raw = s.encode("utf-8")
+			write_varint(buf, len(raw))
+			buf += raw
+
+		write_varint(buf, len(removed))
+		for ID in removed:
+			write_varint(buf, ID)
+
+		write_varint(buf, len(changed))
+		for ID in changed:
+			write_varint(buf, ID)
+			for field in queue[ID]:
+				write_varint(buf, field)
+
+		write_varint(buf, len(acks))
+		for ID in acks:
+			write_varint(buf, ID)
+			write_varint(buf, queue[ID][5])
+
+		# The client assumes the letters it kept stay in order, followed by the new ones.
+		kept = [ID for ID in self.order if ID in queue]
+		new = [ID for ID in order if ID not in self.queue]
+		if kept + new == order:
+			buf.append(0)
+		else:
+			buf.append(1)
+			write_varint(buf, len(order))
+			for ID in order:
+				write_varint(buf, ID)
+
+		write_varint(buf, len(notes))
+		for note in notes:
+			for field in note:
+				write_varint(buf, field)
+
+		self.queue = queue
+		self.order = order
+		return bytes(buf)
+
+# A letter in the queue as the client knows it.
+class queued_mail:
+	__slots__ = ("ID", "sender", "recipient", "story", "damage_lvl", "repair_lvl", "stamp", "age", "following")
+
+	def __eq__(self, other):
+		return all(getattr(self, a) == getattr(other, a) for a in queued_mail.__slots__)
+
+	# Gets a string representing this piece of mail, as mail.get_details does.
+	def get_details(self):
+		return "#%05d | %s -> %s | %d/%d | %d" % (self.ID, self.sender, self.recipient, self.damage_lvl, self.repair_lvl, self.stamp)
+
+# Rebuilds the state of a player's post office from the updates of a delta_encoder.
+class delta_decoder:
+	def __init__(self):
+		self.strings = [None]
+
+		self.day = 0
+		self.queue = {}
+		self.order = []
+
+		# Notifications received in the last update, as (notifier address, code, arg, count). See notices.render_note for their text.
+		self.notes = []
+
+		# IDs of the letters whose route was acknowledged in the last update.
+		self.acks = []
+
+	# Apply an update. Afterwards, the queue in order is [self.queue[ID] for ID in self.order].
+	def decode(self, data):
+		pos = 0
+		self.day, pos = read_varint(data, pos)
+
+		count, pos = read_varint(data, pos)
+		for i in range(count):
+			size, pos = read_varint(data, pos)
+			self.strings.append(bytes(data[pos:pos + size]).decode("utf-8"))
+			pos += size
+
+		count, pos = read_varint(data, pos)
+		removed = set()
+		for i in range(count):
+			ID, pos = read_varint(data, pos)
+			removed.add(ID)
+			del self.queue[ID]
+
+		count, pos = read_varint(data, pos)
+		new = []
+		for i in range(count):
+			ID, pos = read_varint(data, pos)
+			m = queued_mail()
+			m.ID = ID
+			sender, pos = read_varint(data, pos)
+			recipient, pos = read_varint(data, pos)
+			story, pos = read_varint(data, pos)
+			packed, pos = read_varint(data, pos)
+			m.age, pos = read_varint(data, pos)
+			following, pos = read_varint(data, pos)
+
+			m.sender = self.strings[sender]
+			m.recipient = self.strings[recipient]
+			m.story = self.strings[story]
+			m.damage_lvl = packed & 3
+			m.repair_lvl = packed >> 2 & 3
+			m.stamp = packed >> 4
+			m.following = self.strings[following]
+
+			if ID not in self.queue:
+				new.append(ID)
+			self.queue[ID] = m
+
+		count, pos = read_varint(data, pos)
+		self.acks = []
+		for i in range(count):
+			ID, pos = read_varint(data, pos)
+			following, pos = read_varint(data, pos)
+			self.queue[ID].following = self.strings[following]
+			self.acks.append(ID)
+
+		if data[pos] == 0:
+			pos += 1
+			self.order = [ID for ID in self.order if ID not in removed] + new
+		else:
+			count, pos = read_varint(data, pos + 1)
+			self.order = []
+			for i in range(count):
+				ID, pos = read_varint(data, pos)
+				self.order.append(ID)
+
+		count, pos = read_varint(data, pos)
+		self.notes = []
+		for i in range(count):
+			code, pos = read_varint(data, pos)
+			notifier, pos = read_varint(data, pos)
+			num, pos = read_varint(data, pos)
+			arg, pos = read_varint(data, pos)
+			self.notes.append((self.strings[notifier], code, None if arg == 0 else arg - 1, num))
+
+		return pos
+
+# Encode the same state as a delta_encoder update, the way a JSON interface would: the whole queue, formatted, every time, and the
+# notifications rendered in the language of strings.
+def encode_json(town, day, strings):
+	state = {
+		"day": day,
+		"queue": [{"ID": m.ID, "details": m.get_details(), "story": m.is_story, "age": m.age, "following": following_address(m)} for m in town.player_queue],
+		"notes": [{"from": notifier.get_address_line(), "text": render_note(strings, code, arg, count)} for notifier, code, arg, count in town.notes],
+	}
+	return json.dumps(state).encode("utf-8")
@@ -0,0 +1,84 @@
+from postman_classes import *
+from protocol import *
+
+# Round trip test of the delta protocol: a player's queue and notifications are changed in every way an update carries, encoded, and the
+# decoded state is checked against the town after each update.
+
+# Encode an update for the town, decode it, and check that the decoder holds the same queue and notifications as the town. Returns the update.
+def round_trip(enc, dec, t, day):
+	notes = list(t.notes)
+	data = enc.encode(t, day)
+	assert dec.decode(data) == len(data)
+
+	assert dec.day == day
+	assert dec.order == [m.ID for m in t.player_queue]
+	assert sorted(dec.queue) == sorted(dec.order)
+	for m in t.player_queue:
+		q = dec.queue[m.ID]
+		assert (q.sender, q.recipient, q.story, q.damage_lvl, q.repair_lvl, q.stamp, q.age, q.following) == (m.sender.get_address_line(), m.get_dest_line(), m.is_story or None, m.damage_lvl, m.repair_lvl, m.stamp, m.age, following_address(m)), m.get_details()
+
+	assert dec.notes == [(notifier.get_address_line(), code, arg, count) for notifier, code, arg, count in notes]
+	assert len(t.notes) == 0
+	return data
+
+pm = postman("postman_campaign", 1)
+pm.gen_map()
+t = pm.set_player_towns(1)[0]
+pm.gen_mail_batch(200)
+
+letters = list(pm.post)
+houses = [h for s in t.streets for h in s.houses]
+enc = delta_encoder()
+dec = delta_decoder()
+
+# Every letter is new.
+t.player_queue = letters[:20]
+round_trip(enc, dec, t, 1)
+assert dec.acks == []
+
+# Letters are removed, changed, routed and added, and notifications are sent with and without arguments.
+for m in t.player_queue[:3]:
+	t.player_queue.remove(m)
+
+changed = t.player_queue[:4]
+changed[0].damage_lvl = 3
+changed[1].repair_lvl = 1
+changed[2].stamp = 0
+changed[3].age += 1
+changed[3].following = houses[0]
+
+acked = t.player_queue[4:7]
+acked[0].following = t.neighbors[0]
+acked[1].following = houses[-1]
+acked[2].following = "recovery"
+
+t.player_queue += letters[20:25]
+
+t.notify(t, NOTE_LEFTOVER, 12)
+t.notify(t, NOTE_LEFTOVER, 0)
+t.notify(t.neighbors[0], NOTE_ROUTED_IN_ERROR, None, 3)
+t.notify(houses[0], NOTE_INCORRECT_RESIDENCE)
+round_trip(enc, dec, t, 2)
+assert dec.acks == [m.ID for m in acked]
+
+# The queue is reordered, and routes are changed and taken back.
+t.player_queue.reverse()
+t.player_queue.remove(acked[0])
+acked[1].following = t.neighbors[-1]
+acked[2].following = None
+round_trip(enc, dec, t, 3)
+assert dec.acks == [acked[2].ID, acked[1].ID]
+
+# Nothing changed.
+data = round_trip(enc, dec, t, 4)
+assert dec.acks == [] and dec.notes == []
+assert len(data) == 7
+
+# A letter that left the queue comes back, and the queue is emptied.
+t.player_queue.insert(0, acked[0])
+round_trip(enc, dec, t, 5)
+t.player_queue = []
+round_trip(enc, dec, t, 6)
+assert dec.queue == {}
+
+print("Delta protocol round trip OK")
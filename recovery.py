@@ -0,0 +1,136 @@
+import heapq
+from collections import deque
+
+# This file implements mail recovery: the recovery bin of each post office, which holds mail that couldn't be delivered or returned, and
+# the recovery requests senders submit to find their lost mail.
+#
+# A request starts at the sender's post office. Each day, the office it is at looks the letter up in its own bin, and if the letter isn't
+# there, forwards the request to the next office on the letter's route, until the letter is found or the request reaches the town the letter
+# is addressed to. Bins are indexed by mail ID, so each office only checks the few letters sharing the requested ID and no request ever
+# scans a bin.
+
+# The recovery bin of a post office.
+class recovery_bin:
+	def __init__(self):
+		# The entry of filed of each piece of mail in the bin, keyed on the mail itself since mail IDs wrap and aren't unique. Mail that
+		# was taken out and filed again has an older entry in filed.
+		self.entries = {}
+
+		# The mail in the bin with each ID, for requests, which only know the ID, sender and recipient. The inner dicts are used as
+		# ordered sets (values are unused).
+		self.by_ID = {}
+
+		# (day filed, mail) in the order mail was filed, for eviction. Mail taken out of the bin is left here until evicted.
+		self.filed = deque()
+
+	def __len__(self):
+		return len(self.entries)
+
+	# Add a piece of mail to the bin, filed on the given day.
+	def add(self, m, day):
+		entry = (day, m)
+		self.filed.append(entry)
+		self.entries[m] = entry
+		self.by_ID.setdefault(m.ID, {})[m] = None
+
+	# Take a piece of mail out of the bin.
+	def remove(self, m):
+		del self.entries[m]
+
+		same_ID = self.by_ID[m.ID]
+		del same_ID[m]
+		if len(same_ID) == 0:
+			del self.by_ID[m.ID]
+
+	# Gets the mail with the given ID, or None if it isn't in the bin. If sender or recipient are given, the mail must match them.
+	def find(self, ID, sender=None, recipient=None):
+		for m in self.by_ID.get(ID, ()):
+			if (sender is None or m.sender is sender) and (recipient is None or m.recipient is recipient):
+				return m
+
+		return None
+
+	# Take every piece of mail filed keep_days or more days before day out of the bin, and return them.
+	def evict(self, day, keep_days):
+		evicted = []
+		while len(self.filed) > 0 and day - self.filed[0][0] >= keep_days:
+			entry = self.filed.popleft()
+			m = entry[1]
+			if self.entries.get(m) is entry:
+				self.remove(m)
+				evicted.append(m)
+
+		return evicted
+
+	# Gets every (day filed, mail) still in the bin, oldest first.
+	def items(self):
+		return [entry for entry in self.filed if self.entries.get(entry[1]) is entry]
+
+# A sender's request to find a lost letter, making its way from office to office.
+class recovery_request:
+	__slots__ = ("sender", "recipient", "ID", "dest", "town", "day")
+
+	def __init__(self, sender, recipient, ID, dest, town, day):
+		self.sender = sender
+		self.recipient = recipient
+		self.ID = ID
+
+		# The town the letter is addressed to, which may not be the recipient's since they moved. The request follows the letter's route there.
+		self.dest = dest
+
+		# The office the request is at, and the day it was submitted.
+		self.town = town
+		self.day = day
+
+# Handles the recovery requests of a world. Every postman has one in postman.recovery.
+class recovery_desk:
+	def __init__(self):
+		# Requests making their way through the network.
+		self.requests = []
+
+		# Heap of (day, sequence number, mail): letters whose senders will ask for them on that day if they are still lost.
+		self.due = []
+		self.next_seq = 0
+
+	# Have the sender of a letter just filed in a recovery bin ask for it on the given day.
+	def schedule(self, day, m):
+		heapq.heappush(self.due, (day, self.next_seq, m))
+		self.next_seq += 1
+
+	# Submit a request for a letter at the sender's post office.
+	def submit(self, m, day):
+		self.requests.append(recovery_request(m.sender, m.recipient, m.ID, m.addressed.street.town, m.sender.town, day))
+
+	# Submit the requests due by the given day for letters still in a bin, then handle every request for one day: each is looked up at
+	# its office, and forwarded one office along the letter's route if the letter isn't there. Returns the letters found, with the office
+	# that found them, and the number of requests that reached the town their letter is addressed to without finding it.
+	def handle(self, pm, day):
+		while len(self.due) > 0 and self.due[0][0] <= day:
+			due_day, seq, m = heapq.heappop(self.due)
+			if m.following == "recovery":
+				self.submit(m, day)
+
+		found = []
+		num_failed = 0
+		pending = []
+		for req in self.requests:
+			m = req.town.recovery.find(req.ID, req.sender, req.recipient)
+			if m is not None:
+				found.append((m, req.town))
+				continue
+
+			dest = req.dest
+			if req.town is dest:
+				num_failed += 1
+				continue
+
+			next_town = pm.routing.next_hop(req.town.zip_code, dest.zip_code)
+			if next_town is None:
+				num_failed += 1
+				continue
+
+			req.town = next_town
+			pending.append(req)
+
+		self.requests = pending
+		return found, num_failed
@@ -0,0 +1,215 @@
+from array import array
+from bisect import bisect_right
+from collections import deque
+
+# This file implements the routing backends used by post offices to decide where mail should be forwarded.
+# Every backend answers two queries by zip code: next_hop(current, destination), which gives the neighboring town mail should be forwarded to
+# (or None if the two are the same town or unreachable from each other), and distance(a, b), which gives the number of hops between two towns.
+
+# Dense all-pairs routing table. Works on any network shape, but memory grows with the square of the number of towns.
+class routing_table:
+	def __init__(self, towns):
+		# Hop count between every pair of towns, as a dict of dicts keyed by zip code.
+		self.dist = {}
+
+		# Neighboring town to forward to, as a dict of dicts keyed by current zip, then destination zip.
+		self.hops = {}
+
+		# One breadth-first search per town. The first hop of each town reached is inherited from the town it was reached through.
+		for a in towns:
+			dist = {a.zip_code: 0}
+			first_hop = {}
+			hops = {}
+
+			visited = {a}
+			edge = deque([a])
+
+			while len(edge) > 0:
+				cur = edge.popleft()
+				for n in cur.neighbors:
+					if n in visited:
+						continue
+
+					visited.add(n)
+					dist[n.zip_code] = dist[cur.zip_code] + 1
+					first_hop[n.zip_code] = n if cur is a else first_hop[cur.zip_code]
+					hops[n.zip_code] = first_hop[n.zip_code]
+
+					edge.append(n)
+
+			self.dist[a.zip_code] = dist
+			self.hops[a.zip_code] = hops
+
+	def next_hop(self, cur_zip, dest_zip):
+		hops = self.hops.get(cur_zip)
+		if hops is None:
+			return None
+
+		return hops.get(dest_zip)
+
+	def distance(self, a_zip, b_zip):
+		return self.dist[a_zip][b_zip]
+
+# Routing for networks that are trees, which the postal network always is. The tree is rooted once at the first town. Distances are answered
+# with binary lifting, and next hops with the order towns are entered and left in a depth-first walk of the tree, over compact arrays, so
+# memory is O(T log T) instead of O(T^2).
+class routing_tree:
+	def __init__(self, towns):
+		if not routing_tree.is_tree(towns):
+			raise ValueError("The postal network is not a tree; use the routing table instead.")
+
+		self.towns = list(towns)
+
+		# Maps each zip code to the town's index in the arrays below.
+		self.index = {}
+		for i in range(len(self.towns)):
+			self.index[self.towns[i].zip_code] = i
+
+		num_towns = len(self.towns)
+
+		# Depth of each town below the root, and its parent. The root is its own parent.
+		self.depth = array("i", bytes(4 * num_towns))
+		parent = array("i", bytes(4 * num_towns))
+
+		if num_towns > 0:
+			visited = bytearray(num_towns)
+			visited[0] = 1
+			edge = deque([0])
+
+			while len(edge) > 0:
+				cur = edge.popleft()
+				for n in self.towns[cur].neighbors:
+					n_i = self.index[n.zip_code]
+					if visited[n_i]:
+						continue
+
+					visited[n_i] = 1
+					parent[n_i] = cur
+					self.depth[n_i] = self.depth[cur] + 1
+					edge.append(n_i)
+
+		# self.up[k][v] is the 2^k-th ancestor of town v, saturating at the root.
+		self.up = [parent]
+		for k in range(1, max(1, (num_towns - 1).bit_length())):
+			prev = self.up[-1]
+			self.up.append(array("i", [prev[prev[v]] for v in range(num_towns)]))
+
+		self.walk()
+
+	# Creates the router from arrays saved from another router over the same towns, without searching the network again.
+	def from_arrays(towns, depth, up):
+		rt = routing_tree.__new__(routing_tree)
+		rt.towns = list(towns)
+
+		rt.index = {}
+		for i in range(len(rt.towns)):
+			rt.index[rt.towns[i].zip_code] = i
+
+		rt.depth = array("i", depth)
+		rt.up = [array("i", a) for a in up]
+		rt.walk()
+		return rt
+
+	# Walk the tree depth first from the root, numbering towns in the order they are entered, so that the subtree of the town entered n-th
+	# is the towns entered n-th to self.leave[n]-th. The lists below are indexed by that number: the town's parent, and its children in the
+	# order they were entered with their numbers, so that the child whose subtree holds a town can be found by bisection.
+	def walk(self):
+		num_towns = len(self.towns)
+		parent = self.up[0]
+
+		children = [[] for v in range(num_towns)]
+		for v in range(1, num_towns):
+			children[parent[v]].append(v)
+
+		order = []
+		leave = [0] * num_towns
+		stack = [0] if num_towns > 0 else []
+		while len(stack) > 0:
+			v = stack.pop()
+			if v < 0:
+				leave[~v] = len(order) - 1
+				continue
+
+			order.append(v)
+			stack.append(~v)
+			stack.extend(reversed(children[v]))
+
+		enter = [0] * num_towns
+		for n in range(len(order)):
+			enter[order[n]] = n
+
+		self.entered = {}
+		for v in range(num_towns):
+			self.entered[self.towns[v].zip_code] = enter[v]
+
+		self.leave = array("i", [leave[v] for v in order])
+		self.parent = [self.towns[parent[v]] for v in order]
+		self.children = [[self.towns[c] for c in children[v]] for v in order]
+		self.child_enter = [array("i", [enter[c] for c in children[v]]) for v in order]
+
+	# Returns True if the towns form a single connected network without cycles.
+	def is_tree(towns):
+		if len(towns) == 0:
+			return True
+
+		num_edges = 0
+		for t in towns:
+			num_edges += len(t.neighbors)
+
+		if num_edges != 2 * (len(towns) - 1):
+			return False
+
+		visited = {towns[0]}
+		edge = [towns[0]]
+		while len(edge) > 0:
+			for n in edge.pop().neighbors:
+				if n not in visited:
+					visited.add(n)
+					edge.append(n)
+
+		return len(visited) == len(towns)
+
+	# Gets the ancestor of town index v which is k levels above it.
+	def ancestor(self, v, k):
+		i = 0
+		while k > 0:
+			if k & 1:
+				v = self.up[i][v]
+			k >>= 1
+			i += 1
+
+		return v
+
+	# Gets the lowest common ancestor of town indices u and v.
+	def lca(self, u, v):
+		if self.depth[u] < self.depth[v]:
+			u, v = v, u
+
+		u = self.ancestor(u, self.depth[u] - self.depth[v])
+		if u == v:
+			return u
+
+		for k in range(len(self.up) - 1, -1, -1):
+			if self.up[k][u] != self.up[k][v]:
+				u = self.up[k][u]
+				v = self.up[k][v]
+
+		return self.up[0][u]
+
+	def next_hop(self, cur_zip, dest_zip):
+		u = self.entered.get(cur_zip)
+		v = self.entered.get(dest_zip)
+		if u is None or v is None or u == v:
+			return None
+
+		# If the destination is in the current town's subtree, go down towards it, to the last child entered before it. Otherwise, go up
+		# towards the root.
+		if u < v <= self.leave[u]:
+			return self.children[u][bisect_right(self.child_enter[u], v) - 1]
+
+		return self.parent[u]
+
+	def distance(self, a_zip, b_zip):
+		u = self.index[a_zip]
+		v = self.index[b_zip]
+		return self.depth[u] + self.depth[v] - 2 * self.depth[self.lca(u, v)]
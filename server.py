@@ -0,0 +1,226 @@
+import argparse
+import asyncio
+import json
+import threading
+
+from postman_classes import *
+from interface import *
+from mail_store import *
+from snapshot import *
+from protocol import *
+
+# This file implements the multiplayer server. It hosts one world and accepts any number of TCP clients, each of which controls one of the
+# player-controlled post offices through the same commands as the local command line interface.
+#
+# Every message, in both directions, is a frame: a 4-byte big-endian length followed by that many bytes of UTF-8.
+# Clients send one command per frame, as typed in the command line interface ("gam", "rte 3 12345", "end"...). The server answers every
+# command with one frame holding a JSON object:
+#   ok       False if the command failed
+#   day      the day the command ran on
+#   output   the text the command printed
+# On connecting, the server sends a greeting in the same form, naming the client's post office, or an error if every post office is taken.
+#
+# The command "upd" is answered instead with a binary frame: a zero byte followed by an update of the delta protocol (see protocol.py),
+# holding what changed in the client's queue and notifications since their last "upd". Clients that use it don't need "gam" or "notes".
+#
+# Days follow the same barrier as the local game: the world is simulated, then every connected player handles their queue, and the next
+# day is simulated once all of them have ended theirs. Commands received while the world is being simulated, or from a player who has
+# already ended the day, are answered once the next day begins. Players who disconnect stop holding up the day, and their post office is
+# handled automatically until another client takes it. All clients are served by one event loop, so idle connections cost no threads.
+
+# Largest command frame accepted from a client.
+MAX_FRAME = 65536
+
+# Commands remote players may run.
+REMOTE_COMMANDS = {"help", "h", "?", "get_notifications", "notes", "get_all_mail", "gam", "get_mail_item", "gmi", "get_routables", "grs", "repair", "rpr", "route", "rte", "get_recovery", "grc", "find", "fnd", "end_day", "end"}
+
+# Read one frame. Returns None if the connection was closed.
+async def read_frame(reader):
+	try:
+		size = int.from_bytes(await reader.readexactly(4), "big")
+		if size > MAX_FRAME:
+			raise ValueError("Frame of %d bytes is too large." % size)
+
+		return await reader.readexactly(size)
+	except asyncio.IncompleteReadError:
+		return None
+
+def write_frame(writer, data):
+	writer.write(len(data).to_bytes(4, "big") + data)
+
+# Write a response frame.
+def write_response(writer, ok, day, output):
+	write_frame(writer, json.dumps({"ok": ok, "day": day, "output": output}).encode("utf-8"))
+
+# A connected client, and the post office they control.
+class pm_player:
+	def __init__(self, server, town, addr):
+		self.town = town
+		self.ended = False
+
+		# Command output is collected here and sent as one response.
+		self.output = []
+		self.cli = pm_cli(server.pm, addr, town, self.output.append)
+
+		# State of the client's delta protocol session.
+		self.encoder = delta_encoder()
+
+class pm_server:
+	def __init__(self, pm):
+		self.pm = pm
+
+		# Player-controlled towns, and the player controlling each of them or None.
+		self.players = {}
+		for t in pm.towns:
+			if t.player_ctrl:
+				self.players[t] = None
+
+		# Nobody has joined yet, so the world waits after the first day.
+		pm.phase.num_players = 0
+
+		self.loop = None
+
+		# Set when the next day begins. Replaced by a new event every day.
+		self.day_started = None
+
+	# Run the server until the process is stopped.
+	async def serve(self, host, port):
+		self.loop = asyncio.get_running_loop()
+		self.day_started = asyncio.Event()
+
+		# The simulation runs in its own thread, so that players can keep connecting while a day is simulated.
+		threading.Thread(target=self.simulate, daemon=True).start()
+
+		# The backlog is large so that hundreds of clients can connect at once.
+		srv = await asyncio.start_server(self.handle_client, host, port, backlog=1024)
+		print("Serving %d post offices on %s" % (len(self.players), ", ".join(str(s.getsockname()) for s in srv.sockets)))
+
+		async with srv:
+			await srv.serve_forever()
+
+	# Simulation thread. Each day is simulated once every player has ended the previous one.
+	def simulate(self):
+		while True:
+			with self.pm.phase.simulating():
+				self.pm.simulate_day()
+
+			self.loop.call_soon_threadsafe(self.begin_day)
+
+	# Called on the event loop when a day has been simulated.
+	def begin_day(self):
+		for p in self.players.values():
+			if p is not None:
+				p.ended = False
+
+		day_started = self.day_started
+		self.day_started = asyncio.Event()
+		day_started.set()
+
+	# Wait until the player may run commands.
+	async def wait_for_turn(self, player):
+		while player.ended or self.pm.phase.is_simulating:
+			await self.day_started.wait()
+
+	async def handle_client(self, reader, writer):
+		addr = writer.get_extra_info("peername")
+
+		# Bind the client to a free post office.
+		town = None
+		for t in self.players:
+			if self.players[t] is None:
+				town = t
+				break
+
+		if town is None:
+			write_response(writer, False, self.pm.phase.day, "No free post offices.")
+			await writer.drain()
+			writer.close()
+			return
+
+		player = pm_player(self, town, addr)
+		self.players[town] = player
+		await self.loop.run_in_executor(None, self.pm.phase.add_player)
+
+		try:
+			write_response(writer, True, self.pm.phase.day, "You control the post office of " + town.get_address_line() + ".")
+			await writer.drain()
+
+			while True:
+				try:
+					frame = await read_frame(reader)
+				except ValueError as e:
+					write_response(writer, False, self.pm.phase.day, str(e))
+					break
+
+				if frame is None:
+					break
+
+				await self.wait_for_turn(player)
+
+				# Commands take the phase lock, which the simulation thread holds for a whole day, so they run in the executor to keep the event
+				# loop serving other clients.
+				if frame.strip().lower() == b"upd":
+					write_frame(writer, b"\x00" + await self.loop.run_in_executor(None, self.encode_update, player))
+					await writer.drain()
+					continue
+
+				ok = await self.loop.run_in_executor(None, self.run_command, player, frame.decode("utf-8", "replace"))
+				write_response(writer, ok, self.pm.phase.day, "\n".join(player.output))
+				player.output.clear()
+				await writer.drain()
+
+		except ConnectionError:
+			pass
+
+		finally:
+			self.players[town] = None
+			await self.loop.run_in_executor(None, self.pm.phase.remove_player, player)
+			writer.close()
+
+	# Encode a delta protocol update of a player's queue and notifications.
+	def encode_update(self, player):
+		with self.pm.phase.lock:
+			return player.encoder.encode(player.town, self.pm.phase.day)
+
+	# Run a command for a player. Returns False if the command failed. Takes the phase lock, so it must not be called on the event loop.
+	def run_command(self, player, line):
+		inp = line.strip().lower().split(" ")
+		if inp[0] not in REMOTE_COMMANDS:
+			player.output.append("Unknown command " + inp[0] + ".")
+			return False
+
+		with self.pm.phase.lock:
+			try:
+				if not player.cli.run_command(inp):
+					player.ended = True
+					self.pm.phase.end_day(player)
+			except (IndexError, ValueError):
+				player.output.append("Invalid command.")
+				return False
+
+		return True
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Postman multiplayer server.")
+	parser.add_argument("snapshot", nargs="?", help="snapshot file to resume from")
+	parser.add_argument("--host", default="127.0.0.1")
+	parser.add_argument("--port", type=int, default=7070)
+	parser.add_argument("--players", type=int, default=4, help="number of player-controlled post offices")
+	parser.add_argument("--seed", type=int, help="seed for world and mail generation")
+	args = parser.parse_args()
+
+	if args.snapshot is not None:
+		pm = load_snapshot(args.snapshot)
+	else:
+		pm = postman("postman_campaign", args.seed)
+
+		# Make sure there are enough towns for every player.
+		pm.settings.world_gen.num_additional_towns = max(pm.settings.world_gen.num_additional_towns, args.players)
+		pm.gen_map()
+
+	pm.set_player_towns(args.players)
+
+	if pm.settings.mail_store == "columnar" and pm.store is None:
+		pm.store = mail_columns(pm)
+
+	asyncio.run(pm_server(pm).serve(args.host, args.port))
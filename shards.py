@@ -0,0 +1,386 @@
+import atexit
+import multiprocessing
+from collections import deque
+from multiprocessing import resource_tracker, shared_memory
+
+from mail_store import np, mail_columns
+
+# This file implements sharded execution of the columnar store's daily handle and advance passes. The towns are split into shards along
+# subtrees of the postal network, and each shard is given to a worker process which routes and moves the letters in its towns and houses.
+#
+# The store's columns are kept in one block of shared memory that every worker maps, with the rows grouped by shard, so each worker works on
+# its own contiguous slice of rows and nothing is copied in or out. Workers send back only what the main process needs: counts, the
+# notifications to send, and the rows of the letters that moved into another shard. Only those rows, and the few rows in the way where
+# shards grow or shrink, are moved to regroup the rows each day. New mail is added after the last shard and moved into place the same way.
+#
+# The routers' damage rolls only depend on the day and the letter (see letter_rolls), and everything the main process does to letters one
+# at a time is done in canonical order, so the result is the same as running the store in one process with the same seed.
+
+# The columns in shared memory: the store's columns, followed by the letters delivered by the last handle pass.
+shard_columns = mail_columns.columns + (("delivered", "?"),)
+
+# Split the towns into num_shards shards of connected subtrees with roughly equal populations. Returns the shard of each town, in the order
+# of pm.towns. The network is rooted at the first town. If it isn't a tree, a breadth-first spanning tree is split instead.
+def partition_towns(pm, num_shards):
+	num_towns = len(pm.towns)
+	index = {}
+	for i in range(num_towns):
+		index[pm.towns[i]] = i
+
+	# Root the network and list the towns in breadth-first order.
+	parent = [0] * num_towns
+	visited = bytearray(num_towns)
+	visited[0] = 1
+	order = []
+	edge = deque([0])
+	while len(edge) > 0:
+		cur = edge.popleft()
+		order.append(cur)
+		for n in pm.towns[cur].neighbors:
+			n_i = index[n]
+			if not visited[n_i]:
+				visited[n_i] = 1
+				parent[n_i] = cur
+				edge.append(n_i)
+
+	# Cut subtrees off bottom-up once they reach a fraction of the total population. Cutting pieces smaller than a shard lets them be
+	# balanced between shards afterwards.
+	weight = [len(t.citizens) + 1 for t in pm.towns]
+	target = sum(weight) / (4 * num_shards)
+
+	subtree = list(weight)
+	is_cut = bytearray(num_towns)
+	for v in reversed(order):
+		if v != 0 and subtree[v] >= target:
+			is_cut[v] = 1
+		elif v != 0:
+			subtree[parent[v]] += subtree[v]
+
+	is_cut[0] = 1
+
+	# Each town belongs to the piece cut at its nearest cut ancestor.
+	piece = [0] * num_towns
+	for v in order:
+		piece[v] = v if is_cut[v] else piece[parent[v]]
+
+	# Give the largest pieces out first, each to the least loaded shard.
+	load = [0] * num_shards
+	piece_shard = {}
+	for v in sorted((v for v in order if is_cut[v]), key=lambda v: -subtree[v]):
+		s = load.index(min(load))
+		piece_shard[v] = s
+		load[s] += subtree[v]
+
+	return [piece_shard[piece[v]] for v in range(num_towns)]
+
+# Lay out the columns for capacity letters in a shared memory buffer, and return them as a dict of arrays.
+def shard_arrays(buf, capacity):
+	arrays = {}
+	offset = 0
+	for name, dtype in shard_columns:
+		arrays[name] = np.ndarray(capacity, dtype=dtype, buffer=buf, offset=offset)
+		offset += (capacity * np.dtype(dtype).itemsize + 7) // 8 * 8
+
+	return arrays
+
+# Gets the size of the shared memory buffer for capacity letters.
+def shard_arrays_size(capacity):
+	return sum((capacity * np.dtype(dtype).itemsize + 7) // 8 * 8 for name, dtype in shard_columns)
+
+# Main loop of a worker process. Messages from the pool are tuples starting with a command:
+#   ("place_shard", place_shard)    the shard of every place
+#   ("memory", name, capacity)      map the shared memory buffer of the columns with the given name
+#   ("senders", name, num_senders)  map the shared memory buffer of the store's sender_house with the given name
+#   ("router", router)              route letters with the given row_router
+#   ("handle", start, end, seed)    route the rows from start to end with row_router.handle, and reply with its counts
+#   ("advance", start, end)         move the rows from start to end with row_router.advance, and reply with the notifications, and the
+#                                   rows now in another shard
+#   ("stop",)                       exit
+def shard_worker(shard, conn):
+	place_shard = None
+	shm = None
+	arrays = None
+	sender_shm = None
+	sender_house = None
+	router = None
+
+	# Views of the columns of the rows last worked on.
+	c = None
+
+	while True:
+		msg = conn.recv()
+
+		if msg[0] == "place_shard":
+			place_shard = msg[1]
+
+		elif msg[0] == "memory":
+			if shm is not None:
+				arrays = None
+				c = None
+				shm.close()
+
+			shm = shared_memory.SharedMemory(name=msg[1])
+			arrays = shard_arrays(shm.buf, msg[2])
+
+		elif msg[0] == "senders":
+			sender_shm = shared_memory.SharedMemory(name=msg[1])
+			sender_house = np.ndarray(msg[2], dtype="i4", buffer=sender_shm.buf)
+
+		elif msg[0] == "router":
+			router = msg[1]
+
+		elif msg[0] == "handle":
+			start, end, seed = msg[1:]
+			c = {}
+			for name, dtype in mail_columns.columns:
+				c[name] = arrays[name][start:end]
+
+			delivered, num_unrouted, num_errors, num_damaged = router.handle(c, sender_house, seed)
+			arrays["delivered"][start:end] = delivered
+			conn.send((num_unrouted, num_errors, num_damaged))
+
+		elif msg[0] == "advance":
+			start, end = msg[1:]
+			c = {}
+			for name, dtype in mail_columns.columns:
+				c[name] = arrays[name][start:end]
+
+			notes = router.advance(c)
+			conn.send((notes, start + np.flatnonzero(place_shard[c["current"]] != shard)))
+
+		elif msg[0] == "stop":
+			break
+
+	arrays = None
+	c = None
+	sender_house = None
+	if shm is not None:
+		shm.close()
+	if sender_shm is not None:
+		sender_shm.close()
+
+# Pool of worker processes, one per shard, which run the columnar store's handle and advance passes. Set as the store's shards to use it.
+# The pool moves the store's columns, and the house of every sender, into shared memory. Workers are forked, so this needs a platform
+# that supports fork.
+class shard_pool:
+	def __init__(self, st, num_shards):
+		self.st = st
+		self.num_shards = num_shards
+
+		# The shard of every place. Houses are in the shard of their town.
+		town_shard = np.array(partition_towns(st.pm, num_shards), dtype="i4")
+		self.place_shard = town_shard[st.place_town]
+
+		# The rows of shard s are the rows from bounds[s] to bounds[s + 1]. Rows after bounds[-1] were added since the rows were last
+		# grouped, and are moved into place by regroup.
+		self.bounds = np.zeros(num_shards + 1, dtype="i8")
+
+		# Shared memory holding the columns, buffers replaced by a larger one that are still mapped, and the router last sent to the workers.
+		self.shm = None
+		self.arrays = None
+		self.retired = []
+		self.router = None
+
+		# Start the resource tracker before forking, so that the workers share it instead of each starting their own, which would report
+		# the shared memory as leaked when they exit.
+		resource_tracker.ensure_running()
+
+		ctx = multiprocessing.get_context("fork")
+		self.conns = []
+		self.procs = []
+		for s in range(num_shards):
+			conn, child_conn = ctx.Pipe()
+			proc = ctx.Process(target=shard_worker, args=(s, child_conn), daemon=True)
+			proc.start()
+
+			conn.send(("place_shard", self.place_shard))
+			self.conns.append(conn)
+			self.procs.append(proc)
+
+		# Senders don't come and go, so their houses are moved into shared memory once. store.move_sender updates them in place.
+		self.sender_shm = shared_memory.SharedMemory(create=True, size=max(st.sender_house.nbytes, 1))
+		sender_house = np.ndarray(len(st.sender_house), dtype="i4", buffer=self.sender_shm.buf)
+		sender_house[:] = st.sender_house
+		st.sender_house = sender_house
+		for conn in self.conns:
+			conn.send(("senders", self.sender_shm.name, len(sender_house)))
+
+		# Move the columns into shared memory, and group the rows.
+		st.data = self.grow(st.data, st.n, max(len(st.data["ID"]), 1024))
+		st.resize(st.n)
+		self.regroup(np.zeros(0, dtype="i8"))
+
+		atexit.register(self.close)
+
+	# Move the first n rows of the columns in data into a new shared memory buffer with room for capacity letters, and return its
+	# columns. The old buffer is released once nothing refers to it anymore.
+	def grow(self, data, n, capacity):
+		shm = shared_memory.SharedMemory(create=True, size=shard_arrays_size(capacity))
+		arrays = shard_arrays(shm.buf, capacity)
+		for name, dtype in mail_columns.columns:
+			arrays[name][:n] = data[name][:n]
+
+		for conn in self.conns:
+			conn.send(("memory", shm.name, capacity))
+
+		if self.shm is not None:
+			self.retired.append(self.shm)
+		self.shm = shm
+		self.arrays = arrays
+		self.free_retired()
+
+		return arrays
+
+	# Release the old shared memory buffers that nothing in this process refers to anymore.
+	def free_retired(self):
+		retired = []
+		for shm in self.retired:
+			try:
+				shm.close()
+				shm.unlink()
+			except BufferError:
+				retired.append(shm)
+
+		self.retired = retired
+
+	# Keep the bounds of the shards in line with store.keep, which keeps only the rows selected by the boolean mask.
+	def keep(self, mask):
+		kept_before = np.zeros(len(mask) + 1, dtype="i8")
+		np.cumsum(mask, out=kept_before[1:])
+		self.bounds = kept_before[self.bounds]
+
+	# Move rows so that every shard's rows are grouped again. rows holds the rows that may be in the wrong shard's rows, and every row
+	# after bounds[-1] is moved into place too. Only those rows, and the rows in the way where the bounds move, are moved, unless they are
+	# a large part of all rows, in which case all rows are sorted by shard.
+	def regroup(self, rows):
+		st = self.st
+		cur = st.cols["current"]
+		num_shards = self.num_shards
+		tail = int(self.bounds[-1])
+
+		if len(rows) + st.n - tail > st.n // 8:
+			order = np.argsort(self.place_shard[cur], kind="stable")
+			for name in st.cols:
+				st.cols[name][:] = st.cols[name][order]
+
+			np.cumsum(np.bincount(self.place_shard[cur], minlength=num_shards), out=self.bounds[1:])
+			return
+
+		# Count the rows each shard gains and loses.
+		rows = np.concatenate((rows, np.arange(tail, st.n)))
+		shard = self.place_shard[cur[rows]]
+		was_in = np.searchsorted(self.bounds, rows, "right") - 1
+		sizes = np.diff(self.bounds) + np.bincount(shard, minlength=num_shards) - np.bincount(was_in, minlength=num_shards + 1)[:num_shards]
+		bounds = np.zeros(num_shards + 1, dtype="i8")
+		np.cumsum(sizes, out=bounds[1:])
+
+		# Rows between the old and new bounds of a shard are in another shard's rows now.
+		marked = np.zeros(st.n, dtype=bool)
+		marked[rows] = True
+		for old, new in zip(self.bounds[1:-1].tolist(), bounds[1:-1].tolist()):
+			marked[min(old, new):max(old, new)] = True
+
+		rows = np.flatnonzero(marked)
+		shard = self.place_shard[cur[rows]]
+		wrong = shard != np.searchsorted(bounds, rows, "right") - 1
+
+		# Every row in the wrong place is moved to one of the places left by them, in the rows of its own shard.
+		rows = rows[wrong]
+		order = rows[np.argsort(shard[wrong], kind="stable")]
+		for name in st.cols:
+			col = st.cols[name]
+			col[rows] = col[order]
+
+		self.bounds = bounds
+
+	# Send the router to the workers if it changed.
+	def send_router(self, router):
+		if router is not self.router:
+			for conn in self.conns:
+				conn.send(("router", router))
+			self.router = router
+
+	# Run row_router.handle over every shard's rows, each in its worker. Returns the same as row_router.handle.
+	def handle(self, router, seed):
+		self.free_retired()
+		self.send_router(router)
+		self.regroup(np.zeros(0, dtype="i8"))
+
+		for s in range(self.num_shards):
+			self.conns[s].send(("handle", int(self.bounds[s]), int(self.bounds[s + 1]), seed))
+
+		totals = [0, 0, 0]
+		for conn in self.conns:
+			counts = conn.recv()
+			for i in range(3):
+				totals[i] += counts[i]
+
+		return (self.arrays["delivered"][:self.st.n], *totals)
+
+	# Run row_router.advance over every shard's rows, each in its worker, then move the rows that changed shards. Returns the notifications
+	# of every shard, merged as returned by row_router.advance.
+	def advance(self):
+		self.send_router(self.st.get_router())
+		self.regroup(np.zeros(0, dtype="i8"))
+
+		for s in range(self.num_shards):
+			self.conns[s].send(("advance", int(self.bounds[s]), int(self.bounds[s + 1])))
+
+		notes = []
+		moved = []
+		for conn in self.conns:
+			shard_notes, rows = conn.recv()
+			notes.append(shard_notes)
+			moved.append(rows)
+
+		self.regroup(np.concatenate(moved))
+
+		# Pairs are only counted by the shard of their notifier, so they are merged without adding counts up.
+		merged = []
+		for i in range(len(notes[0])):
+			keys = np.concatenate([n[i][1] for n in notes])
+			counts = np.concatenate([n[i][2] for n in notes])
+			order = np.argsort(keys, kind="stable")
+			merged.append((notes[0][i][0], keys[order], counts[order]))
+
+		return merged
+
+	# Gets the rows of the mail at the place with the given place index, searching only its shard's rows and the rows added since.
+	def rows_at(self, place):
+		cur = self.st.cols["current"]
+		s = self.place_shard[place]
+		start, end = int(self.bounds[s]), int(self.bounds[s + 1])
+		rows = start + np.flatnonzero(cur[start:end] == place)
+		tail = int(self.bounds[-1])
+		return np.concatenate((rows, tail + np.flatnonzero(cur[tail:] == place)))
+
+	# Stop the workers and release the shared memory. The store's columns are copied out of it and the store is left unsharded.
+	def close(self):
+		for conn in self.conns:
+			conn.send(("stop",))
+		for proc in self.procs:
+			proc.join()
+
+		self.conns = []
+		self.procs = []
+
+		st = self.st
+		if st.shards is self:
+			st.shards = None
+			data = {}
+			for name, dtype in mail_columns.columns:
+				data[name] = st.data[name][:st.n].copy()
+			st.data = data
+			st.resize(st.n)
+			st.sender_house = st.sender_house.copy()
+
+		self.arrays = None
+		if self.shm is not None:
+			self.retired.append(self.shm)
+			self.shm = None
+		self.free_retired()
+
+		if self.sender_shm is not None:
+			self.retired.append(self.sender_shm)
+			self.sender_shm = None
+			self.free_retired()
@@ -0,0 +1,516 @@
+import gc
+import json
+import mmap
+import sys
+from array import array
+from itertools import accumulate
+
+from postman_classes import *
+from routing import *
+
+# This file implements saving and loading the full game state to a snapshot file, so that a world can be resumed without regenerating it.
+#
+# A snapshot is a small JSON header followed by flat arrays of fixed-size numbers, each aligned to 8 bytes:
+#   8 bytes   magic, b"PMSNAP\0\0"
+#   4 bytes   format version, little-endian
+#   4 bytes   header length, little-endian
+#   header    UTF-8 JSON. Holds the scalar game state, a table of every string used in the world, and the type code, offset and length of
+#             every array section.
+#   sections  raw array data in the byte order named by the header.
+# Loading memory-maps the file and reads every section in place. Objects are referred to by index: towns in the order of postman.towns,
+# places as towns followed by every house (in town, street and house order, as in mail_store.py), senders in the order of postman.senders,
+# and mail in the order of postman.post followed by the mail in recovery bins. Lists of lists are stored as a flat array plus an array of start offsets (<name>_start).
+
+SNAPSHOT_MAGIC = b"PMSNAP\0\0"
+SNAPSHOT_VERSION = 5
+
+# Values of the mail_following section that are not place indices.
+FOLLOWING_NONE = -1
+FOLLOWING_RECOVERY = -2
+
+# Value of the town_note_arg section for notifications without an argument.
+NOTE_NO_ARG = -1
+
+# Accumulates the sections and string table of a snapshot being written.
+class snapshot_writer:
+	def __init__(self):
+		self.sections = []
+		self.strings = []
+		self.string_index = {}
+
+	# Gets the index of a string in the string table, adding it if needed.
+	def string(self, s):
+		if s not in self.string_index:
+			self.string_index[s] = len(self.strings)
+			self.strings.append(s)
+
+		return self.string_index[s]
+
+	def add(self, name, typecode, values):
+		self.sections.append((name, array(typecode, values)))
+
+	# Add a list of lists as a flat section and its start offsets.
+	def add_nested(self, name, typecode, lists):
+		start = array("i", accumulate((len(l) for l in lists), initial=0))
+		flat = array(typecode, [x for l in lists for x in l])
+
+		self.sections.append((name + "_start", start))
+		self.sections.append((name, flat))
+
+	def write(self, fn, header):
+		header["byteorder"] = sys.byteorder
+		header["strings"] = self.strings
+		header["sections"] = {}
+
+		# Lay out the sections after the header. The header size depends on the offsets, so offsets are relative to the end of the header.
+		offset = 0
+		for name, data in self.sections:
+			header["sections"][name] = [data.typecode, offset, len(data)]
+			offset += (len(data) * data.itemsize + 7) // 8 * 8
+
+		header_bytes = json.dumps(header).encode("utf-8")
+		data_start = (16 + len(header_bytes) + 7) // 8 * 8
+		header["data_start"] = data_start
+		header_bytes = json.dumps(header).encode("utf-8")
+
+		# Adding data_start may have pushed the data start further.
+		while 16 + len(header_bytes) > data_start:
+			data_start += 8
+			header["data_start"] = data_start
+			header_bytes = json.dumps(header).encode("utf-8")
+
+		fout = open(fn, "wb")
+		fout.write(SNAPSHOT_MAGIC)
+		fout.write(SNAPSHOT_VERSION.to_bytes(4, "little"))
+		fout.write(len(header_bytes).to_bytes(4, "little"))
+		fout.write(header_bytes)
+		fout.write(bytes(data_start - 16 - len(header_bytes)))
+
+		for name, data in self.sections:
+			raw = data.tobytes()
+			fout.write(raw)
+			fout.write(bytes((8 - len(raw) % 8) % 8))
+
+		fout.close()
+
+# Reads the sections of a memory-mapped snapshot.
+class snapshot_reader:
+	def __init__(self, fn):
+		self.fin = open(fn, "rb")
+		self.mm = mmap.mmap(self.fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+		if self.mm[0:8] != SNAPSHOT_MAGIC:
+			raise ValueError(fn + " is not a postman snapshot.")
+
+		version = int.from_bytes(self.mm[8:12], "little")
+		if version != SNAPSHOT_VERSION:
+			raise ValueError("Unsupported snapshot version %d (expected %d)." % (version, SNAPSHOT_VERSION))
+
+		header_len = int.from_bytes(self.mm[12:16], "little")
+		self.header = json.loads(self.mm[16:16 + header_len].decode("utf-8"))
+		self.strings = self.header["strings"]
+		self.views = []
+
+	# Gets a section as a sequence of numbers. The data is read in place from the file unless its byte order must be swapped.
+	def get(self, name):
+		typecode, offset, length = self.header["sections"][name]
+		itemsize = array(typecode).itemsize
+		start = self.header["data_start"] + offset
+
+		if self.header["byteorder"] != sys.byteorder:
+			data = array(typecode, self.mm[start:start + length * itemsize])
+			data.byteswap()
+			return data
+
+		view = memoryview(self.mm)[start:start + length * itemsize].cast(typecode)
+		self.views.append(view)
+		return view
+
+	# Gets a section saved with snapshot_writer.add_nested as a function returning the list at an index.
+	def get_nested(self, name):
+		start = self.get(name + "_start").tolist()
+		flat = self.get(name).tolist()
+		return lambda i: flat[start[i]:start[i + 1]]
+
+	def close(self):
+		for view in self.views:
+			view.release()
+
+		self.mm.close()
+		self.fin.close()
+
+# Gets every place in the game, towns first, followed by every house.
+def get_places(pm):
+	places = list(pm.towns)
+	for t in pm.towns:
+		for s in t.streets:
+			places.extend(s.houses)
+
+	return places
+
+# Save the full game state of the postman to a snapshot file.
+def save_snapshot(pm, fn):
+	w = snapshot_writer()
+
+	gc_was_enabled = gc.isenabled()
+	gc.disable()
+
+	places = get_places(pm)
+	place_index = {}
+	for i in range(len(places)):
+		place_index[places[i]] = i
+
+	town_index = {}
+	for i in range(len(pm.towns)):
+		town_index[pm.towns[i]] = i
+
+	sender_index = {}
+	for i in range(len(pm.senders)):
+		sender_index[pm.senders[i]] = i
+
+	# Mail in recovery bins is out of circulation, so it isn't in the post.
+	recovery_items = [t.recovery.items() for t in pm.towns]
+	letters = list(pm.post) + [m for items in recovery_items for day, m in items]
+	mail_index = {}
+	for i in range(len(letters)):
+		mail_index[letters[i]] = i
+
+	houses = places[len(pm.towns):]
+	streets = [s for t in pm.towns for s in t.streets]
+
+	# Towns and the network
+	w.add("town_zip", "i", [t.zip_code for t in pm.towns])
+	w.add("town_x", "d", [t.x for t in pm.towns])
+	w.add("town_y", "d", [t.y for t in pm.towns])
+	w.add("town_player_ctrl", "B", [t.player_ctrl for t in pm.towns])
+	w.add("town_name", "i", [w.string(t.name) for t in pm.towns])
+	w.add("town_new_mail_in_pq", "i", [t.new_mail_in_pq for t in pm.towns])
+	w.add_nested("town_neighbor", "i", [[town_index[n] for n in t.neighbors] for t in pm.towns])
+	w.add_nested("town_citizen", "i", [[sender_index[c] for c in t.citizens] for t in pm.towns])
+
+	# Streets, grouped by town, and houses, grouped by street.
+	w.add("town_num_streets", "i", [len(t.streets) for t in pm.towns])
+	w.add("street_name", "i", [w.string(s.name) for s in streets])
+	w.add("street_num_houses", "i", [len(s.houses) for s in streets])
+	w.add("house_number", "i", [h.number for h in houses])
+	w.add_nested("house_sender", "i", [[sender_index[r] for r in h.senders] for h in houses])
+
+	# Senders
+	w.add("sender_house", "i", [place_index[r.house] for r in pm.senders])
+	w.add("sender_first_name", "i", [w.string(r.first_name) for r in pm.senders])
+	w.add("sender_last_name", "i", [w.string(r.last_name) for r in pm.senders])
+	w.add_nested("sender_recv_from", "i", [[f for f, day in r.recv_from.items()] for r in pm.senders])
+	w.add_nested("sender_recv_day", "i", [[day for f, day in r.recv_from.items()] for r in pm.senders])
+
+	# Mail objects. Senders' in_transit lists are rebuilt from these.
+	w.add("mail_ID", "i", [m.ID for m in letters])
+	w.add("mail_sender", "i", [sender_index[m.sender] for m in letters])
+	w.add("mail_recipient", "i", [sender_index[m.recipient] for m in letters])
+	w.add("mail_addressed", "i", [place_index[m.addressed] for m in letters])
+	w.add("mail_story", "i", [w.string(m.is_story) if m.is_story else -1 for m in letters])
+	w.add("mail_act", "B", [m.act for m in letters])
+	w.add("mail_following", "i", [FOLLOWING_NONE if m.following is None else FOLLOWING_RECOVERY if m.following == "recovery" else place_index[m.following] for m in letters])
+	w.add("mail_stamp", "b", [m.stamp for m in letters])
+	w.add("mail_damage_lvl", "b", [m.damage_lvl for m in letters])
+	w.add("mail_repair_lvl", "b", [m.repair_lvl for m in letters])
+	w.add("mail_is_auto", "B", [m.is_auto for m in letters])
+	w.add("mail_previous", "i", [place_index[m.previous] for m in letters])
+	w.add("mail_current", "i", [place_index[m.current] for m in letters])
+	w.add("mail_age", "i", [m.age for m in letters])
+
+	# The mail at each place, player queues and notifications, in their current order.
+	w.add_nested("place_post", "i", [[mail_index[m] for m in p.post] for p in places])
+	w.add_nested("town_player_queue", "i", [[mail_index[m] for m in t.player_queue] for t in pm.towns])
+	w.add_nested("town_note_notifier", "i", [[place_index[n[0]] for n in t.notes] for t in pm.towns])
+	w.add_nested("town_note_code", "i", [[n[1] for n in t.notes] for t in pm.towns])
+	w.add_nested("town_note_arg", "i", [[NOTE_NO_ARG if n[2] is None else n[2] for n in t.notes] for t in pm.towns])
+	w.add_nested("town_note_count", "i", [[n[3] for n in t.notes] for t in pm.towns])
+
+	# Recovery bins, requests in progress, and requests to come. Requests for mail that no longer exists are dropped.
+	w.add_nested("town_recovery_mail", "i", [[mail_index[m] for day, m in items] for items in recovery_items])
+	w.add_nested("town_recovery_day", "i", [[day for day, m in items] for items in recovery_items])
+	requests = pm.recovery.requests
+	w.add("request_sender", "i", [sender_index[req.sender] for req in requests])
+	w.add("request_recipient", "i", [sender_index[req.recipient] for req in requests])
+	w.add("request_ID", "i", [req.ID for req in requests])
+	w.add("request_dest", "i", [town_index[req.dest] for req in requests])
+	w.add("request_town", "i", [town_index[req.town] for req in requests])
+	w.add("request_day", "i", [req.day for req in requests])
+	due = [d for d in sorted(pm.recovery.due) if d[2] in mail_index]
+	w.add("due_day", "i", [d[0] for d in due])
+	w.add("due_mail", "i", [mail_index[d[2]] for d in due])
+
+	# Forwarding orders, in the order they were placed, and empty houses, in the order they are picked from.
+	orders = pm.forwarding.items()
+	w.add("forward_sender", "i", [sender_index[o[0]] for o in orders])
+	w.add("forward_from", "i", [place_index[o[1]] for o in orders])
+	w.add("forward_to", "i", [place_index[o[2]] for o in orders])
+	w.add("forward_expires", "i", [o[3] for o in orders])
+	w.add("vacant_house", "i", [place_index[h] for h in pm.vacancies.houses])
+
+	header = {
+		"server": pm.serv,
+		"ruleset": pm.days.index(pm.day),
+		"day": pm.phase.day,
+		"next_mail_ID": pm.next_mail_ID,
+		"num_posted": len(pm.post),
+		"seed": pm.seed,
+		"rng_state": pm.rng.getstate(),
+		"np_rng_state": None if pm.np_rng is None else pm.np_rng.bit_generator.state,
+		"routing": None,
+		"store": None,
+	}
+
+	# The tree router is small, so it is stored alongside. The routing table is rebuilt on load.
+	if type(pm.routing) is routing_tree:
+		header["routing"] = "tree"
+		header["tree_levels"] = len(pm.routing.up)
+		w.add("tree_depth", "i", [pm.routing.depth[pm.routing.index[t.zip_code]] for t in pm.towns])
+		order = [pm.routing.index[t.zip_code] for t in pm.towns]
+		for k in range(len(pm.routing.up)):
+			w.add("tree_up_%d" % k, "i", [town_index[pm.routing.towns[pm.routing.up[k][i]]] for i in order])
+	elif pm.routing is not None:
+		header["routing"] = "table"
+
+	# Columns of the columnar mail store, if any.
+	if pm.store is not None:
+		pm.store.flush()
+		header["store"] = [name for name, dtype in pm.store.columns]
+		header["store_rng_state"] = pm.store.rng.bit_generator.state
+		for name, dtype in pm.store.columns:
+			w.sections.append(("store_" + name, array({"i4": "i", "i1": "b", "u1": "B"}[dtype], pm.store.cols[name].tobytes())))
+
+	w.write(fn, header)
+
+	if gc_was_enabled:
+		gc.enable()
+
+# Load a game saved with save_snapshot and return its postman.
+def load_snapshot(fn):
+	r = snapshot_reader(fn)
+	h = r.header
+	strings = r.strings
+
+	pm = postman(h["server"], h["seed"])
+	pm.day = pm.days[h["ruleset"]]
+	pm.phase.day = h["day"]
+	pm.next_mail_ID = h["next_mail_ID"]
+
+	# Resume the random generators where they left off, so that a resumed game plays out as the original would have.
+	version, state, gauss_next = h["rng_state"]
+	pm.rng.setstate((version, tuple(state), gauss_next))
+	if pm.np_rng is not None and h["np_rng_state"] is not None:
+		pm.np_rng.bit_generator.state = h["np_rng_state"]
+
+	# Pause the garbage collector while the objects are created, since none of them are garbage.
+	gc_was_enabled = gc.isenabled()
+	gc.disable()
+
+	# Towns
+	town_zip = r.get("town_zip").tolist()
+	town_x = r.get("town_x").tolist()
+	town_y = r.get("town_y").tolist()
+	town_player_ctrl = r.get("town_player_ctrl").tolist()
+	town_name = r.get("town_name").tolist()
+	town_new_mail_in_pq = r.get("town_new_mail_in_pq").tolist()
+
+	for i in range(len(town_zip)):
+		t = town.__new__(town)
+		t.invalidate_address()
+		t.pm = pm
+		t.x = town_x[i]
+		t.y = town_y[i]
+		t.player_ctrl = bool(town_player_ctrl[i])
+		t.citizens = []
+		t.notes = notice_board(pm.settings.aggregate_notes)
+		t.player_queue = []
+		t.post = {}
+		t.recovery = recovery_bin()
+		t.new_mail_in_pq = town_new_mail_in_pq[i]
+		t.zip_code = town_zip[i]
+		t.name = strings[town_name[i]]
+		t.neighbors = []
+		t.streets = []
+
+		pm.towns.append(t)
+		pm.zip_codes.add(t.zip_code)
+
+	town_neighbor = r.get_nested("town_neighbor")
+	for i in range(len(pm.towns)):
+		pm.towns[i].neighbors = [pm.towns[n] for n in town_neighbor(i)]
+
+	# Streets and houses
+	town_num_streets = r.get("town_num_streets").tolist()
+	street_name = r.get("street_name").tolist()
+	street_num_houses = r.get("street_num_houses").tolist()
+	house_number = r.get("house_number").tolist()
+
+	places = list(pm.towns)
+	s_i = 0
+	h_i = 0
+	for t_i in range(len(pm.towns)):
+		t = pm.towns[t_i]
+		for j in range(town_num_streets[t_i]):
+			s = street.__new__(street)
+			s.invalidate_address()
+			s.town = t
+			s.name = strings[street_name[s_i]]
+			s.houses = []
+			t.streets.append(s)
+
+			for k in range(street_num_houses[s_i]):
+				hs = house.__new__(house)
+				hs.invalidate_address()
+				hs.street = s
+				hs.number = house_number[h_i]
+				hs.post = {}
+				hs.senders = []
+				s.houses.append(hs)
+				places.append(hs)
+				h_i += 1
+
+			s_i += 1
+
+	# Senders
+	sender_house = r.get("sender_house").tolist()
+	sender_first_name = r.get("sender_first_name").tolist()
+	sender_last_name = r.get("sender_last_name").tolist()
+
+	for i in range(len(sender_house)):
+		p = sender.__new__(sender)
+		p.invalidate_address()
+		p.pm = pm
+		p.ID = i
+		p.house = places[sender_house[i]]
+		p.town = p.house.street.town
+		p.recv_from = reply_memory(pm.srv.reply_memory_size)
+		p.in_transit = {}
+		p.first_name = strings[sender_first_name[i]]
+		p.last_name = strings[sender_last_name[i]]
+		pm.senders.append(p)
+
+	town_citizen = r.get_nested("town_citizen")
+	for i in range(len(pm.towns)):
+		pm.towns[i].citizens = [pm.senders[c] for c in town_citizen(i)]
+
+	house_sender = r.get_nested("house_sender")
+	for i in range(len(pm.towns), len(places)):
+		places[i].senders = [pm.senders[c] for c in house_sender(i - len(pm.towns))]
+
+	sender_recv_from = r.get_nested("sender_recv_from")
+	sender_recv_day = r.get_nested("sender_recv_day")
+	for i in range(len(pm.senders)):
+		recv_from = pm.senders[i].recv_from
+		for f, day in zip(sender_recv_from(i), sender_recv_day(i)):
+			recv_from.add(f, day)
+
+	# Mail
+	mail_ID = r.get("mail_ID").tolist()
+	mail_sender = r.get("mail_sender").tolist()
+	mail_recipient = r.get("mail_recipient").tolist()
+	mail_addressed = r.get("mail_addressed").tolist()
+	mail_story = r.get("mail_story").tolist()
+	mail_act = r.get("mail_act").tolist()
+	mail_following = r.get("mail_following").tolist()
+	mail_stamp = r.get("mail_stamp").tolist()
+	mail_damage_lvl = r.get("mail_damage_lvl").tolist()
+	mail_repair_lvl = r.get("mail_repair_lvl").tolist()
+	mail_is_auto = r.get("mail_is_auto").tolist()
+	mail_previous = r.get("mail_previous").tolist()
+	mail_current = r.get("mail_current").tolist()
+	mail_age = r.get("mail_age").tolist()
+
+	letters = []
+	for i in range(len(mail_ID)):
+		m = mail.__new__(mail)
+		m.sender = pm.senders[mail_sender[i]]
+		m.recipient = pm.senders[mail_recipient[i]]
+		m.addressed = places[mail_addressed[i]]
+		m.ID = mail_ID[i]
+		m.is_story = False if mail_story[i] < 0 else strings[mail_story[i]]
+		m.act = mail_act[i]
+		m.following = None if mail_following[i] == FOLLOWING_NONE else "recovery" if mail_following[i] == FOLLOWING_RECOVERY else places[mail_following[i]]
+		m.stamp = mail_stamp[i]
+		m.damage_lvl = mail_damage_lvl[i]
+		m.repair_lvl = mail_repair_lvl[i]
+		m.is_auto = bool(mail_is_auto[i])
+		m.previous = places[mail_previous[i]]
+		m.current = places[mail_current[i]]
+		m.age = mail_age[i]
+
+		letters.append(m)
+		if i < h["num_posted"]:
+			pm.post[m] = None
+		m.sender.add_mail(m)
+
+	place_post = r.get_nested("place_post")
+	for i in range(len(places)):
+		for m_i in place_post(i):
+			places[i].post[letters[m_i]] = None
+
+	town_player_queue = r.get_nested("town_player_queue")
+	town_note_notifier = r.get_nested("town_note_notifier")
+	town_note_code = r.get_nested("town_note_code")
+	town_note_arg = r.get_nested("town_note_arg")
+	town_note_count = r.get_nested("town_note_count")
+	for i in range(len(pm.towns)):
+		pm.towns[i].player_queue = [letters[m_i] for m_i in town_player_queue(i)]
+
+		# Notifications are restored as they were, without merging. Nothing is posted between days, so none need merging into later.
+		for n, code, arg, count in zip(town_note_notifier(i), town_note_code(i), town_note_arg(i), town_note_count(i)):
+			pm.towns[i].notes.queue.append([places[n], code, None if arg == NOTE_NO_ARG else arg, count])
+
+	# Recovery
+	town_recovery_mail = r.get_nested("town_recovery_mail")
+	town_recovery_day = r.get_nested("town_recovery_day")
+	for i in range(len(pm.towns)):
+		for m_i, day in zip(town_recovery_mail(i), town_recovery_day(i)):
+			pm.towns[i].recovery.add(letters[m_i], day)
+
+	request_sender = r.get("request_sender").tolist()
+	request_recipient = r.get("request_recipient").tolist()
+	request_ID = r.get("request_ID").tolist()
+	request_dest = r.get("request_dest").tolist()
+	request_town = r.get("request_town").tolist()
+	request_day = r.get("request_day").tolist()
+	for i in range(len(request_ID)):
+		pm.recovery.requests.append(recovery_request(pm.senders[request_sender[i]], pm.senders[request_recipient[i]], request_ID[i], pm.towns[request_dest[i]], pm.towns[request_town[i]], request_day[i]))
+
+	for day, m_i in zip(r.get("due_day").tolist(), r.get("due_mail").tolist()):
+		pm.recovery.schedule(day, letters[m_i])
+
+	# Forwarding and vacancies
+	for s_i, old_i, new_i, expires in zip(r.get("forward_sender").tolist(), r.get("forward_from").tolist(), r.get("forward_to").tolist(), r.get("forward_expires").tolist()):
+		pm.forwarding.add(pm.senders[s_i], places[old_i], places[new_i], expires)
+
+	for h_i in r.get("vacant_house").tolist():
+		pm.vacancies.add(places[h_i])
+
+	# Routing
+	if h["routing"] == "tree":
+		pm.routing = routing_tree.from_arrays(pm.towns, r.get("tree_depth"), [r.get("tree_up_%d" % k) for k in range(h["tree_levels"])])
+	elif h["routing"] == "table":
+		pm.build_routing()
+
+	pm.addresses = address_index(pm)
+
+	# Columnar mail store
+	if h["store"] is not None:
+		from mail_store import mail_columns, np
+
+		# Creating the store draws its seed from pm.rng, so pm.rng is put back where the snapshot left it.
+		rng_state = pm.rng.getstate()
+		pm.store = mail_columns(pm)
+		pm.rng.setstate(rng_state)
+		pm.store.rng.bit_generator.state = h["store_rng_state"]
+		rows = {}
+		for name, dtype in pm.store.columns:
+			rows[name] = np.array(r.get("store_" + name), dtype=dtype)
+		pm.store.append(rows)
+
+	r.close()
+
+	if gc_was_enabled:
+		gc.enable()
+
+	return pm
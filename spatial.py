@@ -0,0 +1,81 @@
+import math
+
+# This file implements the spatial index used during world generation to find nearby towns without scanning every town.
+
+# Uniform grid of square cells. Each cell holds the objects (anything with x and y attributes) whose coordinates fall inside it.
+class spatial_grid:
+	def __init__(self, cell_size):
+		self.cell_size = cell_size
+		self.cells = {}
+
+		# Bounds of the occupied cells, so that searches know when to stop.
+		self.min_cell = None
+		self.max_cell = None
+
+	def get_cell(self, x, y):
+		return (math.floor(x / self.cell_size), math.floor(y / self.cell_size))
+
+	def add(self, obj):
+		cell = self.get_cell(obj.x, obj.y)
+		if cell in self.cells:
+			self.cells[cell].append(obj)
+		else:
+			self.cells[cell] = [obj]
+
+		if self.min_cell is None:
+			self.min_cell = cell
+			self.max_cell = cell
+		else:
+			self.min_cell = (min(self.min_cell[0], cell[0]), min(self.min_cell[1], cell[1]))
+			self.max_cell = (max(self.max_cell[0], cell[0]), max(self.max_cell[1], cell[1]))
+
+	# Gets the objects in the cells on the square ring k cells away from the given cell.
+	def get_ring(self, cell, k):
+		cx, cy = cell
+		if k == 0:
+			return self.cells.get(cell, [])
+
+		ring = []
+		for x in range(cx - k, cx + k + 1):
+			ring.extend(self.cells.get((x, cy - k), []))
+			ring.extend(self.cells.get((x, cy + k), []))
+		for y in range(cy - k + 1, cy + k):
+			ring.extend(self.cells.get((cx - k, y), []))
+			ring.extend(self.cells.get((cx + k, y), []))
+
+		return ring
+
+	# Returns True if any object is strictly closer than dist to the point.
+	def any_within(self, x, y, dist):
+		cell = self.get_cell(x, y)
+		for k in range(math.ceil(dist / self.cell_size) + 1):
+			for obj in self.get_ring(cell, k):
+				if (obj.x - x)**2 + (obj.y - y)**2 < dist**2:
+					return True
+
+		return False
+
+	# Gets the object nearest to the point and its distance, or (None, None) if the grid is empty.
+	def nearest(self, x, y):
+		if self.min_cell is None:
+			return None, None
+
+		cell = self.get_cell(x, y)
+
+		# Stop once every occupied cell has been searched.
+		max_k = max(abs(cell[0] - self.min_cell[0]), abs(cell[0] - self.max_cell[0]), abs(cell[1] - self.min_cell[1]), abs(cell[1] - self.max_cell[1]))
+
+		best = None
+		best_dist = None
+		for k in range(max_k + 1):
+			# Nothing on this ring or beyond can be nearer than k - 1 cells.
+			if best is not None and best_dist <= (k - 1) * self.cell_size:
+				break
+
+			for obj in self.get_ring(cell, k):
+				dist = ((obj.x - x)**2 + (obj.y - y)**2)**0.5
+				if best is None or dist < best_dist:
+					best = obj
+					best_dist = dist
+
+		return best, best_dist